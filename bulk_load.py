@@ -0,0 +1,35 @@
+from dotenv import load_dotenv
+import argparse
+
+load_dotenv()
+
+from src.models.database import SessionLocal
+from src.services import bulk_load_service
+
+# Loads years of bars from a CSV or Parquet export, e.g. the option ladders dumped by
+# demo.py or notebooks/data.csv, without going through the ORM
+parser = argparse.ArgumentParser()
+parser.add_argument("path", help="CSV or Parquet file of bars")
+parser.add_argument("--contract-id", type=int, required=True)
+parser.add_argument("--bar-size", type=int, required=True, help="Bar size in minutes, 1440 for daily bars")
+parser.add_argument("--data-type", default="TRADES")
+parser.add_argument("--data-type-column", help="Column holding the data type of each row, e.g. Type")
+parser.add_argument("--update", action="store_true", help="Overwrite the stored bars that differ")
+parser.add_argument("--batch-rows", type=int, default=bulk_load_service.BULK_BATCH_ROWS)
+args = parser.parse_args()
+
+with SessionLocal() as db:
+    report = bulk_load_service.load_bars(
+        db,
+        bulk_load_service.read_file(args.path, args.data_type_column),
+        contract_id=args.contract_id,
+        data_type=args.data_type,
+        bar_size=args.bar_size,
+        update=args.update,
+        batch_rows=args.batch_rows,
+    )
+
+print(
+    f"Loaded {report.rows} rows in {report.seconds:.1f}s ({report.rows_per_second:.0f} rows/s), "
+    f"{report.written} bars written"
+)
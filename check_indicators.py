@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+import sys
+
+from src.services import indicator_service
+
+
+def pandas_trend(closes: np.ndarray) -> pd.DataFrame:
+    # The full history computation get_trend used to run on every refresh
+    data = pd.DataFrame({"Close": closes})
+
+    window_length = indicator_service.RSI_WINDOW
+    delta = data["Close"].diff(1)
+    gain = (delta.where(delta > 0, 0)).rolling(window=window_length).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=window_length).mean()
+    rs = gain / loss
+    data["RSI"] = 100 - (100 / (1 + rs))
+
+    data["RSI_EMA_144"] = data["RSI"].ewm(span=indicator_service.RSI_EMA_SPAN, adjust=False).mean()
+
+    data["Trend"] = 0
+    data.loc[data["RSI_EMA_144"] > indicator_service.RSI_EMA_THRESHOLD, "Trend"] = 1
+
+    return data
+
+
+def incremental_trend(closes: np.ndarray, rng: np.random.Generator) -> dict:
+    # Fed in random batches, as the bars arrive between two refreshes
+    state = indicator_service.new_state()
+    batches = []
+    start = 0
+
+    while start < len(closes):
+        end = start + int(rng.integers(1, 300))
+        values, state = indicator_service.advance_rsi_ema(closes[start:end], state)
+        batches.append(values)
+        start = end
+
+    return {name: np.concatenate([batch[name] for batch in batches]) for name in batches[0]}
+
+
+def pandas_indicators(columns: dict) -> dict:
+    # The registered kernels, written as in the notebook with pandas
+    data = pd.DataFrame(
+        {name: columns[name] for name in ("high", "low", "close", "volume")},
+        index=pd.DatetimeIndex(columns["date"]).tz_localize("UTC"),
+    )
+    close = data["close"]
+
+    delta = close.diff(1)
+    gain = (delta.where(delta > 0, 0)).rolling(window=14).mean()
+    loss = (-delta.where(delta < 0, 0)).rolling(window=14).mean()
+
+    previous_close = close.shift(1).fillna(close)
+    true_range = pd.concat([data["high"], previous_close], axis=1).max(axis=1) - pd.concat(
+        [data["low"], previous_close], axis=1
+    ).min(axis=1)
+
+    day = data.index.tz_convert("America/New_York").date
+    traded = ((data["high"] + data["low"] + close) / 3 * data["volume"]).groupby(day).cumsum()
+
+    middle = close.rolling(20).mean()
+    deviation = close.rolling(20).std()
+    trend = pandas_trend(close.to_numpy())
+
+    return {
+        "ema_5": close.ewm(span=5, adjust=False).mean(),
+        "ema_20": close.ewm(span=20, adjust=False).mean(),
+        "rsi_14": 100 - (100 / (1 + gain / loss)),
+        "trend": trend["Trend"],
+        "trend_rsi": trend["RSI"],
+        "trend_rsi_ema": trend["RSI_EMA_144"],
+        "atr_14": true_range.rolling(14).mean(),
+        "vwap": traded / data["volume"].groupby(day).cumsum(),
+        "bollinger_20": middle,
+        "bollinger_20_upper": middle + 2 * deviation,
+        "bollinger_20_lower": middle - 2 * deviation,
+    }
+
+
+def compare(name: str, wanted: np.ndarray, got: np.ndarray, tolerance: float) -> bool:
+    if not np.array_equal(np.isnan(wanted), np.isnan(got)):
+        print(f"FAIL {name}: not missing on the same bars")
+        return False
+
+    error = np.nanmax(np.abs(wanted - got), initial=0)
+    if error > tolerance:
+        print(f"FAIL {name}: max error {error}")
+        return False
+
+    print(f"OK   {name}: max error {error}")
+    return True
+
+
+def check_registry(bars: int = 20_000, seed: int = 0) -> bool:
+    rng = np.random.default_rng(seed)
+    closes = 5800 + np.cumsum(rng.normal(0, 2, bars)).round(2)
+    columns = {
+        "date": np.datetime64("2024-01-02T14:30", "us")
+        + np.arange(bars) * np.timedelta64(5, "m"),
+        "open": closes,
+        "high": closes + rng.random(bars),
+        "low": closes - rng.random(bars),
+        "close": closes,
+        "volume": rng.integers(1, 1000, bars),
+    }
+
+    expected = pandas_indicators(columns)
+    actual = indicator_service.compute(columns)
+    ok = set(expected) == set(actual)
+
+    for name, values in expected.items():
+        # pandas' rolling std and sums drift from the windowed ones in the last bits
+        ok &= compare(name, values.to_numpy(dtype=float), actual[name].astype(float), 1e-6)
+
+    return ok
+
+
+def check_indicators(bars: int = 20_000, seed: int = 0) -> bool:
+    rng = np.random.default_rng(seed)
+    closes = 5800 + np.cumsum(rng.normal(0, 2, bars)).round(2)
+    # Flat stretches leave the RSI undefined, the EMA has to carry over them
+    closes[5000:5100] = closes[4999]
+    closes[9000:9040] = closes[8999]
+
+    expected = pandas_trend(closes)
+    actual = incremental_trend(closes, rng)
+    ok = True
+
+    for name, column in (("rsi", "RSI"), ("rsi_ema", "RSI_EMA_144"), ("trend", "Trend")):
+        # The rolling sums of pandas and the windowed means differ in the last bits
+        ok &= compare(name, expected[column].to_numpy(dtype=float), actual[name].astype(float), 1e-8)
+
+    return ok
+
+
+if __name__ == "__main__":
+    ok = check_indicators()
+    ok &= check_registry()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,124 @@
+from sqlalchemy import select, func, text
+from datetime import datetime, timedelta
+from pytz import timezone
+from dotenv import load_dotenv
+import sys
+
+load_dotenv()
+
+from src.models.database import engine
+from src.models.models import PriceBar
+from src.services import indicator_service, prices_service
+
+# Any series works, the plans do not depend on the values
+CONTRACT_ID = 1
+DATA_TYPE = "TRADES"
+BAR_SIZE = 5
+
+
+def series(query):
+    return query.where(
+        PriceBar.contract_id == CONTRACT_ID,
+        PriceBar.data_type == DATA_TYPE,
+        PriceBar.bar_size == BAR_SIZE,
+    )
+
+
+def hot_queries():
+    start_of_day = datetime.now(timezone("America/New_York")).replace(
+        hour=0, minute=0, second=0, microsecond=0
+    )
+
+    return {
+        # prices_service.get_duration_str and the stream tasks' last bar
+        "last bar": series(select(PriceBar)).order_by(PriceBar.date.desc()).limit(1),
+        # prices_service.get_price_bars_from_db with the defaults of the /bars endpoints
+        "bars by date": prices_service.price_bars_query(
+            CONTRACT_ID, DATA_TYPE, BAR_SIZE, "desc", 500
+        ),
+        # trend_tasks.find_high_low_day
+        "day high": series(select(func.max(PriceBar.high))).where(
+            PriceBar.date >= start_of_day,
+            PriceBar.date < start_of_day + timedelta(days=1),
+        ),
+        "day low": series(select(func.min(PriceBar.low))).where(
+            PriceBar.date >= start_of_day,
+            PriceBar.date < start_of_day + timedelta(days=1),
+        ),
+        # trend_tasks.get_trend, the bars since its last run
+        "new bars": series(
+            select(
+                PriceBar.date,
+                PriceBar.open,
+                PriceBar.high,
+                PriceBar.low,
+                PriceBar.close,
+                PriceBar.volume,
+            )
+        )
+        .where(PriceBar.date >= start_of_day)
+        .order_by(PriceBar.date.asc()),
+        # indicator_service.write_trend, a batch of an hour of bars, the first ones
+        # still in the RSI warm-up
+        "trend write-back": indicator_service.trend_update_statement(
+            CONTRACT_ID,
+            DATA_TYPE,
+            BAR_SIZE,
+            [
+                (start_of_day + timedelta(minutes=BAR_SIZE * i), 1, None if i < 2 else 50.0)
+                for i in range(60 // BAR_SIZE)
+            ],
+        ),
+    }
+
+
+# Reads served from the covering index alone
+INDEX_ONLY = ["bars by date", "day high", "day low", "new bars"]
+
+
+def scans(plan: dict, relation: str):
+    # The table is partitioned, the plan scans price_bars_yYYYYmMM partitions
+    if plan.get("Relation Name", "").startswith(relation):
+        yield plan
+
+    for child in plan.get("Plans", []):
+        yield from scans(child, relation)
+
+
+def check_query_plans() -> bool:
+    ok = True
+
+    # Up to date statistics and visibility map, or an index-only scan would still have
+    # to visit the heap and would not be chosen
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"VACUUM (ANALYZE) {PriceBar.__tablename__}"))
+
+    with engine.connect() as conn:
+        # A sequential or bitmap scan is only chosen now when no index can serve the
+        # query as such, whatever the size of the table we run against
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        conn.execute(text("SET LOCAL enable_bitmapscan = off"))
+
+        for name, query in hot_queries().items():
+            compiled = query.compile(dialect=conn.dialect)
+            plan = conn.exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+            ).scalar()[0]["Plan"]
+            nodes = {scan["Node Type"] for scan in scans(plan, PriceBar.__tablename__)}
+
+            if "Seq Scan" in nodes:
+                ok = False
+                print(f"FAIL {name}: sequential scan on {PriceBar.__tablename__}")
+            elif name in INDEX_ONLY and nodes != {"Index Only Scan"}:
+                ok = False
+                print(f"FAIL {name}: {', '.join(sorted(nodes))} instead of an index-only scan")
+            else:
+                print(f"OK   {name}: {plan['Node Type']}, cost {plan['Total Cost']}")
+
+        conn.rollback()
+
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_query_plans() else 1)
@@ -0,0 +1,58 @@
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from dotenv import load_dotenv
+import sys
+
+load_dotenv()
+
+from src.models.database import SQLALCHEMY_DATABASE_URL, SQLALCHEMY_READ_DATABASE_URL
+from src.models.database import engine, read_engine, get_celery_db, get_read_celery_db
+
+# Works against two Postgres instances (DB_READ_HOST=localhost:5433) as well as one
+# instance with the two pools
+SERVER = text(
+    "SELECT inet_server_port(), pg_is_in_recovery(), current_setting('transaction_read_only')"
+)
+
+
+def check_read_routing() -> bool:
+    ok = True
+    replica = SQLALCHEMY_READ_DATABASE_URL != SQLALCHEMY_DATABASE_URL
+
+    with get_celery_db() as db, get_read_celery_db() as read_db:
+        port, in_recovery, read_only = db.execute(SERVER).one()
+        print(f"primary: port {port}, in recovery {in_recovery}, read only {read_only}")
+
+        read_port, read_in_recovery, read_read_only = read_db.execute(SERVER).one()
+        print(
+            f"read:    port {read_port}, in recovery {read_in_recovery}, read only {read_read_only}"
+        )
+
+        if read_read_only != "on":
+            ok = False
+            print("FAIL the read sessions are not read only")
+
+        if replica and (read_port, read_in_recovery) == (port, in_recovery):
+            print("WARN DB_READ_HOST is set but looks like the primary")
+
+        try:
+            read_db.execute(text("CREATE TEMP TABLE read_routing_check (id INT)"))
+            ok = False
+            print("FAIL a read session could write")
+        except DBAPIError:
+            read_db.rollback()
+            print("OK   a read session cannot write")
+
+        # Each role draws from its own pool
+        print(f"primary pool: {engine.pool.status()}")
+        print(f"read pool:    {read_engine.pool.status()}")
+
+        if engine.pool is read_engine.pool or engine.pool.checkedout() != 1:
+            ok = False
+            print("FAIL the read session took a connection of the primary pool")
+
+    return ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_read_routing() else 1)
@@ -1,10 +1,36 @@
-from src.services.ibapi_service import connect_to_ib
+from src.services import (
+    aggregation_service,
+    ibapi_service,
+    market_data_service,
+    metrics_service,
+    streaming_service,
+    cache,
+)
+from src.models.database import get_celery_db
+from src.models.models import Index as IndexModel
 from ib_insync import Index, IB
+import os
 import time
 import signal
 import sys
+import numpy as np
 from logging_config import logger
 
+# The broker owns a dedicated clientId outside of the range leased to the workers
+BROKER_CLIENT_ID = int(os.getenv("IB_BROKER_CLIENT_ID", 1))
+HEARTBEAT_SECONDS = 10
+STATS_EVERY = 30  # heartbeats
+SYNC_SECONDS = 0.5  # How often the requested market data subscriptions are synced
+SPX_STREAM_TASK = "src.tasks.market_reader_tasks.on_spx_bar"
+# The SPX bar sizes built locally from the streamed 1 min bars, the 5 min ones drive the entries
+SPX_ROLL_UP = {
+    5: "SPX_TRADE_5",
+    15: "SPX_TRADE_15",
+    30: "SPX_TRADE_30",
+    60: "SPX_TRADE_60",
+    aggregation_service.DAILY: "SPX_TRADE_D",
+}
+
 def signal_handler(signum, frame):
     logger.info("Received shutdown signal, cleaning up...")
     sys.exit(0)
@@ -12,22 +38,75 @@ def signal_handler(signum, frame):
 signal.signal(signal.SIGTERM, signal_handler)
 signal.signal(signal.SIGINT, signal_handler)
 
+def log_pool_stats():
+    leases = list(cache.r.scan_iter(f"{ibapi_service.LEASE_KEY}:*"))
+    latencies = ibapi_service.get_acquire_latencies()
+
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99])
+        logger.warning(
+            f"IB pool: {len(leases)} leased clientIds, acquire latency p50 {p50:.1f} ms / p99 {p99:.1f} ms"
+        )
+    else:
+        logger.warning(f"IB pool: {len(leases)} leased clientIds")
+
 def main():
-    ib = IB()
-    
+    heartbeats = 0
+    metrics_service.start_metrics_server(
+        int(os.getenv("BROKER_METRICS_PORT", metrics_service.METRICS_PORT + 1))
+    )
+
     while True:
         try:
-            with connect_to_ib() as ib:
+            with ibapi_service.connect_to_ib(clientId=BROKER_CLIENT_ID) as ib:
                 logger.info("IB Connection established")
-                
-                # Keep connection alive with market data request
+
+                # Keep connection alive with market data request, SPX is always streamed
                 spx = Index('SPX', 'CBOE', 'USD')
                 ib.qualifyContracts(spx)
-                ticker = ib.reqMktData(spx)
-                
-                # Run the event loop
-                ib.run()
-                
+                market_data_service.request_subscription(spx)
+
+                # The SPX bars are streamed instead of polled, one 1 min stream feeds every bar size
+                with get_celery_db() as db:
+                    spx_row = db.query(IndexModel).filter(IndexModel.symbol == "SPX").first()
+                if spx_row:
+                    # Replaced by the 1 min stream, the 5 min bars are rolled up from it
+                    streaming_service.cancel_stream(spx.conId, "TRADES", 5)
+                    streaming_service.request_stream(
+                        spx,
+                        spx_row.id,
+                        "Index",
+                        "TRADES",
+                        1,
+                        "SPX_TRADE_1",
+                        SPX_STREAM_TASK,
+                        roll_up=SPX_ROLL_UP,
+                    )
+
+                last_heartbeat = 0
+
+                while ib.isConnected():
+                    # One streaming subscription per requested contract, published to Redis
+                    market_data_service.sync_subscriptions(ib)
+                    streaming_service.sync_streams(ib)
+                    ib.sleep(SYNC_SECONDS)
+
+                    if time.time() - last_heartbeat < HEARTBEAT_SECONDS:
+                        continue
+                    last_heartbeat = time.time()
+
+                    # Leases of dead workers are freed here so their clientIds can be reused
+                    reaped = ibapi_service.reap_stale_leases()
+                    if reaped:
+                        logger.warning(f"Released {reaped} stale IB clientId leases")
+
+                    cache.set("ib_gateway_up", 1, HEARTBEAT_SECONDS * 3)
+                    market_data_service.request_subscription(spx)
+
+                    if heartbeats % STATS_EVERY == 0:
+                        log_pool_stats()
+                    heartbeats += 1
+
         except Exception as e:
             logger.error(f"Error in IB connection: {str(e)}")
             time.sleep(5)  # Wait before retrying
@@ -0,0 +1,29 @@
+from src.services import ibapi_service, ib_simulator
+from ib_insync import Index
+import argparse
+from dotenv import load_dotenv
+load_dotenv()
+
+# Records SPX bars, its option chains and the BID/ASK/TRADES bars of the 0DTE option
+# ladder from the live gateway so they can be replayed offline with IB_BACKEND=simulator
+parser = argparse.ArgumentParser()
+parser.add_argument("path", help="Recording directory, e.g. recordings/latest")
+parser.add_argument("--duration", default="1 D")
+parser.add_argument("--end", default="", help="endDateTime, e.g. '20241017 16:00:00 US/Eastern'")
+parser.add_argument("--spread", type=float, default=150, help="Strikes recorded around SPX's range")
+args = parser.parse_args()
+
+print("Connecting to IB Gateway...")
+with ibapi_service.connect_to_ib() as ib:
+    ib_simulator.record_session(
+        ib,
+        args.path,
+        [Index('SPX', 'CBOE', 'USD')],
+        ["TRADES"],
+        durationStr=args.duration,
+        endDateTime=args.end,
+        option_whatToShow=["BID", "ASK", "TRADES"],
+        spread_around_spot=args.spread,
+    )
+
+print(f"Session recorded in {args.path}")
@@ -0,0 +1,139 @@
+"""Partition price_bars by month
+
+Revision ID: 17a551cf5922
+Revises: 481a4a76d2ef
+Create Date: 2026-10-18 16:48:52.204617
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '17a551cf5922'
+down_revision: Union[str, None] = '481a4a76d2ef'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+COLUMNS = (
+    'id, date, open, high, low, close, volume, bar_size, data_type, trend, '
+    'contract_id, created_at, updated_at'
+)
+MONTHS_AHEAD = 3
+
+# Creates the partition holding the month of the given date, used by partition_service
+# too. Bounds are UTC months.
+ENSURE_PARTITION = """
+CREATE OR REPLACE FUNCTION price_bars_ensure_partition(month date) RETURNS text AS $$
+DECLARE
+    month_start date := date_trunc('month', month);
+    partition_name text := 'price_bars_' || to_char(month_start, '"y"YYYY"m"MM');
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF price_bars FOR VALUES FROM (%L) TO (%L)',
+            partition_name,
+            month_start::timestamp AT TIME ZONE 'UTC',
+            (month_start + interval '1 month')::timestamp AT TIME ZONE 'UTC'
+        );
+    END IF;
+
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def upgrade() -> None:
+    op.execute('ALTER TABLE price_bars RENAME TO price_bars_unpartitioned')
+    op.execute('ALTER INDEX price_bars_pkey RENAME TO price_bars_unpartitioned_pkey')
+    op.execute('ALTER INDEX uq_price_bars_series_date RENAME TO uq_price_bars_unpartitioned_series_date')
+    # The id sequence moves to the new table
+    op.execute('ALTER SEQUENCE price_bars_id_seq OWNED BY NONE')
+
+    op.execute(
+        """
+        CREATE TABLE price_bars (
+            id INTEGER NOT NULL DEFAULT nextval('price_bars_id_seq'),
+            date TIMESTAMP WITH TIME ZONE NOT NULL,
+            open FLOAT NOT NULL,
+            high FLOAT NOT NULL,
+            low FLOAT NOT NULL,
+            close FLOAT NOT NULL,
+            volume BIGINT NOT NULL,
+            bar_size INTEGER NOT NULL,
+            data_type VARCHAR NOT NULL,
+            trend INTEGER,
+            contract_id INTEGER NOT NULL REFERENCES contracts (id),
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, date)
+        ) PARTITION BY RANGE (date)
+        """
+    )
+    op.execute('ALTER SEQUENCE price_bars_id_seq OWNED BY price_bars.id')
+    op.execute(ENSURE_PARTITION)
+
+    # One partition per month from the first stored bar to a few months ahead
+    op.execute(
+        f"""
+        SELECT price_bars_ensure_partition(month::date)
+        FROM generate_series(
+            date_trunc('month', COALESCE((SELECT min(date) FROM price_bars_unpartitioned), now())),
+            date_trunc('month', now()) + interval '{MONTHS_AHEAD} months',
+            interval '1 month'
+        ) AS month
+        """
+    )
+    # Created on the parent, the index is created on every partition
+    op.create_index(
+        'uq_price_bars_series_date',
+        'price_bars',
+        ['contract_id', 'data_type', 'bar_size', 'date'],
+        unique=True,
+        postgresql_include=['open', 'high', 'low', 'close', 'volume'],
+    )
+
+    op.execute(f'INSERT INTO price_bars ({COLUMNS}) SELECT {COLUMNS} FROM price_bars_unpartitioned')
+    op.execute('DROP TABLE price_bars_unpartitioned')
+
+
+def downgrade() -> None:
+    op.execute('ALTER TABLE price_bars RENAME TO price_bars_partitioned')
+    op.execute('ALTER INDEX uq_price_bars_series_date RENAME TO uq_price_bars_partitioned_series_date')
+    op.execute('ALTER SEQUENCE price_bars_id_seq OWNED BY NONE')
+
+    op.execute(
+        """
+        CREATE TABLE price_bars (
+            id INTEGER NOT NULL DEFAULT nextval('price_bars_id_seq'),
+            date TIMESTAMP WITH TIME ZONE NOT NULL,
+            open FLOAT NOT NULL,
+            high FLOAT NOT NULL,
+            low FLOAT NOT NULL,
+            close FLOAT NOT NULL,
+            volume BIGINT NOT NULL,
+            bar_size INTEGER NOT NULL,
+            data_type VARCHAR NOT NULL,
+            trend INTEGER,
+            contract_id INTEGER NOT NULL REFERENCES contracts (id),
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            CONSTRAINT price_bars_pkey PRIMARY KEY (id)
+        )
+        """
+    )
+    op.execute('ALTER SEQUENCE price_bars_id_seq OWNED BY price_bars.id')
+    op.create_index(
+        'uq_price_bars_series_date',
+        'price_bars',
+        ['contract_id', 'data_type', 'bar_size', 'date'],
+        unique=True,
+        postgresql_include=['open', 'high', 'low', 'close', 'volume'],
+    )
+
+    op.execute(f'INSERT INTO price_bars ({COLUMNS}) SELECT {COLUMNS} FROM price_bars_partitioned')
+    op.execute('DROP TABLE price_bars_partitioned')
+    op.execute('DROP FUNCTION price_bars_ensure_partition(date)')
@@ -0,0 +1,42 @@
+"""Covering index for price bar reads
+
+Revision ID: 481a4a76d2ef
+Revises: b8ad0af2c383
+Create Date: 2026-10-18 15:26:08.734112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '481a4a76d2ef'
+down_revision: Union[str, None] = 'b8ad0af2c383'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SERIES_DATE = ['contract_id', 'data_type', 'bar_size', 'date']
+OHLCV = ['open', 'high', 'low', 'close', 'volume']
+
+
+def upgrade() -> None:
+    # The unique key becomes a covering index: the hot queries (last bar, bars of a
+    # series by date, day high/low) are served by index-only scans. It is built
+    # before the constraint is dropped so the upserts always have their key.
+    op.create_index(
+        'ix_price_bars_series_date_ohlcv',
+        'price_bars',
+        SERIES_DATE,
+        unique=True,
+        postgresql_include=OHLCV,
+    )
+    op.drop_constraint('uq_price_bars_series_date', 'price_bars', type_='unique')
+    op.execute('ALTER INDEX ix_price_bars_series_date_ohlcv RENAME TO uq_price_bars_series_date')
+
+
+def downgrade() -> None:
+    op.execute('ALTER INDEX uq_price_bars_series_date RENAME TO ix_price_bars_series_date_ohlcv')
+    op.create_unique_constraint('uq_price_bars_series_date', 'price_bars', SERIES_DATE)
+    op.drop_index('ix_price_bars_series_date_ohlcv', table_name='price_bars')
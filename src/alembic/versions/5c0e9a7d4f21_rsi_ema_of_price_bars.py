@@ -0,0 +1,28 @@
+"""RSI EMA of price bars
+
+Revision ID: 5c0e9a7d4f21
+Revises: 17a551cf5922
+Create Date: 2026-10-18 21:37:05.118342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5c0e9a7d4f21'
+down_revision: Union[str, None] = '17a551cf5922'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Written by get_trend next to the trend, a nullable column without default is only
+    # added to the catalog, the partitions are not rewritten
+    op.add_column('price_bars', sa.Column('rsi_ema', sa.Float(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('price_bars', 'rsi_ema')
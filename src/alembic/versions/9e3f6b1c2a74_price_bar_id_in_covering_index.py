@@ -0,0 +1,44 @@
+"""Price bar id in the covering index
+
+Revision ID: 9e3f6b1c2a74
+Revises: 5c0e9a7d4f21
+Create Date: 2026-10-18 23:12:41.503218
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9e3f6b1c2a74'
+down_revision: Union[str, None] = '5c0e9a7d4f21'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SERIES_DATE = ['contract_id', 'data_type', 'bar_size', 'date']
+OHLCV = ['open', 'high', 'low', 'close', 'volume']
+
+
+def _replace_index(include) -> None:
+    # Built before the old one is dropped so the upserts always have their key. Created
+    # on the parent, the index is created on every partition.
+    op.create_index(
+        'ix_price_bars_series_date_ohlcv',
+        'price_bars',
+        SERIES_DATE,
+        unique=True,
+        postgresql_include=include,
+    )
+    op.drop_index('uq_price_bars_series_date', table_name='price_bars')
+    op.execute('ALTER INDEX ix_price_bars_series_date_ohlcv RENAME TO uq_price_bars_series_date')
+
+
+def upgrade() -> None:
+    # The bar reads of the API select the id too, they are only index-only scans with it
+    _replace_index(['id'] + OHLCV)
+
+
+def downgrade() -> None:
+    _replace_index(OHLCV)
@@ -0,0 +1,42 @@
+"""Unique price bar per series and date
+
+Revision ID: b8ad0af2c383
+Revises: 3674946879d0
+Create Date: 2026-10-18 14:03:27.518904
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8ad0af2c383'
+down_revision: Union[str, None] = '3674946879d0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Duplicates written before the key existed, the first stored bar is kept
+    op.execute(
+        """
+        DELETE FROM price_bars a
+        USING price_bars b
+        WHERE a.contract_id = b.contract_id
+          AND a.data_type = b.data_type
+          AND a.bar_size = b.bar_size
+          AND a.date = b.date
+          AND a.id > b.id
+        """
+    )
+    op.create_unique_constraint(
+        'uq_price_bars_series_date',
+        'price_bars',
+        ['contract_id', 'data_type', 'bar_size', 'date'],
+    )
+
+
+def downgrade() -> None:
+    op.drop_constraint('uq_price_bars_series_date', 'price_bars', type_='unique')
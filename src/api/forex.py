@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Query
 from fastapi.responses import Response
 from models import schemas, models
-from models.database import get_db
+from models.database import get_db, get_read_db
 from sqlalchemy.orm import Session
-from services import prices_service, contracts_service
-from typing import List
+from services import bar_format_service, prices_service, contracts_service
+from typing import List, Optional
+from datetime import datetime
 
 # Create an API router for handling Forex-related requests
 router = APIRouter()
@@ -12,7 +13,7 @@ router = APIRouter()
 
 # Get a list of Forex contracts from the database
 @router.get("/", response_model=List[schemas.Contract])
-def get_forex(db: Session = Depends(get_db)):
+def get_forex(db: Session = Depends(get_read_db)):
     # Retrieve any contracts classified as "Forex" from the database
     return contracts_service.get_any_contracts(db, "Forex")
 
@@ -71,7 +72,18 @@ def get_forex_prices_by_symbol(
     limit: int = Query(
         500, description="Number of bars to return"
     ),  # Limit the number of bars to return
-    db: Session = Depends(get_db),
+    start: Optional[datetime] = Query(
+        None, description="Only the bars at or after this date"
+    ),
+    end: Optional[datetime] = Query(None, description="Only the bars before this date"),
+    after: Optional[datetime] = Query(
+        None, description="Date of the last bar of the previous page, to get the next one"
+    ),
+    accept: Optional[str] = Header(
+        None, description="application/json, or for large reads application/x-ndjson, "
+        "application/vnd.apache.arrow.stream or application/vnd.htb.columns+json"
+    ),
+    db: Session = Depends(get_read_db),
 ):
     # Retrieve the Forex contract by its symbol
     forex = contracts_service.get_contract_by_symbol(db, symbol, "Forex")
@@ -80,10 +92,42 @@ def get_forex_prices_by_symbol(
     if forex is None:
         raise HTTPException(status_code=404, detail="Forex not found")
 
+    # Streamed or columnar formats skip the pydantic models
+    media_type = bar_format_service.negotiate(accept)
+    if media_type != bar_format_service.JSON:
+        return bar_format_service.bars_response(
+            db, media_type, forex.id, data_type, bar_size, order, limit, start, end, after
+        )
+
     # Get price bars (historical data) from the database based on the Forex contract ID and query parameters
     bars = prices_service.get_price_bars_from_db(
-        db, forex.id, data_type, bar_size, order, limit
+        db, forex.id, data_type, bar_size, order, limit, start, end, after
     )
 
     # Return the list of price bars
     return bars
+
+
+# Compute indicators (EMA, RSI, ATR, VWAP, Bollinger bands...) over the last bars of a Forex symbol
+@router.get("/{symbol}/indicators")
+def get_forex_indicators_by_symbol(
+    symbol: str,
+    data_type: str = Query(..., description="Data type e.g., ASK, BID, TRADES"),
+    bar_size: int = Query(..., description="Bar size in minutes"),
+    names: Optional[List[str]] = Query(
+        None, description="Indicators e.g., ema_20, rsi_14, vwap, all of them by default"
+    ),
+    limit: int = Query(500, description="Number of bars to return"),
+    db: Session = Depends(get_read_db),
+):
+    # Retrieve the Forex contract by its symbol
+    forex = contracts_service.get_contract_by_symbol(db, symbol, "Forex")
+
+    # If the contract is not found, raise a 404 error
+    if forex is None:
+        raise HTTPException(status_code=404, detail="Forex not found")
+
+    # One column per indicator, computed together over the bars read once
+    return bar_format_service.indicators_response(
+        db, forex.id, data_type, bar_size, names, limit
+    )
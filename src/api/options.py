@@ -1,9 +1,10 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Query
 from models import schemas
-from models.database import get_db
+from models.database import get_read_db
 from sqlalchemy.orm import Session
-from services import prices_service, options_service
-from typing import List
+from services import bar_format_service, prices_service, options_service
+from typing import List, Optional
+from datetime import datetime
 
 # Create an API router for handling Options-related requests
 router = APIRouter()
@@ -13,7 +14,7 @@ router = APIRouter()
 @router.get("/{symbol}", response_model=List[str])
 def get_options_expiration_dates(
     symbol: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     # Retrieve expiration dates for the options of a given symbol from the database
     expiration_dates = options_service.get_option_expiration_dates(db, symbol)
@@ -26,7 +27,7 @@ def get_options_expiration_dates(
 def get_options_strikes(
     symbol: str,
     expiration_date: str,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
 ):
     # Retrieve the strike prices for the given symbol and expiration date
     strikes = options_service.get_options_strikes(db, symbol, expiration_date)
@@ -60,7 +61,18 @@ def get_options_prices_by_symbol(
     limit: int = Query(
         500, description="Number of bars to return"
     ),  # Limit the number of price bars returned
-    db: Session = Depends(get_db),
+    start: Optional[datetime] = Query(
+        None, description="Only the bars at or after this date"
+    ),
+    end: Optional[datetime] = Query(None, description="Only the bars before this date"),
+    after: Optional[datetime] = Query(
+        None, description="Date of the last bar of the previous page, to get the next one"
+    ),
+    accept: Optional[str] = Header(
+        None, description="application/json, or for large reads application/x-ndjson, "
+        "application/vnd.apache.arrow.stream or application/vnd.htb.columns+json"
+    ),
+    db: Session = Depends(get_read_db),
 ):
     # Retrieve the option contract based on the provided symbol, expiration date, strike price, and option right
     contract = options_service.get_option_contract_db(
@@ -71,9 +83,46 @@ def get_options_prices_by_symbol(
     if contract is None:
         raise HTTPException(status_code=404, detail="Option contract not found")
 
+    # Streamed or columnar formats skip the pydantic models
+    media_type = bar_format_service.negotiate(accept)
+    if media_type != bar_format_service.JSON:
+        return bar_format_service.bars_response(
+            db, media_type, contract.id, data_type, bar_size, order, limit, start, end, after
+        )
+
     # Retrieve price bars (historical data) from the database for the option contract
     bars = prices_service.get_price_bars_from_db(
-        db, contract.id, data_type, bar_size, order, limit
+        db, contract.id, data_type, bar_size, order, limit, start, end, after
     )
 
     return bars
+
+
+# Compute indicators (EMA, RSI, ATR, VWAP, Bollinger bands...) over the last bars of an option contract
+@router.get("/{symbol}/{expiration_date}/indicators")
+def get_options_indicators_by_symbol(
+    symbol: str,
+    expiration_date: str,
+    strike: float = Query(..., description="Strike price"),
+    right: str = Query(..., description="Right e.g., CALL, PUT"),
+    data_type: str = Query(..., description="Data type e.g., ASK, BID, TRADES"),
+    bar_size: int = Query(..., description="Bar size in minutes"),
+    names: Optional[List[str]] = Query(
+        None, description="Indicators e.g., ema_20, rsi_14, vwap, all of them by default"
+    ),
+    limit: int = Query(500, description="Number of bars to return"),
+    db: Session = Depends(get_read_db),
+):
+    # Retrieve the option contract based on the provided symbol, expiration date, strike price, and option right
+    contract = options_service.get_option_contract_db(
+        db, symbol, expiration_date, strike, right
+    )
+
+    # If the contract is not found, raise a 404 error
+    if contract is None:
+        raise HTTPException(status_code=404, detail="Option contract not found")
+
+    # One column per indicator, computed together over the bars read once
+    return bar_format_service.indicators_response(
+        db, contract.id, data_type, bar_size, names, limit
+    )
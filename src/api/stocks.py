@@ -1,11 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, HTTPException, Header, Query
 from fastapi.responses import Response
 from models import schemas
-from models.database import get_db
+from models.database import get_db, get_read_db
 from sqlalchemy.orm import Session
-from services import contracts_service, prices_service
+from services import bar_format_service, contracts_service, prices_service
 from tasks import stocks_tasks  # Celery tasks for asynchronous processing
-from typing import List
+from typing import List, Optional
+from datetime import datetime
 
 # Create an API router for handling stock-related requests
 router = APIRouter()
@@ -13,7 +14,7 @@ router = APIRouter()
 
 # Get a list of all Stock contracts from the database
 @router.get("/", response_model=List[schemas.Contract])
-def get_stocks(db: Session = Depends(get_db)):
+def get_stocks(db: Session = Depends(get_read_db)):
     # Retrieve any contracts classified as "Stock" from the database
     stocks = contracts_service.get_any_contracts(db, "Stock")
     return stocks
@@ -51,7 +52,18 @@ def get_stock_prices_by_symbol(
     limit: int = Query(
         500, description="Number of bars to return"
     ),  # Limit on the number of price bars
-    db: Session = Depends(get_db),
+    start: Optional[datetime] = Query(
+        None, description="Only the bars at or after this date"
+    ),
+    end: Optional[datetime] = Query(None, description="Only the bars before this date"),
+    after: Optional[datetime] = Query(
+        None, description="Date of the last bar of the previous page, to get the next one"
+    ),
+    accept: Optional[str] = Header(
+        None, description="application/json, or for large reads application/x-ndjson, "
+        "application/vnd.apache.arrow.stream or application/vnd.htb.columns+json"
+    ),
+    db: Session = Depends(get_read_db),
 ):
     # Retrieve the Stock contract by its symbol
     stock = contracts_service.get_contract_by_symbol(db, symbol, "Stock")
@@ -60,10 +72,42 @@ def get_stock_prices_by_symbol(
     if stock is None:
         raise HTTPException(status_code=404, detail="Stock not found")
 
+    # Streamed or columnar formats skip the pydantic models
+    media_type = bar_format_service.negotiate(accept)
+    if media_type != bar_format_service.JSON:
+        return bar_format_service.bars_response(
+            db, media_type, stock.id, data_type, bar_size, order, limit, start, end, after
+        )
+
     # Retrieve price bars (historical data) from the database for the stock contract
     bars = prices_service.get_price_bars_from_db(
-        db, stock.id, data_type, bar_size, order, limit
+        db, stock.id, data_type, bar_size, order, limit, start, end, after
     )
 
     # Return the list of price bars
     return bars
+
+
+# Compute indicators (EMA, RSI, ATR, VWAP, Bollinger bands...) over the last bars of a Stock symbol
+@router.get("/{symbol}/indicators")
+def get_stock_indicators_by_symbol(
+    symbol: str,
+    data_type: str = Query(..., description="Data type e.g., ASK, BID, TRADES"),
+    bar_size: int = Query(..., description="Bar size in minutes"),
+    names: Optional[List[str]] = Query(
+        None, description="Indicators e.g., ema_20, rsi_14, vwap, all of them by default"
+    ),
+    limit: int = Query(500, description="Number of bars to return"),
+    db: Session = Depends(get_read_db),
+):
+    # Retrieve the Stock contract by its symbol
+    stock = contracts_service.get_contract_by_symbol(db, symbol, "Stock")
+
+    # If the contract is not found, raise a 404 error
+    if stock is None:
+        raise HTTPException(status_code=404, detail="Stock not found")
+
+    # One column per indicator, computed together over the bars read once
+    return bar_format_service.indicators_response(
+        db, stock.id, data_type, bar_size, names, limit
+    )
@@ -1,4 +1,5 @@
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown
 import os
 from datetime import datetime
 from src.tasks import celeryconfig
@@ -27,6 +28,24 @@ celery_app.autodiscover_tasks(
         "src.tasks.stocks_tasks",
         "src.tasks.trend_tasks",
         "src.tasks.economic_data_tasks",
+        "src.tasks.maintenance_tasks",
     ],
     force=True,
 )
+
+
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    # Served by the main worker process, the children write to PROMETHEUS_MULTIPROC_DIR
+    from src.services import metrics_service
+
+    metrics_service.start_metrics_server()
+
+
+@worker_process_shutdown.connect
+def close_ib_connections(pid=None, **kwargs):
+    # Pooled IB connections are kept open between tasks, we close them with the process
+    from src.services import ibapi_service, metrics_service
+
+    ibapi_service.close_pool()
+    metrics_service.mark_process_dead(pid or os.getpid())
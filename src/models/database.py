@@ -9,37 +9,75 @@ DB_USER = os.getenv("DB_USER", "michaelrobinson")
 DB_PASS = os.getenv("DB_PASS", "postgres")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_NAME = os.getenv("DB_NAME", "algo")
+# Replica serving the read-only sessions, e.g. "replica:5432". Without one they get a pool
+# of their own on the primary, long reads never take the connections of the trading path.
+DB_READ_HOST = os.getenv("DB_READ_HOST") or DB_HOST
 
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
+SQLALCHEMY_READ_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_READ_HOST}/{DB_NAME}"
 
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     poolclass=QueuePool,  # Manage pool size and overflow
-    pool_size=10,  # Connection pool size
-    max_overflow=5,  # Number of connections to allow in overflow state
+    pool_size=int(os.getenv("DB_POOL_SIZE", 10)),  # Connection pool size
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 5)),  # Number of connections to allow in overflow state
     pool_timeout=30,  # Timeout for getting connection from the pool
     pool_recycle=1800,  # Recycle connections after 30 minutes
 )
 
+# API and analytics reads
+read_engine = create_engine(
+    SQLALCHEMY_READ_DATABASE_URL,
+    poolclass=QueuePool,
+    pool_size=int(os.getenv("DB_READ_POOL_SIZE", 5)),
+    max_overflow=int(os.getenv("DB_READ_MAX_OVERFLOW", 5)),
+    pool_timeout=30,
+    pool_recycle=1800,
+    # A write through a read session fails instead of silently landing on the primary
+    execution_options={"postgresql_readonly": True},
+)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
 
 
+@contextmanager
+def _session(session_factory: sessionmaker):
+    db = session_factory()
+    try:
+        yield db
+    except:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
 # Dependency
 def get_db():
     with get_celery_db() as db:
         yield db
 
 
+# Dependency of the endpoints that only read, they may lag the primary when on a replica
+def get_read_db():
+    with get_read_celery_db() as db:
+        yield db
+
+
 @contextmanager
 def get_celery_db():
-    db = SessionLocal()
-    try:
+    with _session(SessionLocal) as db:
+        yield db
+
+
+@contextmanager
+def get_read_celery_db():
+    """
+    Session for analytics reads, never for the trading path which must see its own writes.
+    """
+    with _session(ReadSessionLocal) as db:
         yield db
-    except:
-        db.rollback()
-        raise
-    finally:
-        db.close()
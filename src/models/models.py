@@ -11,6 +11,7 @@ from sqlalchemy import (
     Enum,
     JSON,
 )
+from sqlalchemy import Index as TableIndex  # Index is the contract model below
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
@@ -32,6 +33,12 @@ class BaseContract(Base):
     currency: Mapped[str] = mapped_column(String, default="USD")
     contract_type: Mapped[str] = mapped_column(String)  # polymorphic column
 
+    # Filled by the first qualification, so IB contracts can be built without a round-trip
+    conId: Mapped[int | None] = mapped_column(Integer, unique=True, nullable=True)
+    tradingClass: Mapped[str | None] = mapped_column(String, nullable=True)
+    multiplier: Mapped[str | None] = mapped_column(String, nullable=True)
+    localSymbol: Mapped[str | None] = mapped_column(String, nullable=True)
+
     to_trade: Mapped[bool | None] = mapped_column(Boolean, default=True, nullable=True)
 
     created_at: Mapped[datetime] = mapped_column(DateTime, default=func.now())
@@ -45,8 +52,6 @@ class BaseContract(Base):
 class Stock(BaseContract):
     # __tablename__ = "stocks"
 
-    conId: Mapped[int | None] = mapped_column(Integer, unique=True, nullable=True)
-
     spread_around_spot: Mapped[float | None] = mapped_column(
         Float, default=2, nullable=True
     )
@@ -103,9 +108,26 @@ class Forex(BaseContract):
 
 class PriceBar(Base):
     __tablename__ = "price_bars"
+    __table_args__ = (
+        # One bar per series and date, bars are upserted on this key. Every hot query
+        # filters on the series and orders by date, the id and OHLCV values are included
+        # so the bar reads are index-only scans.
+        TableIndex(
+            "uq_price_bars_series_date",
+            "contract_id",
+            "data_type",
+            "bar_size",
+            "date",
+            unique=True,
+            postgresql_include=["id", "open", "high", "low", "close", "volume"],
+        ),
+        # Monthly range partitions on date, managed by partition_service
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
 
+    # The partition key has to be part of the primary key
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    date: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    date: Mapped[datetime] = mapped_column(DateTime(timezone=True), primary_key=True)
     open: Mapped[float] = mapped_column(Float)
     high: Mapped[float] = mapped_column(Float)
     low: Mapped[float] = mapped_column(Float)
@@ -115,6 +137,7 @@ class PriceBar(Base):
 
     data_type: Mapped[str] = mapped_column(String)
     trend: Mapped[int | None] = mapped_column(Integer, nullable=True, default=None)
+    rsi_ema: Mapped[float | None] = mapped_column(Float, nullable=True, default=None)
 
     contract_id: Mapped[int] = mapped_column(ForeignKey("contracts.id"))
     contract: Mapped[BaseContract] = relationship(
@@ -0,0 +1,252 @@
+from sqlalchemy.orm import Session
+from datetime import datetime, time, timedelta
+from typing import Dict, List, Optional, Tuple
+from ib_insync import BarData
+from pytz import timezone
+import numpy as np
+import pytz
+from src.services import calendar_service, prices_service
+
+# Bar sizes are in minutes, a daily bar is a whole regular session
+DAILY = 24 * 60
+# Bar sizes built from the stored 1 min bars instead of being requested from IB
+ROLLUP_BAR_SIZES = (5, 15, 30, 60, DAILY)
+SOURCE_BAR_SIZE = 1
+
+NY_TZ = timezone("America/New_York")
+BAR_COLUMNS = ("open", "high", "low", "close", "volume")
+
+
+def _to_datetime64(value: datetime) -> np.datetime64:
+    # The sessions and the columns are naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+
+    return np.datetime64(value, "us")
+
+
+def _to_datetime(value: np.datetime64) -> datetime:
+    return value.astype("datetime64[us]").astype(datetime).replace(tzinfo=pytz.utc)
+
+
+def get_sessions(start: datetime, end: datetime) -> Tuple[np.ndarray, np.ndarray]:
+    return calendar_service.get_sessions(
+        start.astimezone(NY_TZ).date(), end.astimezone(NY_TZ).date()
+    )
+
+
+def bucket_dates(
+    dates: np.ndarray, bar_size: int, sessions: Tuple[np.ndarray, np.ndarray]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the bar of each date, bars start at the session open and end with the session.
+
+    :param dates: Naive UTC datetime64[us] dates, sorted.
+    :param sessions: The session opens and closes, from calendar_service.get_sessions.
+    :return: A mask of the dates inside a session, and the start and end of their bars.
+    """
+    opens, closes = sessions
+    session = np.searchsorted(opens, dates, side="right") - 1
+    in_session = session >= 0
+    in_session[in_session] &= dates[in_session] < closes[session[in_session]]
+
+    dates = dates[in_session]
+    opens = opens[session[in_session]]
+    closes = closes[session[in_session]]
+
+    if bar_size == DAILY:
+        return in_session, opens, closes
+
+    step = np.timedelta64(bar_size, "m")
+    starts = opens + (dates - opens) // step * step
+
+    # The last bar of an early close is cut short
+    return in_session, starts, np.minimum(starts + step, closes)
+
+
+def resample(
+    columns: Dict[str, np.ndarray],
+    bar_size: int,
+    sessions: Tuple[np.ndarray, np.ndarray],
+) -> Dict[str, np.ndarray]:
+    """
+    Aggregate smaller bars into bar_size bars aligned on the NYSE sessions.
+
+    The bars outside the regular sessions are left out.
+
+    :param columns: date (naive UTC datetime64[us], sorted), open, high, low, close and
+        volume arrays, as returned by prices_service.get_bar_columns.
+    :return: The same columns for the aggregated bars, plus their end.
+    """
+    in_session, starts, ends = bucket_dates(columns["date"], bar_size, sessions)
+
+    if not len(starts):
+        return {
+            "date": starts,
+            "end": ends,
+            **{column: columns[column][:0] for column in BAR_COLUMNS},
+        }
+
+    values = {column: columns[column][in_session] for column in BAR_COLUMNS}
+
+    # The dates are sorted, a bar is a run of the same start
+    first = np.flatnonzero(np.concatenate(([True], starts[1:] != starts[:-1])))
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+
+    return {
+        "date": starts[first],
+        "end": ends[first],
+        "open": values["open"][first],
+        "high": np.maximum.reduceat(values["high"], first),
+        "low": np.minimum.reduceat(values["low"], first),
+        "close": values["close"][last],
+        "volume": np.add.reduceat(values["volume"], first),
+    }
+
+
+def to_bars(columns: Dict[str, np.ndarray]) -> List[BarData]:
+    return [
+        BarData(
+            date=_to_datetime(columns["date"][i]),
+            open=float(columns["open"][i]),
+            high=float(columns["high"][i]),
+            low=float(columns["low"][i]),
+            close=float(columns["close"][i]),
+            volume=int(columns["volume"][i]),
+        )
+        for i in range(len(columns["date"]))
+    ]
+
+
+def roll_up(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    since: datetime,
+    bar_sizes: List[int] = ROLLUP_BAR_SIZES,
+) -> Dict[int, Tuple[Optional[BarData], Optional[BarData]]]:
+    """
+    Rebuild the bars of bar_sizes from the stored 1 min bars, from the session of `since`.
+
+    Only the sessions touched by new 1 min bars are read again. A stream runs it once when
+    it starts, then folds each new 1 min bar into the forming bars (fold). The closed bars
+    are written, the caller commits.
+
+    :param since: Date of the first new 1 min bar.
+    :return: The last closed bar and the bar still forming of each bar size, if any.
+    """
+    start = NY_TZ.localize(datetime.combine(since.astimezone(NY_TZ).date(), time.min))
+    columns = prices_service.get_bar_columns(
+        db, contract_id, data_type, SOURCE_BAR_SIZE, start=start
+    )
+    rolled_up = {bar_size: (None, None) for bar_size in bar_sizes}
+
+    if not len(columns["date"]):
+        return rolled_up
+
+    sessions = get_sessions(start, _to_datetime(columns["date"][-1]))
+    # The stored 1 min bars are closed, so is every bar ending with the last of them
+    covered_until = columns["date"][-1] + np.timedelta64(SOURCE_BAR_SIZE, "m")
+
+    for bar_size in bar_sizes:
+        bars = resample(columns, bar_size, sessions)
+        closed = bars["end"] <= covered_until
+
+        closed_bars = to_bars({column: values[closed] for column, values in bars.items()})
+        forming = to_bars({column: values[~closed] for column, values in bars.items()})
+
+        prices_service.upsert_price_bars(
+            db, closed_bars, data_type, contract_id, bar_size, update=True
+        )
+        rolled_up[bar_size] = (
+            closed_bars[-1] if closed_bars else None,
+            forming[-1] if forming else None,
+        )
+
+    return rolled_up
+
+
+def _bucket(bar: BarData, bar_size: int) -> Optional[Tuple[datetime, datetime]]:
+    # Start and end of the bar_size bar of a 1 min bar, None outside a session
+    in_session, starts, ends = bucket_dates(
+        np.array([_to_datetime64(bar.date)]), bar_size, get_sessions(bar.date, bar.date)
+    )
+
+    if not in_session[0]:
+        return None
+
+    return _to_datetime(starts[0]), _to_datetime(ends[0])
+
+
+def _merge(aggregate: Optional[BarData], bar: BarData, start: datetime) -> BarData:
+    if aggregate is None or aggregate.date != start:
+        # The 1 min bar opens a new bar
+        return BarData(
+            date=start,
+            open=bar.open,
+            high=bar.high,
+            low=bar.low,
+            close=bar.close,
+            volume=bar.volume,
+        )
+
+    return BarData(
+        date=start,
+        open=aggregate.open,
+        high=max(aggregate.high, bar.high),
+        low=min(aggregate.low, bar.low),
+        close=bar.close,
+        volume=aggregate.volume + bar.volume,
+    )
+
+
+def merge_forming(
+    aggregate: Optional[BarData], bar: BarData, bar_size: int
+) -> Optional[BarData]:
+    """
+    Add the forming 1 min bar to the forming bar_size bar built from the closed ones.
+
+    :param aggregate: The forming bar returned by roll_up or fold, if any.
+    :return: The forming bar_size bar, the aggregate as is when the 1 min bar is outside
+        a session.
+    """
+    bucket = _bucket(bar, bar_size)
+    if bucket is None:
+        return aggregate
+
+    return _merge(aggregate, bar, bucket[0])
+
+
+def fold(
+    forming: Dict[int, Optional[BarData]], bar: BarData
+) -> Tuple[Dict[int, List[BarData]], Dict[int, Optional[BarData]]]:
+    """
+    Fold a closed 1 min bar into the forming bars of each bar size, without reading the
+    stored bars again.
+
+    :param forming: The forming bar of each bar size, from roll_up or the previous fold.
+    :return: The bars closed by the 1 min bar and the forming bars after it.
+    """
+    closed = {bar_size: [] for bar_size in forming}
+    forming = dict(forming)
+    bar_end = _to_datetime(_to_datetime64(bar.date)) + timedelta(minutes=SOURCE_BAR_SIZE)
+
+    for bar_size, aggregate in forming.items():
+        bucket = _bucket(bar, bar_size)
+        if bucket is None:
+            continue
+        start, end = bucket
+
+        if aggregate is not None and aggregate.date != start:
+            # Its last 1 min bars never came, the bar ended anyway
+            closed[bar_size].append(aggregate)
+
+        aggregate = _merge(aggregate, bar, start)
+
+        if bar_end >= end:
+            closed[bar_size].append(aggregate)
+            aggregate = None
+
+        forming[bar_size] = aggregate
+
+    return closed, forming
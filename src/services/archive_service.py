@@ -0,0 +1,265 @@
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional
+from pytz import timezone
+import pytz
+import json
+import os
+import polars as pl
+from src.logging_config import logger
+from src.models.models import PriceBar
+
+# Closed days are exported to uncompressed Arrow IPC files, one per series and month:
+# {ARCHIVE_DIR}/{contract_id}/{data_type}/{bar_size}/{YYYY-MM}.arrow
+# Uncompressed IPC is memory-mapped on read, the columns are not copied or decoded.
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+WATERMARK_FILE = "archived_until.json"
+ARCHIVE_SCHEMA = {
+    "date": pl.Datetime("us", "UTC"),
+    "open": pl.Float64,
+    "high": pl.Float64,
+    "low": pl.Float64,
+    "close": pl.Float64,
+    "volume": pl.Int64,
+}
+
+NY_TZ = timezone("America/New_York")
+
+
+def series_dir(contract_id: int, data_type: str, bar_size: int) -> str:
+    return os.path.join(ARCHIVE_DIR, str(contract_id), data_type, str(bar_size))
+
+
+def month_path(contract_id: int, data_type: str, bar_size: int, day: date) -> str:
+    return os.path.join(
+        series_dir(contract_id, data_type, bar_size), f"{day.year:04d}-{day.month:02d}.arrow"
+    )
+
+
+def _utc(value: datetime) -> datetime:
+    # The archive dates are UTC, polars only compares dates of the same time zone
+    if value.tzinfo is None:
+        return value.replace(tzinfo=pytz.utc)
+
+    return value.astimezone(pytz.utc)
+
+
+def day_bounds(day: date):
+    # Days are New York trading days
+    start = NY_TZ.localize(datetime.combine(day, time.min))
+    return start, NY_TZ.localize(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def archived_until(contract_id: int, data_type: str, bar_size: int) -> Optional[datetime]:
+    """
+    :return: The end of the last archived day (exclusive), None when nothing is archived.
+    """
+    path = os.path.join(series_dir(contract_id, data_type, bar_size), WATERMARK_FILE)
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as file:
+        return day_bounds(date.fromisoformat(json.load(file)["day"]))[1]
+
+
+def _set_watermark(contract_id: int, data_type: str, bar_size: int, day: date):
+    path = os.path.join(series_dir(contract_id, data_type, bar_size), WATERMARK_FILE)
+
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({"day": day.isoformat()}, file)
+    os.replace(f"{path}.tmp", path)
+
+
+def _write_atomic(frame: pl.DataFrame, path: str):
+    # Readers keep the old file mapped, they never see a half written one
+    frame.write_ipc(f"{path}.tmp", compression="uncompressed")
+    os.replace(f"{path}.tmp", path)
+
+
+def export_day(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    day: date,
+    advance_watermark: bool = True,
+) -> int:
+    """
+    Export the bars of a closed day to the month file of its series.
+
+    :param advance_watermark: Mark the series archived up to this day, not when an
+        already archived day is exported again.
+    :return: The number of bars exported.
+    """
+    start, end = day_bounds(day)
+    rows = db.execute(
+        select(
+            PriceBar.date,
+            PriceBar.open,
+            PriceBar.high,
+            PriceBar.low,
+            PriceBar.close,
+            PriceBar.volume,
+        )
+        .where(
+            PriceBar.contract_id == contract_id,
+            PriceBar.data_type == data_type,
+            PriceBar.bar_size == bar_size,
+            PriceBar.date >= start,
+            PriceBar.date < end,
+        )
+        .order_by(PriceBar.date.asc())
+    ).all()
+
+    os.makedirs(series_dir(contract_id, data_type, bar_size), exist_ok=True)
+
+    if rows:
+        day_frame = pl.DataFrame(
+            [tuple(row) for row in rows],
+            schema=ARCHIVE_SCHEMA,
+            orient="row",
+        )
+        path = month_path(contract_id, data_type, bar_size, day)
+
+        if os.path.exists(path):
+            # Re-exporting a day replaces its bars stored in the db. The other archived
+            # bars of the day are kept, they may have been compacted out of the db.
+            month_frame = pl.read_ipc(path).join(day_frame.select("date"), on="date", how="anti")
+            day_frame = pl.concat([month_frame, day_frame]).sort("date")
+
+        _write_atomic(day_frame, path)
+
+    if advance_watermark:
+        _set_watermark(contract_id, data_type, bar_size, day)
+
+    return len(rows)
+
+
+def rearchive_days(
+    db: Session, contract_id: int, data_type: str, bar_size: int, start: datetime, end: datetime
+) -> int:
+    """
+    Export again the archived days of a series overlapping start-end, after bars were
+    written there. The days before the watermark are only read from the archive.
+
+    :return: The number of bars exported.
+    """
+    watermark = archived_until(contract_id, data_type, bar_size)
+    if watermark is None:
+        return 0
+
+    day = start.astimezone(NY_TZ).date()
+    exported = 0
+
+    while day_bounds(day)[0] < min(end, watermark):
+        exported += export_day(db, contract_id, data_type, bar_size, day, advance_watermark=False)
+        day += timedelta(days=1)
+
+    return exported
+
+
+def archive_series(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    until: date,
+    first_date: Optional[datetime] = None,
+) -> int:
+    """
+    Export the days of a series not archived yet, up to the day before `until`.
+
+    :param first_date: Date of the first bar of the series, read from the db when not given.
+    :return: The number of bars exported.
+    """
+    watermark = archived_until(contract_id, data_type, bar_size)
+
+    if watermark is None and first_date is None:
+        first_date = db.execute(
+            select(func.min(PriceBar.date)).where(
+                PriceBar.contract_id == contract_id,
+                PriceBar.data_type == data_type,
+                PriceBar.bar_size == bar_size,
+            )
+        ).scalar()
+
+        if first_date is None:
+            return 0
+
+    day = (watermark or first_date).astimezone(NY_TZ).date()
+    exported = 0
+
+    while day < until:
+        exported += export_day(db, contract_id, data_type, bar_size, day)
+        day += timedelta(days=1)
+
+    return exported
+
+
+def archive_closed_days(db: Session, until: date = None) -> int:
+    """
+    Export every series' closed days not archived yet, up to the day before `until`.
+
+    :return: The number of bars exported.
+    """
+    until = until or datetime.now(NY_TZ).date()
+    exported = 0
+
+    series = db.execute(
+        select(
+            PriceBar.contract_id,
+            PriceBar.data_type,
+            PriceBar.bar_size,
+            func.min(PriceBar.date),
+        ).group_by(PriceBar.contract_id, PriceBar.data_type, PriceBar.bar_size)
+    ).all()
+
+    for contract_id, data_type, bar_size, first_date in series:
+        exported += archive_series(db, contract_id, data_type, bar_size, until, first_date)
+
+    logger.info(f"Archived {exported} bars")
+
+    return exported
+
+
+def read_archive(
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> pl.DataFrame:
+    """
+    Read the archived bars of a series between start (inclusive) and end (exclusive).
+
+    Only the month files overlapping the range are mapped, and within a file the
+    columns are views on the mapped memory.
+    """
+    directory = series_dir(contract_id, data_type, bar_size)
+    paths: List[str] = []
+
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".arrow"):
+                continue
+
+            month = date.fromisoformat(f"{name[:7]}-01")
+            month_end = (month + timedelta(days=32)).replace(day=1)
+
+            if (start is None or day_bounds(month_end)[0] > start) and (
+                end is None or day_bounds(month)[0] < end
+            ):
+                paths.append(os.path.join(directory, name))
+
+    if not paths:
+        return pl.DataFrame(schema=ARCHIVE_SCHEMA)
+
+    bars = pl.scan_ipc(paths)
+    if start is not None:
+        bars = bars.filter(pl.col("date") >= _utc(start))
+    if end is not None:
+        bars = bars.filter(pl.col("date") < _utc(end))
+
+    return bars.collect()
@@ -0,0 +1,292 @@
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from ib_insync import IB, Contract
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional
+import json
+import os
+import numpy as np
+import pytz
+from src.logging_config import logger
+from src.models.models import PriceBar
+from src.services import (
+    aggregation_service,
+    archive_service,
+    cache,
+    calendar_service,
+    pacing_service,
+    prices_service,
+)
+
+# Days of history checked for holes by default
+BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", 30))
+# Longest duration IB serves in one request per bar size (minutes), from its
+# historical data limits
+MAX_REQUEST_DAYS = {1: 1, 2: 2, 3: 7, 5: 7, 10: 7, 15: 14, 20: 14, 30: 30, 60: 30}
+
+# Chunks still to fetch, per series, so an interrupted backfill resumes where it stopped
+PLAN_KEY = "backfill_plan"
+# Ranges already requested, the bars still missing there do not exist at IB (no trades,
+# halts) and are not requested again
+CHECKED_KEY = "backfill_checked"
+CHECKED_TTL = 60 * 60 * 24 * 30
+# IB may not serve the very last bars yet, a range this recent is requested again next time
+SETTLE_TIME = timedelta(hours=1)
+
+NY_TZ = pytz.timezone("America/New_York")
+
+
+class BackfillChunk(NamedTuple):
+    start: datetime  # First missing bar covered
+    end: datetime  # endDateTime of the request, after the last missing bar covered
+    durationStr: str
+
+    @property
+    def endDateTime(self) -> str:
+        # IB reads this format as UTC
+        return self.end.astimezone(pytz.utc).strftime("%Y%m%d-%H:%M:%S")
+
+
+def series_key(contract_id: int, data_type: str, bar_size: int) -> str:
+    return f"{contract_id}:{data_type}:{bar_size}"
+
+
+def _to_datetime64(values) -> np.ndarray:
+    return np.array(
+        [value.astimezone(pytz.utc).replace(tzinfo=None) for value in values],
+        dtype="datetime64[us]",
+    )
+
+
+def _to_datetime(value: np.datetime64) -> datetime:
+    return value.item().replace(tzinfo=pytz.utc)
+
+
+def max_request_span(bar_size: int) -> np.timedelta64:
+    days = [days for size, days in MAX_REQUEST_DAYS.items() if size <= bar_size][-1]
+    return np.timedelta64(days, "D")
+
+
+def expected_bar_starts(
+    start: datetime, end: datetime, bar_size: int
+) -> np.ndarray:
+    """
+    Start of every bar of the NYSE regular sessions closed between start and end.
+
+    IB aligns intraday bars on the clock, a bar is expected when it overlaps a session.
+
+    :return: Naive UTC datetime64[us] starts, sorted.
+    """
+    opens, closes = calendar_service.get_sessions(
+        start.astimezone(NY_TZ).date(), end.astimezone(NY_TZ).date()
+    )
+    step = np.timedelta64(bar_size, "m")
+    epoch = np.datetime64(0, "us")
+
+    firsts = epoch + (opens - epoch) // step * step
+    counts = ((closes - firsts) + step - np.timedelta64(1, "us")) // step
+
+    # Position of each bar within its session
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = np.repeat(firsts, counts) + offsets * step
+
+    return starts[
+        (starts >= _to_datetime64([start])[0]) & (starts + step <= _to_datetime64([end])[0])
+    ]
+
+
+def _checked_ranges(key: str) -> List[tuple]:
+    return [
+        (np.datetime64(start, "us"), np.datetime64(end, "us"))
+        for start, end in cache.get(f"{CHECKED_KEY}:{key}", [])
+    ]
+
+
+def _mark_checked(key: str, chunk: BackfillChunk):
+    checked = cache.get(f"{CHECKED_KEY}:{key}", [])
+    checked.append(
+        [
+            str(_to_datetime64([chunk.start])[0]),
+            str(_to_datetime64([chunk.end])[0]),
+        ]
+    )
+    cache.set(f"{CHECKED_KEY}:{key}", json.dumps(checked), CHECKED_TTL)
+
+
+def find_missing_bars(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    start: datetime,
+    end: datetime,
+) -> np.ndarray:
+    """
+    Find the bars of the trading sessions between start and end missing from the db.
+
+    :return: Naive UTC datetime64[us] starts of the missing bars, sorted.
+    """
+    expected = expected_bar_starts(start, end, bar_size)
+
+    stored = _to_datetime64(
+        db.execute(
+            select(PriceBar.date).where(
+                PriceBar.contract_id == contract_id,
+                PriceBar.data_type == data_type,
+                PriceBar.bar_size == bar_size,
+                PriceBar.date >= start,
+                PriceBar.date < end,
+            )
+        ).scalars()
+    )
+    missing = expected[~np.isin(expected, stored)]
+
+    for checked_start, checked_end in _checked_ranges(
+        series_key(contract_id, data_type, bar_size)
+    ):
+        missing = missing[(missing < checked_start) | (missing >= checked_end)]
+
+    return missing
+
+
+def plan_requests(missing: np.ndarray, bar_size: int) -> List[BackfillChunk]:
+    """
+    Cover the missing bars with as few requests as possible.
+
+    Going back from the latest missing bar, each request ends right after a missing bar
+    and reaches as far back as IB allows for the bar size, but no further than the
+    earliest missing bar it covers.
+    """
+    step = np.timedelta64(bar_size, "m")
+    span = max_request_span(bar_size)
+    chunks = []
+    last = len(missing)
+
+    while last > 0:
+        end = missing[last - 1] + step
+        first = np.searchsorted(missing, end - span, side="left")
+        start = missing[first]
+
+        chunks.append(
+            BackfillChunk(
+                _to_datetime(start),
+                _to_datetime(end),
+                prices_service.duration_str((end - start) / np.timedelta64(1, "s")),
+            )
+        )
+        last = first
+
+    return chunks
+
+
+def _save_plan(key: str, chunks: List[BackfillChunk]):
+    if chunks:
+        cache.r.hset(
+            f"{PLAN_KEY}:{key}",
+            mapping={
+                chunk.endDateTime: json.dumps(
+                    [chunk.start.isoformat(), chunk.end.isoformat(), chunk.durationStr]
+                )
+                for chunk in chunks
+            },
+        )
+
+
+def _load_plan(key: str) -> List[BackfillChunk]:
+    chunks = [
+        BackfillChunk(datetime.fromisoformat(start), datetime.fromisoformat(end), durationStr)
+        for start, end, durationStr in (
+            json.loads(raw) for raw in cache.r.hvals(f"{PLAN_KEY}:{key}")
+        )
+    ]
+
+    # Latest first, as planned
+    return sorted(chunks, key=lambda chunk: chunk.end, reverse=True)
+
+
+def backfill(
+    db: Session,
+    ib: IB,
+    contract: Contract,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    days: int = BACKFILL_DAYS,
+    end: Optional[datetime] = None,
+) -> prices_service.UpsertResult:
+    """
+    Fetch the bars missing from the last `days` days of a series.
+
+    The plan is kept in Redis and every chunk is removed once its bars are committed,
+    a backfill interrupted by an outage resumes with the chunks left. A chunk IB did not
+    answer, e.g. during a farm disconnect, stays in the plan. The days of a chunk already
+    archived are exported again, the archive is where they are read from.
+
+    :return: The total UpsertResult of the chunks fetched.
+    """
+    if bar_size >= aggregation_service.DAILY:
+        raise ValueError("Daily bars are built from the intraday ones, not backfilled.")
+
+    key = series_key(contract_id, data_type, bar_size)
+    chunks = _load_plan(key)
+
+    if not chunks:
+        end = end or datetime.now(pytz.utc)
+        chunks = plan_requests(
+            find_missing_bars(
+                db, contract_id, data_type, bar_size, end - timedelta(days=days), end
+            ),
+            bar_size,
+        )
+        _save_plan(key, chunks)
+
+    if chunks:
+        logger.info(f"Backfilling {key} in {len(chunks)} requests")
+
+    result = prices_service.UpsertResult()
+
+    # A batch of requests runs concurrently, its bars are committed before the next one
+    for batch in range(0, len(chunks), prices_service.MAX_CONCURRENT_HISTORICAL):
+        requests = {}
+
+        for chunk in chunks[batch : batch + prices_service.MAX_CONCURRENT_HISTORICAL]:
+            request = prices_service.HistoricalRequest(
+                contract,
+                data_type,
+                durationStr=chunk.durationStr,
+                barSizeSetting=prices_service.bar_size_setting(bar_size),
+                endDateTime=chunk.endDateTime,
+                priority=pacing_service.PRIORITY_BACKFILL,
+            )
+            # Contracts are not hashable before qualification, we key by identity
+            requests[id(request)] = (request, chunk)
+
+        for request, bars in prices_service.get_many_historical_bars(
+            ib, [request for request, _ in requests.values()]
+        ):
+            chunk = requests[id(request)][1]
+
+            if not pacing_service.answered(bars):
+                # Failed, not empty: the chunk stays in the plan and its range unchecked
+                logger.warning(f"Backfill of {key} until {chunk.endDateTime} failed, kept")
+                continue
+
+            closed_bars, _ = prices_service.split_closed_bars(bars, bar_size)
+
+            upserted = prices_service.upsert_price_bars(
+                db, closed_bars, data_type, contract_id, bar_size
+            )
+            db.commit()
+            result += upserted
+
+            # Holes of days already archived are only seen once the days are exported again
+            if upserted.inserted or upserted.updated:
+                archive_service.rearchive_days(
+                    db, contract_id, data_type, bar_size, chunk.start, chunk.end
+                )
+
+            if chunk.end < datetime.now(pytz.utc) - SETTLE_TIME:
+                _mark_checked(key, chunk)
+            cache.r.hdel(f"{PLAN_KEY}:{key}", chunk.endDateTime)
+
+    return result
@@ -0,0 +1,166 @@
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Iterator, List, Optional
+from pytz import timezone
+import io
+import json
+import polars as pl
+from src.services import indicator_service, prices_service
+
+# Formats of the /bars endpoints besides the default JSON list, picked from the Accept header
+NDJSON = "application/x-ndjson"  # One bar per line, streamed
+ARROW = "application/vnd.apache.arrow.stream"  # Arrow IPC stream, UTC dates
+COLUMNS_JSON = "application/vnd.htb.columns+json"  # One array per column, epoch ms dates
+JSON = "application/json"
+FORMATS = (JSON, NDJSON, ARROW, COLUMNS_JSON)
+
+COLUMNS = ("id", "date", "open", "high", "low", "close", "volume")
+ARROW_SCHEMA = {
+    "id": pl.Int64,
+    "date": pl.Datetime("us", "UTC"),
+    "open": pl.Float64,
+    "high": pl.Float64,
+    "low": pl.Float64,
+    "close": pl.Float64,
+    "volume": pl.Int64,
+}
+
+NY_TZ = timezone("America/New_York")
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """
+    Pick the format of the response from an Accept header, JSON unless another
+    supported format is preferred.
+    """
+    best, best_quality = JSON, 0.0
+
+    for media_range in (accept or "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        # The first of equally preferred formats wins
+        if media_type in FORMATS and quality > best_quality:
+            best, best_quality = media_type, quality
+
+    return best
+
+
+def _ndjson_lines(db: Session, *query_args) -> Iterator[bytes]:
+    # Run by the server while sending, after the request's session was closed, so the
+    # rows are read with a session of our own on the same engine
+    with Session(db.get_bind()) as stream_db:
+        for rows in prices_service.iter_price_bars_from_db(stream_db, *query_args):
+            yield "".join(
+                json.dumps(
+                    {
+                        "id": row.id,
+                        "date": row.date.astimezone(NY_TZ).isoformat(),
+                        "open": row.open,
+                        "high": row.high,
+                        "low": row.low,
+                        "close": row.close,
+                        "volume": row.volume,
+                    }
+                )
+                + "\n"
+                for row in rows
+            ).encode()
+
+
+def _bars_frame(db: Session, *query_args) -> pl.DataFrame:
+    # Built a batch at a time, the rows of one batch only are held as Python objects
+    frames = [
+        pl.DataFrame([tuple(row) for row in rows], schema=ARROW_SCHEMA, orient="row")
+        for rows in prices_service.iter_price_bars_from_db(db, *query_args)
+    ]
+
+    if not frames:
+        return pl.DataFrame(schema=ARROW_SCHEMA)
+
+    return pl.concat(frames, rechunk=True)
+
+
+def bars_response(
+    db: Session,
+    media_type: str,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    order: str,
+    limit: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+) -> Response:
+    """
+    Build the response of a /bars endpoint in a format other than the default JSON.
+
+    :param media_type: NDJSON, ARROW or COLUMNS_JSON, as returned by negotiate.
+    """
+    query_args = (contract_id, data_type, bar_size, order, limit, start, end, after)
+
+    if media_type == NDJSON:
+        return StreamingResponse(_ndjson_lines(db, *query_args), media_type=NDJSON)
+
+    bars = _bars_frame(db, *query_args)
+
+    if media_type == ARROW:
+        buffer = io.BytesIO()
+        bars.write_ipc_stream(buffer, compression="uncompressed")
+        return Response(buffer.getvalue(), media_type=ARROW)
+
+    columns = {
+        column: bars[column].dt.epoch("ms").to_list()
+        if column == "date"
+        else bars[column].to_list()
+        for column in COLUMNS
+    }
+
+    return Response(json.dumps(columns), media_type=COLUMNS_JSON)
+
+
+def indicators_response(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    names: Optional[List[str]],
+    limit: int,
+) -> Response:
+    """
+    Compute indicators over the last bars of a series, as columns like COLUMNS_JSON with
+    null before their warm-up.
+
+    :param names: Registered indicators, all of them when None.
+    """
+    unknown = set(names or ()) - set(indicator_service.INDICATORS)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown indicators: {', '.join(sorted(unknown))}"
+        )
+
+    values = pl.DataFrame(
+        indicator_service.get_recent_indicators(
+            db, contract_id, data_type, bar_size, names, limit
+        )
+    )
+
+    columns = {
+        column: values[column].dt.epoch("ms").to_list()
+        if column == "date"
+        else values[column].fill_nan(None).to_list()
+        for column in values.columns
+    }
+
+    return Response(json.dumps(columns), media_type=COLUMNS_JSON)
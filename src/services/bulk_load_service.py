@@ -0,0 +1,316 @@
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from datetime import datetime
+from itertools import islice
+from typing import Iterable, Iterator, NamedTuple, Optional
+import csv
+import os
+import time
+import polars as pl
+from pytz import timezone
+from src.logging_config import logger
+from src.services import (
+    archive_service,
+    indicator_service,
+    partition_service,
+    shared_bars_service,
+)
+
+# Rows copied and merged per transaction, the staging table never holds more
+BULK_BATCH_ROWS = int(os.getenv("BULK_BATCH_ROWS", 1_000_000))
+# Rows read at once from a Parquet file
+PARQUET_BATCH_ROWS = 100_000
+
+COPY_COLUMNS = (
+    "contract_id",
+    "data_type",
+    "bar_size",
+    "date",
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume",
+)
+BAR_COLUMNS = ("date", "open", "high", "low", "close", "volume")
+
+NY_TZ = timezone("America/New_York")
+
+CREATE_STAGING = """
+CREATE TEMP TABLE price_bars_staging (
+    contract_id INTEGER NOT NULL,
+    data_type VARCHAR NOT NULL,
+    bar_size INTEGER NOT NULL,
+    date TIMESTAMP WITH TIME ZONE NOT NULL,
+    open FLOAT NOT NULL,
+    high FLOAT NOT NULL,
+    low FLOAT NOT NULL,
+    close FLOAT NOT NULL,
+    volume BIGINT NOT NULL
+) ON COMMIT DROP
+"""
+
+# The last row of a duplicated bar wins, as in upsert_price_bars
+MERGE = """
+INSERT INTO price_bars ({columns}, created_at, updated_at)
+SELECT DISTINCT ON (contract_id, data_type, bar_size, date) {columns}, now(), now()
+FROM (SELECT *, row_number() OVER () AS position FROM price_bars_staging) staged
+ORDER BY contract_id, data_type, bar_size, date, position DESC
+ON CONFLICT (contract_id, data_type, bar_size, date) DO {conflict}
+"""
+UPDATE_CHANGED = """UPDATE SET
+    open = excluded.open, high = excluded.high, low = excluded.low,
+    close = excluded.close, volume = excluded.volume, updated_at = now()
+WHERE (price_bars.open, price_bars.high, price_bars.low, price_bars.close, price_bars.volume)
+    IS DISTINCT FROM (excluded.open, excluded.high, excluded.low, excluded.close, excluded.volume)
+"""
+
+
+class LoadReport(NamedTuple):
+    rows: int = 0  # Rows read
+    written: int = 0  # Bars inserted, or updated when loading with update
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class _CopyStream:
+    """
+    File object read by COPY, the lines are pulled from an iterator as COPY asks for them.
+    """
+
+    def __init__(self, lines: Iterator[str]):
+        self._lines = lines
+        self._rest = ""
+
+    def read(self, size: int = -1) -> str:
+        chunks, length = [self._rest], len(self._rest)
+
+        for line in self._lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = "".join(chunks)
+        if size < 0:
+            self._rest = ""
+            return data
+
+        self._rest = data[size:]
+        return data[:size]
+
+
+def _field(bar, name: str):
+    return bar[name] if isinstance(bar, dict) else getattr(bar, name)
+
+
+def _to_utc_iso(value) -> str:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    elif not isinstance(value, datetime):
+        # A daily bar's date
+        value = datetime.combine(value, datetime.min.time())
+
+    if value.tzinfo is None:
+        # Dates without time zone are New York time, as IB sends them
+        value = NY_TZ.localize(value)
+
+    return value.isoformat()
+
+
+def _copy_lines(
+    bars: Iterable, contract_id: Optional[int], data_type: Optional[str], bar_size: Optional[int]
+) -> Iterator[str]:
+    for bar in bars:
+        # The series of a bar is its own, or the one given for the whole load
+        series = {
+            "contract_id": contract_id,
+            "data_type": data_type,
+            "bar_size": bar_size,
+        }
+        for name in series:
+            if isinstance(bar, dict) and bar.get(name) is not None:
+                series[name] = bar[name]
+
+        yield ",".join(
+            (
+                str(series["contract_id"]),
+                series["data_type"],
+                str(series["bar_size"]),
+                _to_utc_iso(_field(bar, "date")),
+                repr(float(_field(bar, "open"))),
+                repr(float(_field(bar, "high"))),
+                repr(float(_field(bar, "low"))),
+                repr(float(_field(bar, "close"))),
+                str(int(float(_field(bar, "volume")))),
+            )
+        ) + "\n"
+
+
+def _load_batch(db: Session, lines: Iterator[str], update: bool) -> tuple:
+    db.execute(text(CREATE_STAGING))
+
+    cursor = db.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY price_bars_staging ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+        _CopyStream(lines),
+    )
+    copied = cursor.rowcount
+
+    if not copied:
+        db.rollback()
+        return 0, 0, {}
+
+    months = db.execute(
+        text(
+            "SELECT DISTINCT date_trunc('month', date AT TIME ZONE 'UTC')::date "
+            "FROM price_bars_staging"
+        )
+    ).scalars()
+    partition_service.ensure_partitions(db, months)
+
+    # First and last date loaded per series
+    series = {
+        (contract_id, data_type, bar_size): (first, last)
+        for contract_id, data_type, bar_size, first, last in db.execute(
+            text(
+                "SELECT contract_id, data_type, bar_size, min(date), max(date) "
+                "FROM price_bars_staging GROUP BY contract_id, data_type, bar_size"
+            )
+        )
+    }
+
+    written = db.execute(
+        text(
+            MERGE.format(
+                columns=", ".join(COPY_COLUMNS),
+                conflict=UPDATE_CHANGED if update else "NOTHING",
+            )
+        )
+    ).rowcount
+    db.commit()
+
+    return copied, written, series
+
+
+def load_bars(
+    db: Session,
+    bars: Iterable,
+    contract_id: Optional[int] = None,
+    data_type: Optional[str] = None,
+    bar_size: Optional[int] = None,
+    update: bool = False,
+    batch_rows: int = BULK_BATCH_ROWS,
+) -> LoadReport:
+    """
+    Bulk load bars with COPY into a staging table merged into price_bars.
+
+    The bars are consumed lazily, batch_rows at a time, so a generator of any size is
+    loaded in flat memory. Each batch is committed. The days loaded before a series'
+    archive watermark are exported again.
+
+    :param bars: Dicts or objects (e.g. BarData) with date, open, high, low, close and
+        volume. Dicts can carry their own contract_id, data_type and bar_size.
+    :param update: Overwrite the stored bars whose values changed, otherwise they are kept.
+    """
+    started = time.monotonic()
+    lines = _copy_lines(bars, contract_id, data_type, bar_size)
+    rows = written = 0
+    loaded_series = {}
+
+    while True:
+        copied, merged, series = _load_batch(db, islice(lines, batch_rows), update)
+        if not copied:
+            break
+
+        rows += copied
+        written += merged
+        for key, (first, last) in series.items():
+            if key in loaded_series:
+                first = min(first, loaded_series[key][0])
+                last = max(last, loaded_series[key][1])
+            loaded_series[key] = (first, last)
+        logger.info(
+            f"Bulk loaded {rows} rows, {rows / (time.monotonic() - started):.0f} rows/s"
+        )
+
+    # These bars did not go through upsert_price_bars, the workers' copies are stale,
+    # the days already archived are only read from the archive, and the indicators have
+    # to be computed again over the history loaded
+    for series, (first, last) in loaded_series.items():
+        shared_bars_service.invalidate(*series)
+        archive_service.rearchive_days(
+            db, *series, first, archive_service.day_bounds(last.astimezone(NY_TZ).date())[1]
+        )
+        indicator_service.reset_state(*series)
+
+    return LoadReport(rows, written, time.monotonic() - started)
+
+
+def _find_column(columns, name: str) -> str:
+    # Exports name their columns date or Date, volume or Volume...
+    for column in columns:
+        if column.lower() == name:
+            return column
+
+    raise ValueError(f"No {name} column in {list(columns)}")
+
+
+def read_csv(path: str, data_type_column: Optional[str] = None) -> Iterator[dict]:
+    """
+    Read bars from a CSV file, a row at a time.
+
+    :param data_type_column: Column holding the data type of each row, e.g. the "Type"
+        (Bid/Ask) column of the files dumped by demo.py.
+    """
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        columns = {name: _find_column(reader.fieldnames, name) for name in BAR_COLUMNS}
+
+        for row in reader:
+            bar = {name: row[column] for name, column in columns.items()}
+
+            # Exports can hold rows without prices, e.g. holidays
+            if any(bar[name] in ("", None) for name in BAR_COLUMNS):
+                continue
+
+            if data_type_column:
+                bar["data_type"] = row[data_type_column].upper()
+
+            yield bar
+
+
+def read_parquet(path: str, data_type_column: Optional[str] = None) -> Iterator[dict]:
+    """
+    Read bars from a Parquet file, PARQUET_BATCH_ROWS rows at a time.
+    """
+    bars = pl.scan_parquet(path)
+    names = bars.collect_schema().names()
+    columns = {name: _find_column(names, name) for name in BAR_COLUMNS}
+    if data_type_column:
+        columns["data_type"] = data_type_column
+
+    bars = bars.select([pl.col(column).alias(name) for name, column in columns.items()])
+    # From the file's metadata
+    total = bars.select(pl.len()).collect().item()
+
+    for offset in range(0, total, PARQUET_BATCH_ROWS):
+        # The slice of the file itself is pushed down to the reader, only the row groups
+        # of the batch are read. The rows without prices are dropped afterwards, a slice
+        # of the filtered rows would scan the file from its start for every batch.
+        batch = bars.slice(offset, PARQUET_BATCH_ROWS).collect().drop_nulls(list(BAR_COLUMNS))
+
+        if data_type_column:
+            batch = batch.with_columns(pl.col("data_type").str.to_uppercase())
+
+        yield from batch.iter_rows(named=True)
+
+
+def read_file(path: str, data_type_column: Optional[str] = None) -> Iterator[dict]:
+    if path.endswith(".parquet"):
+        return read_parquet(path, data_type_column)
+
+    return read_csv(path, data_type_column)
@@ -1,5 +1,7 @@
+import functools
 import datetime
 import pandas_market_calendars as mcal
+import numpy as np
 
 
 def get_0dte_expiration_date():
@@ -25,3 +27,23 @@ def get_0dte_expiration_date():
         raise ValueError("No valid expiration date found within the next year.")
 
     return expiration_date
+
+
+@functools.lru_cache(maxsize=64)
+def get_sessions(start_date: datetime.date, end_date: datetime.date):
+    """
+    Get the NYSE regular sessions between two days, early closes included.
+
+    :return: The session opens and closes, as naive UTC datetime64[us] arrays.
+    """
+    schedule = mcal.get_calendar("NYSE").schedule(start_date=start_date, end_date=end_date)
+
+    if schedule.empty:
+        # A weekend or a holiday, the columns are not even datetimes then
+        empty = np.array([], dtype="datetime64[us]")
+        return empty, empty
+
+    opens = schedule["market_open"].dt.tz_convert(None).to_numpy().astype("datetime64[us]")
+    closes = schedule["market_close"].dt.tz_convert(None).to_numpy().astype("datetime64[us]")
+
+    return opens, closes
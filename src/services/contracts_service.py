@@ -13,11 +13,15 @@ from sqlalchemy.orm import Session
 from datetime import date
 from src.models import models
 from src.models.schemas import IBOptionWithID, Contract as schemasContract
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional
+from collections import OrderedDict
+import json
+import numpy as np
+import pandas as pd
 from fastapi import HTTPException
 from pytz import timezone
 from datetime import datetime
-from src.services import prices_service, contracts_service, ibapi_service, calendar_service
+from src.services import prices_service, contracts_service, ibapi_service, calendar_service, cache, market_data_service
 from src.tasks import stocks_tasks
 
 
@@ -41,6 +45,82 @@ def get_option_chains(ib: IB, underlying: Contract) -> List[OptionChain]:
     return chains
 
 
+# Option chains only change between trading days, they are cached per underlying and day
+OPTION_CHAIN_KEY = "option_chain"
+OPTION_CHAIN_TTL = 60 * 60 * 24
+# Chains kept in memory per process, the least recently used go first
+OPTION_CHAIN_MEMORY = 16
+
+
+class CachedOptionChain(NamedTuple):
+    exchange: str
+    tradingClass: str
+    multiplier: str
+    expirations: frozenset
+    strikes: np.ndarray  # Sorted
+
+    def strikes_around(self, price: float, spread: float) -> np.ndarray:
+        # Strikes strictly within spread of the price, found by binary search
+        start = np.searchsorted(self.strikes, price - spread, side="right")
+        end = np.searchsorted(self.strikes, price + spread, side="left")
+
+        return self.strikes[start:end]
+
+
+_option_chains: "OrderedDict[str, List[CachedOptionChain]]" = OrderedDict()
+
+
+def _option_chain_key(underlying: Contract) -> str:
+    trading_day = datetime.now(timezone("America/New_York")).strftime("%Y%m%d")
+
+    return f"{OPTION_CHAIN_KEY}:{underlying.symbol}:{underlying.conId}:{trading_day}"
+
+
+def get_cached_option_chains(ib: IB, underlying: Contract) -> List[CachedOptionChain]:
+    """
+    Get the option chains of a qualified underlying, from memory, Redis, or IB on a miss.
+    """
+    key = _option_chain_key(underlying)
+
+    chains = _option_chains.get(key)
+    if chains is not None:
+        _option_chains.move_to_end(key)
+        return chains
+
+    raw_chains = cache.get(key)
+
+    if raw_chains is None:
+        raw_chains = [
+            {
+                "exchange": chain.exchange,
+                "tradingClass": chain.tradingClass,
+                "multiplier": chain.multiplier,
+                "expirations": sorted(chain.expirations),
+                "strikes": sorted(chain.strikes),
+            }
+            for chain in get_option_chains(ib, underlying)
+        ]
+        cache.set(key, json.dumps(raw_chains), OPTION_CHAIN_TTL)
+
+    chains = [
+        CachedOptionChain(
+            exchange=chain["exchange"],
+            tradingClass=chain["tradingClass"],
+            multiplier=chain["multiplier"],
+            expirations=frozenset(chain["expirations"]),
+            strikes=np.array(chain["strikes"], dtype=np.float64),
+        )
+        for chain in raw_chains
+    ]
+
+    # The keys hold the trading day, the chains of the past days are the first to go
+    _option_chains[key] = chains
+    while len(_option_chains) > OPTION_CHAIN_MEMORY:
+        _option_chains.popitem(last=False)
+
+    return chains
+
+
 def get_db_option_contracts(
     db: Session,
     underlying_id: int,
@@ -64,7 +144,7 @@ def get_ib_option_contracts(
     latest_price: float,
     spread_around_spot: float,
 ) -> List[Option]:
-    chains = get_option_chains(ib, underlying)
+    chains = get_cached_option_chains(ib, underlying)
 
     if underlying.symbol == "SPX":
         chain = [
@@ -80,12 +160,7 @@ def get_ib_option_contracts(
 
     # Filter strikes around the spot price
     # We only want to fetch data for strikes that are within a certain range around the spot price
-    strikes_to_fetch = [
-        strike
-        for strike in chain.strikes
-        if strike > latest_price - spread_around_spot
-        and strike < latest_price + spread_around_spot
-    ]
+    strikes_to_fetch = chain.strikes_around(latest_price, spread_around_spot).tolist()
 
     # Get all strikes for this expiration and create option contracts
     option_contracts = []
@@ -97,6 +172,7 @@ def get_ib_option_contracts(
                 strike=strike,
                 right=right,
                 exchange="SMART",
+                tradingClass=chain.tradingClass,
             )
             option_contracts.append(contract)
 
@@ -108,16 +184,7 @@ def db_to_ib_option_contracts(
 ) -> List[IBOptionWithID]:
     return [
         IBOptionWithID(
-            option=Option(
-                symbol=contract.symbol,
-                lastTradeDateOrContractMonth=contract.lastTradeDateOrContractMonth.strftime(
-                    "%Y%m%d"
-                ),
-                strike=contract.strike,
-                right=contract.right,
-                exchange=contract.exchange,
-                currency=contract.currency,
-            ),
+            option=db_to_ib_contract(contract),
             db_id=contract.id,
         )
         for contract in option_contracts
@@ -249,6 +316,123 @@ def get_contract_by_symbol(db: Session, symbol: str, contract_type: str):
     return db.query(model).filter(model.symbol == symbol).first()
 
 
+# Fully specified IB contracts, keyed by db id
+QUALIFIED_CACHE_SIZE = 10000
+_qualified_contracts: Dict[int, Contract] = {}
+
+
+def apply_contract_details(db_contract: models.BaseContract, contract: Contract):
+    db_contract.conId = contract.conId
+    db_contract.tradingClass = contract.tradingClass or None
+    db_contract.multiplier = contract.multiplier or None
+    db_contract.localSymbol = contract.localSymbol or None
+
+
+def db_to_ib_contract(db_contract: models.BaseContract) -> Contract:
+    """
+    Build the IB contract of a db row. When the row was qualified before, the contract is
+    fully specified (conId, tradingClass, multiplier) and can be used without qualification.
+    """
+    if db_contract.contract_type == "Option":
+        contract = Option(
+            db_contract.symbol,
+            db_contract.lastTradeDateOrContractMonth.strftime("%Y%m%d"),
+            db_contract.strike,
+            db_contract.right,
+            db_contract.exchange,
+            currency=db_contract.currency,
+        )
+    elif db_contract.contract_type == "Stock":
+        contract = Stock(db_contract.symbol, db_contract.exchange, db_contract.currency)
+    elif db_contract.contract_type == "Index":
+        contract = Index(db_contract.symbol, db_contract.exchange, db_contract.currency)
+    elif db_contract.contract_type == "Future":
+        contract = ContFuture(db_contract.symbol, db_contract.exchange)
+    elif db_contract.contract_type == "Forex":
+        contract = Forex(db_contract.symbol)
+    else:
+        raise ValueError(f"Invalid contract type {db_contract.contract_type}")
+
+    if db_contract.conId:
+        contract.conId = db_contract.conId
+        contract.tradingClass = db_contract.tradingClass or ""
+        contract.multiplier = db_contract.multiplier or ""
+        contract.localSymbol = db_contract.localSymbol or ""
+
+    return contract
+
+
+def _cache_qualified(db_id: int, contract: Contract):
+    if len(_qualified_contracts) >= QUALIFIED_CACHE_SIZE:
+        _qualified_contracts.clear()
+
+    _qualified_contracts[db_id] = contract
+
+
+def get_qualified_contracts(
+    db: Session, ib: IB, db_contracts: List[models.BaseContract]
+) -> List[Contract]:
+    """
+    Get the qualified IB contracts of db rows.
+
+    Contracts come from the in-process cache, or are built from the stored conId.
+    Only the rows never qualified before cost an IB round-trip, made in one batch.
+    """
+    contracts = []
+    to_qualify = []
+
+    for db_contract in db_contracts:
+        contract = _qualified_contracts.get(db_contract.id)
+
+        if contract is None:
+            contract = db_to_ib_contract(db_contract)
+
+            if contract.conId:
+                _cache_qualified(db_contract.id, contract)
+            else:
+                to_qualify.append((db_contract, contract))
+
+        contracts.append(contract)
+
+    if to_qualify:
+        ib.qualifyContracts(*[contract for _, contract in to_qualify])
+
+        for db_contract, contract in to_qualify:
+            if not contract.conId:
+                raise ValueError(f"Could not qualify contract {contract}.")
+
+            apply_contract_details(db_contract, contract)
+            _cache_qualified(db_contract.id, contract)
+
+        db.commit()
+
+    return contracts
+
+
+def get_qualified_contract(
+    db: Session, ib: IB, db_contract: models.BaseContract
+) -> Contract:
+    return get_qualified_contracts(db, ib, [db_contract])[0]
+
+
+def get_ladder_quotes(
+    db: Session, ib: IB, db_contracts: List[models.BaseContract]
+) -> pd.DataFrame:
+    """
+    Quote a strike ladder in one round-trip.
+
+    :return: One row per contract, in the given order, with the db id, conId, strike,
+        last, bid, ask, volume and time.
+    """
+    quotes = market_data_service.get_quotes(
+        ib, get_qualified_contracts(db, ib, db_contracts)
+    )
+    quotes.insert(0, "id", [db_contract.id for db_contract in db_contracts])
+    quotes.insert(2, "strike", [getattr(db_contract, "strike", None) for db_contract in db_contracts])
+
+    return quotes
+
+
 # Helper function to create the appropriate IB contract object
 def create_ib_contract(
     contract_type: str,
@@ -301,19 +485,8 @@ def get_fetch_option_contracts_with_strike(
         .all()
     )
 
-    if underlying_db_contact.contract_type == "Stock":
-        underlying_contract = Stock(
-            underlying_db_contact.symbol,
-            underlying_db_contact.exchange,
-            underlying_db_contact.currency,
-        )
-
-    elif underlying_db_contact.contract_type == "Index":
-        underlying_contract = Index(
-            underlying_db_contact.symbol, underlying_db_contact.exchange
-        )
-
-    underlying_contract = ib.qualifyContracts(underlying_contract)[0]
+    # The underlying is only qualified against IB the first time
+    underlying_contract = get_qualified_contract(db, ib, underlying_db_contact)
     latest_price = prices_service.get_latest_price(underlying_contract, ib)
 
     if not contracts:
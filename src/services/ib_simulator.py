@@ -0,0 +1,741 @@
+"""
+Offline stand-in for ib_insync's IB, replaying a recorded session.
+
+A recording is a directory with:
+
+- contracts.json: the contracts (ib_insync fields) returned by the qualification
+- chains.json: the reqSecDefOptParams answers, keyed by underlying conId
+- bars/<conId>_<whatToShow>_<bar_size>.csv: date,open,high,low,close,volume
+- ticks/<conId>.csv (optional): time,last,bid,ask,volume
+
+Historical requests are rebuilt from the finest recorded bars closed at the simulated
+time, quotes from the ticks (or from the closed bars when no tick was recorded) and
+orders are acked and filled against those quotes after a configurable latency. The
+session runs SIM_SPEED times faster than real time, on a clock shared by every worker
+through Redis.
+
+It is selected with IB_BACKEND=simulator, see ibapi_service.
+"""
+
+from ib_insync import (
+    BarData,
+    BarDataList,
+    Contract,
+    ContractDetails,
+    Option,
+    OptionChain,
+    OrderStatus,
+    Ticker,
+    Trade,
+    util,
+)
+from eventkit import Event
+import asyncio
+import itertools
+import json
+import math
+import os
+import time
+import zlib
+import pandas as pd
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from pytz import timezone
+from src.logging_config import logger
+from src.services import cache, pacing_service
+
+RECORDING_DIR = os.getenv("SIM_RECORDING_DIR", "recordings/latest")
+SIM_SPEED = float(os.getenv("SIM_SPEED", 1))
+SIM_START = os.getenv("SIM_START")  # ISO datetime, defaults to the first recorded bar
+
+# Latencies in simulated seconds
+CONNECT_LATENCY = float(os.getenv("SIM_CONNECT_LATENCY", 0.05))
+HISTORICAL_LATENCY = float(os.getenv("SIM_HISTORICAL_LATENCY", 0.3))
+SNAPSHOT_LATENCY = float(os.getenv("SIM_SNAPSHOT_LATENCY", 0.2))
+ACK_LATENCY = float(os.getenv("SIM_ACK_LATENCY", 0.05))
+FILL_LATENCY = float(os.getenv("SIM_FILL_LATENCY", 0.5))
+
+HALF_SPREAD = float(os.getenv("SIM_HALF_SPREAD", 0.05))  # Used when no BID/ASK was recorded
+TICK_INTERVAL = 0.25  # Real seconds between two ticker updates while sleeping
+
+# Start of the replay in real time, shared by all the workers of a simulation
+EPOCH_KEY = "sim_epoch"
+
+NY_TZ = timezone("America/New_York")
+BAR_COLUMNS = ["open", "high", "low", "close", "volume"]
+
+_order_ids = itertools.count(1)
+_req_ids = itertools.count(1)
+
+
+def parse_bar_size(barSizeSetting: str) -> int:
+    # "1 min", "5 mins", "1 hour", "1 day" -> minutes
+    count, unit = barSizeSetting.split()
+    unit = unit.rstrip("s")
+
+    return int(count) * {"sec": 1 / 60, "min": 1, "hour": 60, "day": 60 * 24}[unit]
+
+
+def parse_duration(durationStr: str) -> timedelta:
+    count, unit = durationStr.split()
+    days = {"D": 1, "W": 7, "M": 31, "Y": 366}
+
+    if unit == "S":
+        return timedelta(seconds=int(count))
+
+    return timedelta(days=int(count) * days[unit])
+
+
+def synthetic_con_id(contract: Contract) -> int:
+    key = json.dumps(util.dataclassNonDefaults(contract), sort_keys=True, default=str)
+
+    return zlib.crc32(key.encode("utf-8")) & 0x7FFFFFFF
+
+
+class Recording:
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(os.path.join(path, "contracts.json")) as f:
+            self.contracts: List[dict] = json.load(f)
+
+        chains_path = os.path.join(path, "chains.json")
+        self.chains: Dict[str, List[dict]] = {}
+        if os.path.exists(chains_path):
+            with open(chains_path) as f:
+                self.chains = json.load(f)
+
+        # (conId, whatToShow) -> {bar_size: file}
+        self.bar_files: Dict[tuple, Dict[int, str]] = {}
+        bars_dir = os.path.join(path, "bars")
+
+        for name in os.listdir(bars_dir) if os.path.isdir(bars_dir) else []:
+            conId, whatToShow, bar_size = name[: -len(".csv")].split("_")
+            self.bar_files.setdefault((int(conId), whatToShow), {})[int(bar_size)] = (
+                os.path.join(bars_dir, name)
+            )
+
+        self._frames: Dict[str, pd.DataFrame] = {}
+
+    def _read(self, file: str, time_column: str) -> pd.DataFrame:
+        if file not in self._frames:
+            frame = pd.read_csv(file, parse_dates=[time_column])
+            frame[time_column] = frame[time_column].dt.tz_convert(NY_TZ)
+            self._frames[file] = frame.set_index(time_column).sort_index()
+
+        return self._frames[file]
+
+    def start(self) -> datetime:
+        return min(
+            self._read(file, "date").index[0]
+            for files in self.bar_files.values()
+            for file in files.values()
+        )
+
+    def find_contract(self, contract: Contract) -> Optional[dict]:
+        wanted = {
+            k: v
+            for k, v in util.dataclassNonDefaults(contract).items()
+            if k in ["conId", "secType", "symbol", "lastTradeDateOrContractMonth", "right", "tradingClass"]
+        }
+
+        for recorded in self.contracts:
+            if all(recorded.get(k) == v for k, v in wanted.items()) and (
+                not contract.strike or recorded.get("strike") == contract.strike
+            ):
+                return recorded
+
+        return None
+
+    def bars(self, conId: int, whatToShow: str, bar_size: int) -> Optional[tuple]:
+        # The finest recorded series that can be aggregated into bar_size
+        files = self.bar_files.get((conId, whatToShow), {})
+        sizes = [size for size in sorted(files) if bar_size % size == 0]
+
+        if not sizes:
+            return None
+
+        return sizes[0], self._read(files[sizes[0]], "date")
+
+    def ticks(self, conId: int) -> Optional[pd.DataFrame]:
+        file = os.path.join(self.path, "ticks", f"{conId}.csv")
+
+        return self._read(file, "time") if os.path.exists(file) else None
+
+
+class SimulatedClock:
+    def __init__(self, start: datetime, speed: float, epoch: float):
+        self.start = start
+        self.speed = speed
+        self.epoch = epoch
+
+    def now(self) -> datetime:
+        return self.start + timedelta(seconds=(time.time() - self.epoch) * self.speed)
+
+    def real_seconds(self, sim_seconds: float) -> float:
+        return sim_seconds / self.speed
+
+
+class SimulatedIB:
+    """
+    Implements the part of the IB API used by the services and tasks.
+    """
+
+    def __init__(self, recording: Recording, clock: SimulatedClock):
+        self.recording = recording
+        self.clock = clock
+        self.client = SimpleNamespace(clientId=None)
+        self._connected = False
+
+        self.pendingTickersEvent = Event("pendingTickersEvent")
+        self.errorEvent = Event("errorEvent")
+        self.commissionReportEvent = Event("commissionReportEvent")
+        self.orderStatusEvent = Event("orderStatusEvent")
+        self.barUpdateEvent = Event("barUpdateEvent")
+
+        self._tickers: Dict[int, Ticker] = {}
+        self._trades: List[Trade] = []
+        self._live_bars: List[BarDataList] = []
+        self._snapshots: Dict[int, Ticker] = {}
+
+    @classmethod
+    def from_env(cls) -> "SimulatedIB":
+        recording = Recording(RECORDING_DIR)
+
+        start = datetime.fromisoformat(SIM_START) if SIM_START else recording.start()
+        if start.tzinfo is None:
+            start = NY_TZ.localize(start)
+
+        cache.r.set(EPOCH_KEY, time.time(), nx=True)
+        epoch = float(cache.r.get(EPOCH_KEY))
+
+        return cls(recording, SimulatedClock(start, SIM_SPEED, epoch))
+
+    # Connection
+
+    def connect(self, host: str = "", port: int = 0, clientId: int = 1, **kwargs):
+        self.sleep(CONNECT_LATENCY)
+        self.client.clientId = clientId
+        self._connected = True
+        logger.info(f"Simulated IB connected (clientId {clientId}, {self.clock.now()})")
+
+        return self
+
+    def disconnect(self):
+        self._connected = False
+
+    def isConnected(self) -> bool:
+        return self._connected
+
+    def reqAccountUpdates(self, subscribe: bool = True, account: str = ""):
+        pass
+
+    # Event loop
+
+    def run(self, *awaitables, timeout: Optional[float] = None):
+        return util.run(*awaitables, timeout=timeout)
+
+    def sleep(self, secs: float = 0.02) -> bool:
+        deadline = time.time() + self.clock.real_seconds(secs)
+
+        while True:
+            self._update_tickers()
+            self._update_bars()
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                return True
+
+            util.run(asyncio.sleep(min(remaining, TICK_INTERVAL)))
+
+    def waitOnUpdate(self, timeout: float = 0) -> bool:
+        self.sleep(min(timeout, TICK_INTERVAL * self.clock.speed) if timeout else TICK_INTERVAL)
+
+        return True
+
+    # Contracts
+
+    def qualifyContracts(self, *contracts: Contract) -> List[Contract]:
+        for contract in contracts:
+            recorded = self.recording.find_contract(contract)
+
+            if recorded:
+                for field, value in recorded.items():
+                    setattr(contract, field, value)
+            else:
+                contract.conId = synthetic_con_id(contract)
+
+        return list(contracts)
+
+    def reqContractDetails(self, contract: Contract) -> List[ContractDetails]:
+        return [ContractDetails(contract=self.qualifyContracts(contract)[0])]
+
+    def reqSecDefOptParams(
+        self,
+        underlyingSymbol: str,
+        futFopExchange: str,
+        underlyingSecType: str,
+        underlyingConId: int,
+    ) -> List[OptionChain]:
+        return [
+            OptionChain(
+                chain["exchange"],
+                underlyingConId,
+                chain["tradingClass"],
+                chain["multiplier"],
+                chain["expirations"],
+                chain["strikes"],
+            )
+            for chain in self.recording.chains.get(str(underlyingConId), [])
+        ]
+
+    # Historical data
+
+    def _bars(
+        self,
+        contract: Contract,
+        whatToShow: str,
+        end: datetime,
+        duration: timedelta,
+        bar_size: int,
+    ) -> BarDataList:
+        result = BarDataList()
+        result.contract = contract
+        recorded = self.recording.bars(contract.conId, whatToShow, bar_size)
+
+        if recorded is None:
+            return result
+
+        source_size, frame = recorded
+        frame = frame.loc[end - duration : end]
+        # Only the recorded bars closed by now are known, the bar forming is built from
+        # the finer ones closed so far, or left out when none were recorded
+        frame = frame[frame.index + timedelta(minutes=source_size) <= self.clock.now()]
+
+        if source_size != bar_size:
+            frame = (
+                frame.resample(f"{bar_size}min", origin="start_day")
+                .agg({"open": "first", "high": "max", "low": "min", "close": "last", "volume": "sum"})
+                .dropna()
+            )
+
+        for date, row in zip(frame.index, frame[BAR_COLUMNS].itertuples(index=False)):
+            result.append(
+                BarData(
+                    date=date.to_pydatetime(),
+                    open=row.open,
+                    high=row.high,
+                    low=row.low,
+                    close=row.close,
+                    volume=row.volume,
+                )
+            )
+
+        return result
+
+    async def reqHistoricalDataAsync(
+        self,
+        contract: Contract,
+        endDateTime="",
+        durationStr: str = "1 D",
+        barSizeSetting: str = "1 min",
+        whatToShow: str = "TRADES",
+        useRTH: bool = False,
+        formatDate: int = 1,
+        keepUpToDate: bool = False,
+        chartOptions: list = [],
+        timeout: float = 60,
+    ) -> BarDataList:
+        await asyncio.sleep(self.clock.real_seconds(HISTORICAL_LATENCY))
+
+        if not contract.conId:
+            self.qualifyContracts(contract)
+
+        if isinstance(endDateTime, datetime):
+            end = endDateTime
+        elif endDateTime:
+            end = NY_TZ.localize(datetime.strptime(endDateTime[:17], "%Y%m%d %H:%M:%S"))
+        else:
+            end = self.clock.now()
+
+        bars = self._bars(
+            contract,
+            whatToShow,
+            end,
+            parse_duration(durationStr),
+            parse_bar_size(barSizeSetting),
+        )
+        bars.reqId = next(_req_ids)
+
+        if not bars:
+            # As IB does for a range without bars
+            self.errorEvent.emit(
+                bars.reqId,
+                162,
+                "Historical Market Data Service error message:HMDS query returned no data",
+                contract,
+            )
+
+        if keepUpToDate:
+            bars.whatToShow = whatToShow
+            bars.barSizeSetting = barSizeSetting
+            bars.keepUpToDate = True
+            self._live_bars.append(bars)
+
+        return bars
+
+    def reqHistoricalData(self, contract: Contract, *args, **kwargs) -> BarDataList:
+        return self.run(self.reqHistoricalDataAsync(contract, *args, **kwargs))
+
+    def realtimeBars(self) -> List[BarDataList]:
+        return list(self._live_bars)
+
+    def cancelHistoricalData(self, bars: BarDataList):
+        if bars in self._live_bars:
+            self._live_bars.remove(bars)
+
+    def _update_bars(self):
+        now = self.clock.now()
+
+        for bars in self._live_bars:
+            bar_size = parse_bar_size(bars.barSizeSetting)
+            latest = self._bars(
+                bars.contract, bars.whatToShow, now, timedelta(minutes=bar_size * 2), bar_size
+            )
+            if not latest:
+                continue
+
+            if bars and latest[-1] == bars[-1]:
+                continue
+
+            has_new_bar = bool(bars) and latest[-1].date > bars[-1].date
+            for bar in latest:
+                if not bars or bar.date > bars[-1].date:
+                    bars.append(bar)
+                elif bar.date == bars[-1].date:
+                    # The bar that was forming gets its final values
+                    bars[-1] = bar
+
+            bars.updateEvent.emit(bars, has_new_bar)
+            self.barUpdateEvent.emit(bars, has_new_bar)
+
+    # Market data
+
+    def _quote(self, conId: int) -> dict:
+        now = self.clock.now()
+        ticks = self.recording.ticks(conId)
+
+        if ticks is not None:
+            position = ticks.index.searchsorted(now, side="right") - 1
+            if position < 0:
+                return {}
+
+            row = ticks.iloc[position]
+            return {field: row.get(field, math.nan) for field in ["last", "bid", "ask", "volume"]}
+
+        quote = {}
+        for field, whatToShow in [("last", "TRADES"), ("bid", "BID"), ("ask", "ASK")]:
+            recorded = self.recording.bars(conId, whatToShow, 1)
+            if recorded is None:
+                continue
+
+            source_size, frame = recorded
+            # The close of the last bar closed, a bar forming would quote its future close
+            position = (
+                frame.index.searchsorted(now - timedelta(minutes=source_size), side="right") - 1
+            )
+            if position >= 0:
+                quote[field] = frame["close"].iloc[position]
+
+        # Only trades recorded, we quote around them
+        if "last" in quote and "bid" not in quote:
+            quote["bid"] = quote["last"] - HALF_SPREAD
+            quote["ask"] = quote["last"] + HALF_SPREAD
+
+        return quote
+
+    def _update_tickers(self):
+        updated = set()
+        now = self.clock.now()
+
+        for ticker in self._tickers.values():
+            quote = self._quote(ticker.contract.conId)
+
+            if any(getattr(ticker, k) != v for k, v in quote.items()):
+                for field, value in quote.items():
+                    setattr(ticker, field, value)
+                ticker.time = now
+                ticker.updateEvent.emit(ticker)
+                updated.add(ticker)
+
+        if updated:
+            self.pendingTickersEvent.emit(updated)
+
+    def reqMktData(
+        self,
+        contract: Contract,
+        genericTickList: str = "",
+        snapshot: bool = False,
+        regulatorySnapshot: bool = False,
+        mktDataOptions: list = [],
+    ) -> Ticker:
+        if not contract.conId:
+            self.qualifyContracts(contract)
+
+        ticker = self._tickers.get(id(contract))
+        if ticker is None:
+            ticker = Ticker(contract=contract)
+            self._tickers[id(contract)] = ticker
+
+        return ticker
+
+    async def reqTickersAsync(self, *contracts: Contract, regulatorySnapshot: bool = False) -> List[Ticker]:
+        await asyncio.sleep(self.clock.real_seconds(SNAPSHOT_LATENCY))
+        now = self.clock.now()
+        tickers = []
+
+        for contract in contracts:
+            if not contract.conId:
+                self.qualifyContracts(contract)
+
+            ticker = self._tickers.get(id(contract))
+            if ticker is None:
+                ticker = Ticker(contract=contract)
+                self._snapshots[id(contract)] = ticker
+
+            for field, value in self._quote(contract.conId).items():
+                setattr(ticker, field, value)
+            ticker.time = now
+            tickers.append(ticker)
+
+        return tickers
+
+    def reqTickers(self, *contracts: Contract, regulatorySnapshot: bool = False) -> List[Ticker]:
+        return self.run(self.reqTickersAsync(*contracts, regulatorySnapshot=regulatorySnapshot))
+
+    def cancelMktData(self, contract: Contract):
+        self._tickers.pop(id(contract), None)
+
+    def ticker(self, contract: Contract) -> Optional[Ticker]:
+        return self._tickers.get(id(contract)) or self._snapshots.get(id(contract))
+
+    def tickers(self) -> List[Ticker]:
+        return list(self._tickers.values())
+
+    # Orders
+
+    def placeOrder(self, contract: Contract, order) -> Trade:
+        order.orderId = order.orderId or next(_order_ids)
+        trade = Trade(
+            contract=contract,
+            order=order,
+            orderStatus=OrderStatus(
+                orderId=order.orderId,
+                status="PendingSubmit",
+                remaining=order.totalQuantity,
+            ),
+        )
+        self._trades.append(trade)
+
+        util.getLoop().call_later(self.clock.real_seconds(ACK_LATENCY), self._ack, trade)
+
+        return trade
+
+    def _emit_status(self, trade: Trade):
+        trade.statusEvent.emit(trade)
+        self.orderStatusEvent.emit(trade)
+
+    def _ack(self, trade: Trade):
+        trade.orderStatus.status = "Submitted"
+        self._emit_status(trade)
+
+        util.getLoop().call_later(self.clock.real_seconds(FILL_LATENCY), self._try_fill, trade)
+
+    def _try_fill(self, trade: Trade):
+        if trade.orderStatus.status != "Submitted":
+            return
+
+        quote = self._quote(trade.contract.conId)
+        order = trade.order
+        price = quote.get("ask") if order.action == "BUY" else quote.get("bid")
+
+        marketable = price is not None and not math.isnan(price) and (
+            order.orderType == "MKT"
+            or (order.action == "BUY" and order.lmtPrice >= price)
+            or (order.action == "SELL" and order.lmtPrice <= price)
+        )
+
+        if not marketable:
+            # We try again on the next quote
+            util.getLoop().call_later(TICK_INTERVAL, self._try_fill, trade)
+            return
+
+        trade.orderStatus.status = "Filled"
+        trade.orderStatus.filled = order.totalQuantity
+        trade.orderStatus.remaining = 0
+        trade.orderStatus.avgFillPrice = price
+        trade.orderStatus.lastFillPrice = price
+        self._emit_status(trade)
+
+    def cancelOrder(self, order):
+        for trade in self._trades:
+            if trade.order.orderId == order.orderId and not trade.isDone():
+                trade.orderStatus.status = "Cancelled"
+                self._emit_status(trade)
+
+    def trades(self) -> List[Trade]:
+        return list(self._trades)
+
+
+def _record_bars(
+    ib,
+    path: str,
+    contract: Contract,
+    data_type: str,
+    durationStr: str,
+    bar_size: int,
+    endDateTime: str,
+) -> Optional[pd.DataFrame]:
+    # Paced with the workers' bucket, a ladder is hundreds of requests
+    bars = ib.run(
+        pacing_service.request_historical_bars(
+            ib,
+            contract,
+            data_type,
+            endDateTime=endDateTime,
+            durationStr=durationStr,
+            barSizeSetting=f"{bar_size} min{'s' if bar_size > 1 else ''}",
+            useRTH=False,
+            formatDate=2,  # UTC
+        )
+    )
+    if not bars:
+        return None
+
+    frame = util.df(bars)[["date"] + BAR_COLUMNS]
+    frame.to_csv(
+        os.path.join(path, "bars", f"{contract.conId}_{data_type}_{bar_size}.csv"),
+        index=False,
+    )
+
+    return frame
+
+
+def _ladder(
+    ib, underlying: Contract, chains: List[dict], frame: pd.DataFrame, spread: float
+) -> List[Contract]:
+    # The options expiring on a recorded day, with strikes within spread of that day's range
+    days = frame.groupby(frame["date"].dt.tz_convert(NY_TZ).dt.strftime("%Y%m%d"))
+    options = []
+
+    for day, bars in days:
+        for chain in chains:
+            if chain["exchange"] != "SMART" or day not in chain["expirations"]:
+                continue
+
+            for strike in chain["strikes"]:
+                if bars["low"].min() - spread < strike < bars["high"].max() + spread:
+                    options += [
+                        Option(
+                            symbol=underlying.symbol,
+                            lastTradeDateOrContractMonth=day,
+                            strike=strike,
+                            right=right,
+                            exchange="SMART",
+                            tradingClass=chain["tradingClass"],
+                        )
+                        for right in ["C", "P"]
+                    ]
+
+    # The strikes are those of every expiration, the ones not listed for a day stay unqualified
+    return [option for option in ib.qualifyContracts(*options) if option.conId]
+
+
+def record_session(
+    ib,
+    path: str,
+    contracts: List[Contract],
+    whatToShow: List[str],
+    durationStr: str = "1 D",
+    bar_size: int = 1,
+    endDateTime: str = "",
+    option_whatToShow: List[str] = ["BID", "ASK", "TRADES"],
+    spread_around_spot: float = 150,
+):
+    """
+    Record what the simulator needs to replay the given contracts from a live connection.
+
+    Underlyings get their option chains recorded too, and the options expiring on a
+    recorded day get their bars recorded over that day. Their BID/ASK bars are what the
+    simulator quotes them from.
+
+    :param ib: A live IB connection.
+    :param path: The recording directory.
+    :param contracts: The contracts to record.
+    :param whatToShow: The data types to record, e.g. ["TRADES", "BID", "ASK"].
+    :param option_whatToShow: The data types recorded for the options.
+    :param spread_around_spot: Distance to the underlying's range of the strikes recorded,
+        as get_fetch_option_contracts_with_strike fetches them.
+    """
+    os.makedirs(os.path.join(path, "bars"), exist_ok=True)
+
+    contracts = ib.qualifyContracts(*contracts)
+    recorded = list(contracts)
+    chains = {}
+
+    for contract in contracts:
+        frames = {
+            data_type: _record_bars(
+                ib, path, contract, data_type, durationStr, bar_size, endDateTime
+            )
+            for data_type in whatToShow
+        }
+
+        if contract.secType not in ["STK", "IND"]:
+            continue
+
+        chains[str(contract.conId)] = [
+            {
+                "exchange": chain.exchange,
+                "tradingClass": chain.tradingClass,
+                "multiplier": chain.multiplier,
+                "expirations": sorted(chain.expirations),
+                "strikes": sorted(chain.strikes),
+            }
+            for chain in ib.reqSecDefOptParams(
+                contract.symbol, "", contract.secType, contract.conId
+            )
+        ]
+
+        frame = frames.get("TRADES")
+        if frame is None:
+            logger.warning(f"No TRADES bars for {contract.symbol}, its options are not recorded")
+            continue
+
+        options = _ladder(ib, contract, chains[str(contract.conId)], frame, spread_around_spot)
+        logger.info(f"Recording {len(options)} options of {contract.symbol}")
+
+        for option in options:
+            # The expiration day only, until the close
+            expiry = NY_TZ.localize(
+                datetime.strptime(option.lastTradeDateOrContractMonth, "%Y%m%d")
+                + timedelta(hours=16, minutes=15)
+            )
+            for data_type in option_whatToShow:
+                _record_bars(
+                    ib,
+                    path,
+                    option,
+                    data_type,
+                    "1 D",
+                    bar_size,
+                    expiry.astimezone(timezone("UTC")).strftime("%Y%m%d-%H:%M:%S"),
+                )
+        recorded += options
+
+    with open(os.path.join(path, "contracts.json"), "w") as f:
+        json.dump([util.dataclassNonDefaults(c) for c in recorded], f, indent=2)
+
+    with open(os.path.join(path, "chains.json"), "w") as f:
+        json.dump(chains, f)
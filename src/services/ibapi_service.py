@@ -1,72 +1,323 @@
-from ib_insync import IB
+from ib_insync import IB, BarDataList, Ticker
 import os
 import time
 import random
+import socket
+import threading
+import psutil
 from contextlib import contextmanager
+from typing import Dict, List
 import logging
 from logging_config import logger
+from src.services import cache, market_data_service, metrics_service, pacing_service
 
-@contextmanager
-def connect_to_ib(clientId: int = None):
-    ib = IB()
+IB_HOST = os.getenv("IB_GATEWAY_IP", "127.0.0.1")
+IB_PORT = int(os.getenv("IB_GATEWAY_PORT", 4002))
+# "gateway" for TWS/IB Gateway, "simulator" to replay a recorded session offline
+IB_BACKEND = os.getenv("IB_BACKEND", "gateway")
+
+# Client ids handed out to workers. The broker process (ib_connection_manager.py)
+# uses its own id outside of this range.
+CLIENT_ID_RANGE = range(
+    int(os.getenv("IB_CLIENT_ID_START", 100)), int(os.getenv("IB_CLIENT_ID_END", 164))
+)
+# Idle connections kept open per process, 2 so that nested connect_to_ib calls reuse too
+POOL_SIZE = int(os.getenv("IB_POOL_SIZE", 2))
+LEASE_TTL = int(os.getenv("IB_LEASE_TTL", 60 * 60))
+# Events the tasks listen to, a pooled connection is handed over without their handlers.
+# errorEvent keeps the connection's own handlers (pacing, metrics).
+TASK_EVENTS = ["pendingTickersEvent", "commissionReportEvent", "orderStatusEvent", "barUpdateEvent"]
+
+LEASE_KEY = "ib_client_lease"
+ACQUIRE_LATENCY_KEY = "ib_acquire_latency_ms"
+ACQUIRE_LATENCY_SAMPLES = 1000
+
+# Process local pool, reset after a fork so children never share a socket
+_idle: List[IB] = []
+_pool_pid = os.getpid()
+# Lease refreshes of the open pooled connections, borrowed or idle, keyed by connection
+_lease_timers: Dict[int, threading.Timer] = {}
+_lease_lock = threading.Lock()
+
+
+def _lease_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _lease_client_id() -> int:
+    # A clientId is leased through Redis so two workers never connect with the same id
+    for client_id in random.sample(CLIENT_ID_RANGE, len(CLIENT_ID_RANGE)):
+        if cache.r.set(f"{LEASE_KEY}:{client_id}", _lease_owner(), nx=True, ex=LEASE_TTL):
+            return client_id
+
+    raise Exception("No free IB clientId left in the pool range.")
+
+
+def _refresh_lease(client_id: int) -> bool:
+    key = f"{LEASE_KEY}:{client_id}"
+    owner = cache.r.get(key)
+
+    if owner is None:
+        # The lease expired while idle, we take it back if nobody else did
+        return bool(cache.r.set(key, _lease_owner(), nx=True, ex=LEASE_TTL))
+
+    if owner.decode("utf-8") != _lease_owner():
+        return False
+
+    return bool(cache.r.expire(key, LEASE_TTL))
+
+
+def _release_lease(client_id: int):
+    key = f"{LEASE_KEY}:{client_id}"
+    owner = cache.r.get(key)
+
+    if owner is not None and owner.decode("utf-8") == _lease_owner():
+        cache.r.delete(key)
+
+
+def reap_stale_leases() -> int:
+    """
+    Delete the leases held by processes of this host that no longer exist.
+
+    :return: The number of leases released.
+    """
+    hostname = socket.gethostname()
+    reaped = 0
+
+    for key in cache.r.scan_iter(f"{LEASE_KEY}:*"):
+        owner = cache.r.get(key)
+        if owner is None:
+            continue
+
+        host, _, pid = owner.decode("utf-8").rpartition(":")
+        if host == hostname and not psutil.pid_exists(int(pid)):
+            cache.r.delete(key)
+            reaped += 1
+
+    return reaped
+
+
+def get_acquire_latencies() -> List[float]:
+    return [float(value) for value in cache.r.lrange(ACQUIRE_LATENCY_KEY, 0, -1)]
+
+
+def _record_acquire_latency(latency_ms: float):
+    pipe = cache.r.pipeline()
+    pipe.lpush(ACQUIRE_LATENCY_KEY, round(latency_ms, 3))
+    pipe.ltrim(ACQUIRE_LATENCY_KEY, 0, ACQUIRE_LATENCY_SAMPLES - 1)
+    pipe.execute()
+
+
+def _new_ib() -> IB:
+    if IB_BACKEND == "simulator":
+        from src.services import ib_simulator
+
+        return metrics_service.instrument_ib(ib_simulator.SimulatedIB.from_env())
+
+    return metrics_service.instrument_ib(IB())
+
+
+def _connect(clientId: int = None) -> IB:
+    ib = _new_ib()
     connected = False
-    max_retries = 100  
+    max_retries = 100
     retry_count = 0
-    retry_delay = 5  
+    retry_delay = 5
+    leased = clientId is None
 
-    if not clientId:
-        clientId = random.randint(1, 32767)
+    if leased:
+        clientId = _lease_client_id()
 
     while not connected and retry_count < max_retries:
         try:
-            ib.connect(
-                os.getenv("IB_GATEWAY_IP", "127.0.0.1"),
-                os.getenv("IB_GATEWAY_PORT", 4002),
-                clientId=clientId,
-            )
+            ib.connect(IB_HOST, IB_PORT, clientId=clientId)
             connected = True
             logger.info(f"Connected to IB Gateway with clientId {clientId}")
-            
-            ib.reqAccountUpdates(True)  
+
+            ib.reqAccountUpdates(True)
             ib.commissionReportEvent.clear()
             ib.pendingTickersEvent.clear()
-            
+            ib.errorEvent += pacing_service.on_error
+
         except Exception as e:
-            logger.warning(f"Connection attempt {retry_count + 1} failed with clientId {clientId}: {str(e)}")
-            clientId = random.randint(1, 32767)  
+            logger.warning(
+                f"Connection attempt {retry_count + 1} failed with clientId {clientId}: {str(e)}"
+            )
+            if leased:
+                _release_lease(clientId)
+                clientId = _lease_client_id()
+            else:
+                clientId = random.randint(1, 32767)
             retry_count += 1
             time.sleep(retry_delay)
 
     if not connected:
+        if leased:
+            _release_lease(clientId)
         raise Exception("Failed to connect after multiple attempts.")
 
+    return ib
+
+
+def _disconnect(ib: IB):
+    _drop_lease_timer(ib)
+    clientId = ib.client.clientId
+    logger.info(f"Disconnecting clientId {clientId}")
+
+    try:
+        ib.disconnect()
+    except:
+        pass
+
+    if clientId in CLIENT_ID_RANGE:
+        _release_lease(clientId)
+
+
+def _acquire(clientId: int = None) -> IB:
+    global _pool_pid
+
+    if _pool_pid != os.getpid():
+        # We were forked, the parent's sockets are not ours to use, nor its lease timers
+        _idle.clear()
+        _lease_timers.clear()
+        _pool_pid = os.getpid()
+
+    if clientId is None:
+        while _idle:
+            ib = _idle.pop()
+
+            if ib.isConnected() and _refresh_lease(ib.client.clientId):
+                return ib
+
+            _disconnect(ib)
+
+    return _connect(clientId)
+
+
+def _schedule_lease(ib: IB):
+    timer = threading.Timer(LEASE_TTL / 3, _hold_lease, (ib,))
+    timer.daemon = True
+    _lease_timers[id(ib)] = timer
+    timer.start()
+
+
+def _hold_lease(ib: IB):
+    # In a timer thread, as the loop does not turn while the connection is idle in the
+    # pool or its borrower is busy elsewhere. Only Redis is used here, and the lock keeps
+    # a connection being disconnected from getting its lease back.
+    with _lease_lock:
+        if id(ib) not in _lease_timers:
+            return
+
+        if not _refresh_lease(ib.client.clientId):
+            logger.warning(f"Lost the lease of IB clientId {ib.client.clientId} while open")
+        _schedule_lease(ib)
+
+
+def _keep_lease(ib: IB):
+    # Until the connection is disconnected, an idle socket keeps its clientId at IB
+    with _lease_lock:
+        if id(ib) not in _lease_timers:
+            _schedule_lease(ib)
+
+
+def _drop_lease_timer(ib: IB):
+    with _lease_lock:
+        timer = _lease_timers.pop(id(ib), None)
+
+    if timer is not None:
+        timer.cancel()
+
+
+def _subscriptions(ib: IB) -> List[Ticker]:
+    # Streaming market data only, the snapshot tickers stay in ib.tickers() once answered.
+    # The simulator only keeps the subscriptions there.
+    wrapper = getattr(ib, "wrapper", None)
+    if wrapper is None:
+        return ib.tickers()
+
+    return list(wrapper.ticker2ReqId["mktData"])
+
+
+def _reset(ib: IB):
+    # What the borrower left on the connection would go on ticking for the next one
+    for ticker in _subscriptions(ib):
+        # Through market_data_service, it must not take the contract as still held
+        market_data_service.unsubscribe(ib, ticker.contract.conId)
+
+        if any(held is ticker for held in _subscriptions(ib)):
+            ib.cancelMktData(ticker.contract)
+
+    for bars in ib.realtimeBars():
+        if isinstance(bars, BarDataList):
+            ib.cancelHistoricalData(bars)
+        else:
+            ib.cancelRealTimeBars(bars)
+
+    for event in TASK_EVENTS:
+        getattr(ib, event).clear()
+    ib.errorEvent -= market_data_service.on_error
+
+
+def _release(ib: IB, pooled: bool):
+    if pooled and ib.isConnected() and len(_idle) < POOL_SIZE:
+        try:
+            _reset(ib)
+        except Exception as e:
+            logger.warning(f"Could not reset IB clientId {ib.client.clientId}: {str(e)}")
+        else:
+            _idle.append(ib)
+            return
+
+    _disconnect(ib)
+
+
+def close_pool():
+    while _idle:
+        _disconnect(_idle.pop())
+
+
+@contextmanager
+def connect_to_ib(clientId: int = None):
+    # Connections are borrowed from the process pool and only opened on a miss, and go
+    # back to it without the borrower's subscriptions and handlers. Passing a clientId
+    # opts out of the pool and gives a dedicated connection.
+    start = time.perf_counter()
+    ib = _acquire(clientId)
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    logger.debug(f"Acquired IB clientId {ib.client.clientId} in {latency_ms:.1f} ms")
+    try:
+        _record_acquire_latency(latency_ms)
+    except Exception as e:
+        logger.warning(f"Could not record IB acquire latency: {str(e)}")
+
+    if clientId is None:
+        _keep_lease(ib)
+
     try:
         yield ib
-    finally:
-        if connected:
-            logger.info(f"Disconnecting clientId {clientId}")
-            try:
-                ib.disconnect()
-            except:
-                pass
+    except BaseException:
+        # The block may have failed mid-request, the connection is not handed over
+        _release(ib, False)
+        raise
+    else:
+        _release(ib, clientId is None)
+
 
 def handle_disconnect(ib, clientId):
     logger.warning(f"Disconnected from IB Gateway (clientId: {clientId}). Attempting to reconnect...")
     max_reconnect_attempts = 100
-    reconnect_delay = 5  
-    
+    reconnect_delay = 5
+
     for attempt in range(max_reconnect_attempts):
         try:
             if not ib.isConnected():
-                ib.connect(
-                    os.getenv("IB_GATEWAY_IP", "127.0.0.1"),
-                    os.getenv("IB_GATEWAY_PORT", 4002),
-                    clientId=clientId
-                )
+                ib.connect(IB_HOST, IB_PORT, clientId=clientId)
                 logger.info(f"Successfully reconnected to IB Gateway (clientId: {clientId})")
                 return
         except Exception as e:
             logger.error(f"Reconnection attempt {attempt + 1} failed: {str(e)}")
             time.sleep(reconnect_delay)
-    
+
     logger.critical(f"Failed to reconnect after {max_reconnect_attempts} attempts")
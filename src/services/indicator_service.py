@@ -0,0 +1,451 @@
+from sqlalchemy import DateTime, Float, Integer, Update, cast, column, tuple_, update, values
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+import json
+import numpy as np
+import polars as pl
+import pytz
+from src.models.models import PriceBar
+from src.services import cache, prices_service
+
+# The trend of get_trend: the 144 EMA of a 60 bars RSI (5 hours of 5 min bars), bullish
+# above 45
+RSI_WINDOW = 12 * 5
+RSI_EMA_SPAN = 144
+RSI_EMA_THRESHOLD = 45
+
+# Recursive state of the indicators of each series, so every bar is only read once
+STATE_KEY = "indicator_state"
+# Bars written back per statement, a first run writes the whole history
+WRITE_BATCH_SIZE = 5000
+
+
+def state_key(contract_id: int, data_type: str, bar_size: int) -> str:
+    return f"{STATE_KEY}:{contract_id}:{data_type}:{bar_size}"
+
+
+def new_state() -> dict:
+    return {
+        "date": None,  # Last bar folded in, naive UTC
+        "close": None,
+        "gains": [],  # Gains and losses of the last RSI_WINDOW bars
+        "losses": [],
+        "ema": None,  # pandas ewm(adjust=False) running average and weight
+        "ema_weight": 1.0,
+    }
+
+
+def reset_state(contract_id: int, data_type: str, bar_size: int):
+    """
+    Forget the state of a series whose past bars changed (backfill, bulk load), its
+    indicators are computed again from the first bar on the next update.
+    """
+    cache.r.delete(state_key(contract_id, data_type, bar_size))
+
+
+def _rolling_mean(values: np.ndarray, n: int, window: int = RSI_WINDOW) -> np.ndarray:
+    # Mean of the `window` values ending at each of the last n, NaN while incomplete
+    means = np.full(n, np.nan)
+
+    if len(values) >= window and n:
+        windows = sliding_window_view(values, window).mean(axis=1)
+        filled = min(n, len(windows))
+        means[n - filled :] = windows[-filled:]
+
+    return means
+
+
+def advance_rsi_ema(closes: np.ndarray, state: dict) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Advance the RSI, its EMA and the trend over new closes.
+
+    The values are the ones of the pandas computation over the whole history, the
+    rolling(RSI_WINDOW).mean() of the gains and losses and their ewm(span=RSI_EMA_SPAN,
+    adjust=False), at the cost of the new closes only.
+
+    :return: rsi, rsi_ema and trend of each close, and the state after the last one.
+    """
+    n = len(closes)
+    if not n:
+        return {"rsi": closes, "rsi_ema": closes, "trend": closes.astype(int)}, state
+
+    # The first bar has no change, pandas counts it as a 0 gain and loss
+    previous = closes[:1] if state["close"] is None else np.array([state["close"]])
+    deltas = np.diff(np.concatenate((previous, closes)))
+
+    gains = np.concatenate((state["gains"], np.where(deltas > 0, deltas, 0.0)))
+    losses = np.concatenate((state["losses"], np.where(deltas < 0, -deltas, 0.0)))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = 100 - 100 / (1 + _rolling_mean(gains, n) / _rolling_mean(losses, n))
+
+    # The EMA is recursive, as in pandas' ewm: a missing RSI only decays the weight of
+    # the running average
+    alpha = 2 / (RSI_EMA_SPAN + 1)
+    ema, weight = state["ema"], state["ema_weight"]
+    rsi_ema = np.empty(n)
+
+    for i, value in enumerate(rsi.tolist()):
+        if ema is None:
+            if value == value:
+                ema = value
+        else:
+            weight *= 1 - alpha
+            if value == value:
+                if ema != value:
+                    ema = (weight * ema + alpha * value) / (weight + alpha)
+                weight = 1.0
+
+        rsi_ema[i] = np.nan if ema is None else ema
+
+    state = {
+        "date": state["date"],
+        "close": float(closes[-1]),
+        "gains": gains[-RSI_WINDOW:].tolist(),
+        "losses": losses[-RSI_WINDOW:].tolist(),
+        "ema": ema,
+        "ema_weight": weight,
+    }
+
+    return {"rsi": rsi, "rsi_ema": rsi_ema, "trend": (rsi_ema > RSI_EMA_THRESHOLD).astype(int)}, state
+
+
+def update_trend(
+    db: Session, contract_id: int, data_type: str, bar_size: int
+) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Fold the bars stored since the last update into the persisted state of the series.
+
+    The first update reads the whole history, the next ones the new bars only. The
+    caller saves the state returned with save_state.
+
+    :return: date (naive UTC datetime64[us]), rsi, rsi_ema and trend of the new bars, and
+        the state after them.
+    """
+    state = cache.get(state_key(contract_id, data_type, bar_size)) or new_state()
+
+    start = None
+    if state["date"] is not None:
+        start = (np.datetime64(state["date"]) + np.timedelta64(1, "us")).item()
+        start = start.replace(tzinfo=pytz.utc)
+
+    columns = prices_service.get_bar_columns(db, contract_id, data_type, bar_size, start=start)
+    values, state = advance_rsi_ema(columns["close"], state)
+
+    if len(columns["date"]):
+        state["date"] = str(columns["date"][-1])
+
+    return {"date": columns["date"], **values}, state
+
+
+def save_state(contract_id: int, data_type: str, bar_size: int, state: dict):
+    # Once the values of the new bars are stored, or they would never be written
+    cache.set(state_key(contract_id, data_type, bar_size), json.dumps(state))
+
+
+def trend_update_statement(
+    contract_id: int, data_type: str, bar_size: int, batch: List[tuple]
+) -> Update:
+    """
+    Build the UPDATE ... FROM (VALUES ...) writing a batch of trend and RSI EMA values.
+
+    :param batch: (date, trend, rsi_ema) rows, sorted by date.
+    """
+    new_values = values(
+        column("date", DateTime(timezone=True)),
+        column("trend", Integer),
+        column("rsi_ema", Float),
+        name="new_values",
+    ).data(batch)
+    # A column of NULLs only, during the warm-up of the RSI, would be text
+    trend = cast(new_values.c.trend, Integer)
+    rsi_ema = cast(new_values.c.rsi_ema, Float)
+
+    return (
+        update(PriceBar)
+        .where(
+            PriceBar.contract_id == contract_id,
+            PriceBar.data_type == data_type,
+            PriceBar.bar_size == bar_size,
+            # Only the partitions of the batch are scanned
+            PriceBar.date.between(batch[0][0], batch[-1][0]),
+            PriceBar.date == new_values.c.date,
+            tuple_(PriceBar.trend, PriceBar.rsi_ema).is_distinct_from(
+                tuple_(trend, rsi_ema)
+            ),
+        )
+        .values(trend=trend, rsi_ema=rsi_ema)
+    )
+
+
+def write_trend(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    indicators: Dict[str, np.ndarray],
+) -> int:
+    """
+    Write the trend and RSI EMA of bars with one UPDATE ... FROM (VALUES ...) per batch.
+
+    The bars whose values did not change are not touched. The caller commits.
+
+    :param indicators: date, trend and rsi_ema arrays, as returned by update_trend.
+    :return: The number of bars updated.
+    """
+    rows = [
+        (to_datetime(date), int(trend), None if rsi_ema != rsi_ema else float(rsi_ema))
+        for date, trend, rsi_ema in zip(
+            indicators["date"], indicators["trend"].tolist(), indicators["rsi_ema"].tolist()
+        )
+    ]
+    updated = 0
+
+    for start in range(0, len(rows), WRITE_BATCH_SIZE):
+        updated += db.execute(
+            trend_update_statement(
+                contract_id, data_type, bar_size, rows[start : start + WRITE_BATCH_SIZE]
+            ),
+            execution_options={"synchronize_session": False},
+        ).rowcount
+
+    return updated
+
+
+def latest_trend(state: dict) -> Tuple[float, int]:
+    """
+    :return: The RSI EMA and the trend after the last bar of a state.
+    """
+    rsi_ema = float("nan") if state["ema"] is None else state["ema"]
+    return rsi_ema, int(rsi_ema > RSI_EMA_THRESHOLD)
+
+
+def to_datetime(value: np.datetime64) -> datetime:
+    return value.astype("datetime64[us]").item().replace(tzinfo=pytz.utc)
+
+
+# Indicators computed over bar columns: declared once, read by the API, research and
+# the live tasks. A kernel is a vectorized function of the OHLCV columns.
+class Indicator(NamedTuple):
+    kernel: Callable[..., Union[np.ndarray, Dict[str, np.ndarray]]]
+    # Bars before the first value, or for a recursive one before it is close to its value
+    # over the whole history
+    warm_up: int
+    params: dict
+
+
+INDICATORS: Dict[str, Indicator] = {}
+
+
+def register(name: str, warm_up: int, **params):
+    """
+    Declare a kernel as the indicator `name`, with the params it is called with.
+
+    A kernel can be registered under several names with different params. It returns an
+    array, or a dict of arrays named f"{name}_{key}", the "" key being named `name`.
+    """
+
+    def decorator(kernel):
+        INDICATORS[name] = Indicator(kernel, warm_up, params)
+        return kernel
+
+    return decorator
+
+
+def warm_up(names: Iterable[str]) -> int:
+    return max((INDICATORS[name].warm_up for name in names), default=0)
+
+
+def compute(
+    columns: Dict[str, np.ndarray], names: Optional[Iterable[str]] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Compute indicators over bar columns, every kernel reads the same contiguous arrays.
+
+    :param columns: date (naive UTC datetime64[us], sorted), open, high, low, close and
+        volume arrays, as returned by prices_service.get_bar_columns or
+        shared_bars_service.get_recent_bars.
+    :param names: Registered indicators, all of them by default.
+    :return: The arrays of the indicators, aligned on the bars.
+    """
+    columns = {
+        column: np.ascontiguousarray(
+            values, dtype=values.dtype if column == "date" else np.float64
+        )
+        for column, values in columns.items()
+    }
+    results = {}
+
+    for name in INDICATORS if names is None else names:
+        indicator = INDICATORS[name]
+        outputs = indicator.kernel(columns, **indicator.params)
+
+        if isinstance(outputs, dict):
+            results.update(
+                {f"{name}_{key}" if key else name: values for key, values in outputs.items()}
+            )
+        else:
+            results[name] = outputs
+
+    return results
+
+
+def get_indicators(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    names: Optional[Iterable[str]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Compute indicators over a range of bars for research, the bars are read once for all
+    of them, with their warm-up before start.
+
+    :return: The date of the bars from start on, and the arrays of the indicators.
+    """
+    names = list(INDICATORS if names is None else names)
+    read_from = start
+
+    if start is not None:
+        # Sessions are 6.5 hours, 5 in 7 days, and a few holidays
+        days = warm_up(names) * bar_size / (6.5 * 60) * 7 / 5 + 7
+        read_from = start - timedelta(days=days)
+
+    columns = prices_service.get_bar_columns(
+        db, contract_id, data_type, bar_size, read_from, end
+    )
+    values = {"date": columns["date"], **compute(columns, names)}
+
+    if start is None:
+        return values
+
+    kept = columns["date"] >= np.datetime64(start.astimezone(pytz.utc).replace(tzinfo=None), "us")
+    return {name: array[kept] for name, array in values.items()}
+
+
+def get_recent_indicators(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    names: Optional[Iterable[str]] = None,
+    n: int = 500,
+) -> Dict[str, np.ndarray]:
+    """
+    Compute indicators over the last n bars, read with their warm-up in one query.
+
+    The API runs apart from the workers, their shared memory is not reachable from it.
+
+    :return: The date of the last n bars, and the arrays of the indicators.
+    """
+    names = list(INDICATORS if names is None else names)
+    columns = prices_service.get_bar_columns(
+        db, contract_id, data_type, bar_size, limit=n + warm_up(names)
+    )
+    values = {"date": columns["date"], **compute(columns, names)}
+
+    return {name: array[-n:] for name, array in values.items()}
+
+
+def _ema(values: np.ndarray, span: int) -> np.ndarray:
+    # pandas' ewm(span, adjust=False).mean() of values without gaps. The recursion is
+    # unrolled by blocks: y[k] = d^(k+1) * y[-1] + a * sum(d^(k-j) * x[j]), the blocks
+    # short enough for d^-k to stay finite.
+    alpha = 2 / (span + 1)
+    decay = 1 - alpha
+    block = max(1, int(-50 / np.log(decay)))
+    ema = np.empty(len(values))
+    previous = values[0] if len(values) else np.nan
+
+    for start in range(0, len(values), block):
+        chunk = values[start : start + block]
+        powers = decay ** np.arange(len(chunk))
+        ema[start : start + len(chunk)] = (
+            decay * powers * previous + alpha * powers * np.cumsum(chunk / powers)
+        )
+        previous = ema[start + len(chunk) - 1]
+
+    return ema
+
+
+def _rsi(closes: np.ndarray, window: int) -> np.ndarray:
+    # The RSI of get_trend and the notebook, from rolling means of the gains and losses
+    deltas = np.diff(closes, prepend=closes[:1])
+    gains = np.where(deltas > 0, deltas, 0.0)
+    losses = np.where(deltas < 0, -deltas, 0.0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return 100 - 100 / (
+            1 + _rolling_mean(gains, len(closes), window) / _rolling_mean(losses, len(closes), window)
+        )
+
+
+@register("ema_5", 3 * 5, span=5)
+@register("ema_20", 3 * 20, span=20)
+def ema(columns: Dict[str, np.ndarray], span: int) -> np.ndarray:
+    return _ema(columns["close"], span)
+
+
+@register("rsi_14", 14, window=14)
+def rsi(columns: Dict[str, np.ndarray], window: int) -> np.ndarray:
+    return _rsi(columns["close"], window)
+
+
+@register("trend", RSI_WINDOW + 3 * RSI_EMA_SPAN)
+def trend(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # The same computation as get_trend, from the first bar given
+    values, _ = advance_rsi_ema(columns["close"], new_state())
+    return {"": values["trend"], "rsi": values["rsi"], "rsi_ema": values["rsi_ema"]}
+
+
+@register("atr_14", 14, window=14)
+def atr(columns: Dict[str, np.ndarray], window: int) -> np.ndarray:
+    # Rolling mean of the true range, the first bar has no previous close
+    previous_close = np.concatenate((columns["close"][:1], columns["close"][:-1]))
+    true_range = np.maximum(columns["high"], previous_close) - np.minimum(
+        columns["low"], previous_close
+    )
+    return _rolling_mean(true_range, len(true_range), window)
+
+
+@register("vwap", 0)
+def vwap(columns: Dict[str, np.ndarray]) -> np.ndarray:
+    # Volume weighted typical price since the start of the bar's New York day
+    days = (
+        pl.Series(columns["date"])
+        .dt.replace_time_zone("UTC")
+        .dt.convert_time_zone("America/New_York")
+        .dt.date()
+        .to_numpy()
+    )
+    firsts = np.flatnonzero(np.concatenate(([True], days[1:] != days[:-1])))
+    day_start = np.repeat(firsts, np.diff(np.concatenate((firsts, [len(days)]))))
+
+    typical = (columns["high"] + columns["low"] + columns["close"]) / 3
+    traded = np.cumsum(typical * columns["volume"])
+    volume = np.cumsum(columns["volume"])
+    # Totals of the previous days, taken off the running sums
+    before = day_start - 1
+    traded = traded - np.where(before >= 0, traded[before], 0)
+    volume = volume - np.where(before >= 0, volume[before], 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return traded / volume
+
+
+@register("bollinger_20", 20, window=20, width=2)
+def bollinger(columns: Dict[str, np.ndarray], window: int, width: float) -> Dict[str, np.ndarray]:
+    closes = columns["close"]
+    middle = np.full(len(closes), np.nan)
+    deviation = np.full(len(closes), np.nan)
+
+    if len(closes) >= window:
+        windows = sliding_window_view(closes, window)
+        middle[window - 1 :] = windows.mean(axis=1)
+        deviation[window - 1 :] = windows.std(axis=1, ddof=1)
+
+    return {"": middle, "upper": middle + width * deviation, "lower": middle - width * deviation}
@@ -0,0 +1,352 @@
+from ib_insync import IB, Contract, Ticker, util
+import asyncio
+import json
+import math
+import time
+import pandas as pd
+from datetime import datetime
+from typing import Dict, List, Optional
+from src.logging_config import logger
+from src.services import cache
+
+# Snapshots are published as Redis hashes so every worker reads the same quote
+QUOTE_KEY = "quote"
+QUOTE_TTL = 60 * 5
+# Seconds after which a snapshot is not considered fresh. A quiet contract can go much
+# longer without a tick, the age is counted from the last time its subscription was
+# confirmed alive.
+QUOTE_MAX_AGE = 5
+ALIVE_REFRESH = 1  # How often the broker confirms its subscriptions are alive
+QUOTE_FIELDS = ["last", "bid", "ask", "volume"]
+
+# conId -> contract fields of the subscriptions held by the broker process
+SUBSCRIPTIONS_KEY = "quote_subscriptions"
+SUBSCRIPTION_IDLE = 60 * 30  # Subscriptions not requested for this long are cancelled
+SUBSCRIPTION_RETRY_SECONDS = 60
+BROKER_ALIVE_KEY = "ib_gateway_up"
+# Errors ending a market data subscription: no permission, competing session, unknown contract
+SUBSCRIPTION_ERRORS = {200, 354, 10089, 10090, 10168, 10197}
+
+# Process local state: latest snapshot per conId and the streaming tickers we own
+_snapshots: Dict[int, dict] = {}
+_tickers: Dict[int, Ticker] = {}
+_requested_at: Dict[int, float] = {}
+_failed_at: Dict[int, float] = {}
+_confirmed_at = 0.0
+
+
+def _valid(value) -> Optional[float]:
+    # IB sends nan/-1 when a side of the book is empty
+    if value is None or math.isnan(value) or value < 0:
+        return None
+
+    return float(value)
+
+
+def snapshot_from_ticker(ticker: Ticker) -> dict:
+    snapshot = {field: _valid(getattr(ticker, field)) for field in QUOTE_FIELDS}
+    snapshot["time"] = ticker.time.timestamp() if ticker.time else time.time()
+    # A tick proves the subscription alive
+    snapshot["alive"] = time.time()
+
+    return snapshot
+
+
+def _fresh(snapshot: Optional[dict], now: float) -> bool:
+    # Snapshots published before "alive" existed only have the time of their last tick
+    return bool(snapshot) and now - snapshot.get("alive", snapshot["time"]) < QUOTE_MAX_AGE
+
+
+def publish_ticker(ticker: Ticker, pipe=None):
+    conId = ticker.contract.conId
+    snapshot = snapshot_from_ticker(ticker)
+
+    # We keep the last known value of a field when the tick only updated the others
+    previous = _snapshots.get(conId, {})
+    for field in QUOTE_FIELDS:
+        if snapshot[field] is None and previous.get(field) is not None:
+            snapshot[field] = previous[field]
+
+    _snapshots[conId] = snapshot
+
+    key = f"{QUOTE_KEY}:{conId}"
+    execute = pipe is None
+    pipe = pipe if pipe is not None else cache.r.pipeline()
+    pipe.hset(
+        key,
+        mapping={k: json.dumps(v) for k, v in snapshot.items()},
+    )
+    pipe.expire(key, QUOTE_TTL)
+
+    if execute:
+        pipe.execute()
+
+
+def on_pending_tickers(tickers):
+    for ticker in tickers:
+        if ticker.contract and ticker.contract.conId:
+            publish_ticker(ticker)
+
+
+def _parse_snapshot(raw: dict) -> Optional[dict]:
+    if not raw:
+        return None
+
+    snapshot = {k.decode("utf-8"): json.loads(v) for k, v in raw.items()}
+    if not _fresh(snapshot, time.time()):
+        return None
+
+    return snapshot
+
+
+def read_snapshot(conId: int) -> Optional[dict]:
+    snapshot = _snapshots.get(conId)
+    if _fresh(snapshot, time.time()):
+        return snapshot
+
+    return _parse_snapshot(cache.r.hgetall(f"{QUOTE_KEY}:{conId}"))
+
+
+def read_snapshots(conIds: List[int]) -> Dict[int, dict]:
+    """
+    Read the fresh snapshots of many contracts, with one Redis round-trip for those not in memory.
+    """
+    now = time.time()
+    snapshots = {}
+    missing = []
+
+    for conId in conIds:
+        snapshot = _snapshots.get(conId)
+        if _fresh(snapshot, now):
+            snapshots[conId] = snapshot
+        else:
+            missing.append(conId)
+
+    if missing:
+        pipe = cache.r.pipeline()
+        for conId in missing:
+            pipe.hgetall(f"{QUOTE_KEY}:{conId}")
+
+        for conId, raw in zip(missing, pipe.execute()):
+            snapshot = _parse_snapshot(raw)
+            if snapshot:
+                snapshots[conId] = snapshot
+
+    return snapshots
+
+
+def request_subscription(contract: Contract):
+    """
+    Ask the broker process to keep a streaming subscription for the contract.
+
+    :param contract: A qualified contract (with a conId).
+    """
+    now = time.time()
+
+    # We only refresh the request once a minute to keep the hot path cheap
+    if now - _requested_at.get(contract.conId, 0) < 60:
+        return
+
+    _requested_at[contract.conId] = now
+    cache.r.hset(
+        SUBSCRIPTIONS_KEY,
+        contract.conId,
+        json.dumps(
+            {"contract": util.dataclassNonDefaults(contract), "requested_at": now}
+        ),
+    )
+
+
+def subscribe(ib: IB, contract: Contract) -> Ticker:
+    """
+    Hold one streaming subscription for the contract on this process' connection.
+    """
+    ticker = _tickers.get(contract.conId)
+
+    if ticker is not None and ib.ticker(ticker.contract) is ticker:
+        return ticker
+
+    if on_pending_tickers not in ib.pendingTickersEvent:
+        ib.pendingTickersEvent += on_pending_tickers
+
+    ticker = ib.reqMktData(contract, "", False, False)
+    _tickers[contract.conId] = ticker
+
+    return ticker
+
+
+def unsubscribe(ib: IB, conId: int):
+    ticker = _tickers.pop(conId, None)
+    _snapshots.pop(conId, None)
+
+    if ticker is not None and ib.isConnected():
+        ib.cancelMktData(ticker.contract)
+
+
+def on_error(reqId: int, errorCode: int, errorString: str, contract: Contract):
+    # The subscription is dead, it must not be confirmed alive. It is retried later.
+    if errorCode in SUBSCRIPTION_ERRORS and contract and contract.conId in _tickers:
+        logger.warning(f"Market data of conId {contract.conId} ended: {errorString}")
+        _tickers.pop(contract.conId, None)
+        _snapshots.pop(contract.conId, None)
+        _failed_at[contract.conId] = time.time()
+
+
+def confirm_alive(ib: IB):
+    """
+    Run by the broker process: mark the snapshots of its live subscriptions as fresh,
+    ticks or not.
+    """
+    global _confirmed_at
+
+    now = time.time()
+    if now - _confirmed_at < ALIVE_REFRESH or not ib.isConnected():
+        return
+    _confirmed_at = now
+
+    pipe = cache.r.pipeline()
+
+    # Only the contracts that ticked once have a snapshot to serve
+    for conId in _tickers:
+        if conId in _snapshots:
+            _snapshots[conId]["alive"] = now
+            pipe.hset(f"{QUOTE_KEY}:{conId}", "alive", json.dumps(now))
+            pipe.expire(f"{QUOTE_KEY}:{conId}", QUOTE_TTL)
+
+    pipe.execute()
+
+
+def sync_subscriptions(ib: IB):
+    """
+    Run by the broker process: subscribe to the requested contracts and drop the idle or expired ones.
+    """
+    now = time.time()
+    today = datetime.now().strftime("%Y%m%d")
+    wanted = set()
+
+    for conId, raw in cache.r.hgetall(SUBSCRIPTIONS_KEY).items():
+        conId = int(conId)
+        request = json.loads(raw)
+        contract = Contract.create(**request["contract"])
+
+        expiry = contract.lastTradeDateOrContractMonth
+        if now - request["requested_at"] > SUBSCRIPTION_IDLE or (expiry and expiry < today):
+            cache.r.hdel(SUBSCRIPTIONS_KEY, conId)
+            continue
+
+        wanted.add(conId)
+        if now - _failed_at.get(conId, 0) >= SUBSCRIPTION_RETRY_SECONDS:
+            if on_error not in ib.errorEvent:
+                ib.errorEvent += on_error
+            subscribe(ib, contract)
+
+    for conId in list(_tickers):
+        if conId not in wanted:
+            logger.info(f"Cancelling market data for conId {conId}")
+            unsubscribe(ib, conId)
+
+    confirm_alive(ib)
+
+
+def get_quote(ib: IB, contract: Contract, timeout: float = 2) -> dict:
+    """
+    Get the latest last/bid/ask snapshot of a contract.
+
+    The snapshot is read from memory or Redis when fresh. On a miss the broker is asked
+    to stream the contract. If it does not answer in time the contract is subscribed on
+    this connection until a first tick, then left to the broker.
+
+    :param ib: The connection used when the quote has to be requested.
+    :param contract: The contract to quote.
+    :param timeout: Maximum time in seconds to wait for a first tick.
+    :return: A dict with last, bid, ask, volume (None when unknown) and time.
+    """
+    if not contract.conId:
+        ib.qualifyContracts(contract)
+
+    snapshot = read_snapshot(contract.conId)
+    if snapshot:
+        return snapshot
+
+    request_subscription(contract)
+
+    if cache.r.exists(BROKER_ALIVE_KEY):
+        deadline = time.time() + timeout
+
+        while time.time() < deadline:
+            ib.sleep(0.05)
+            snapshot = read_snapshot(contract.conId)
+
+            if snapshot:
+                return snapshot
+
+        logger.warning(f"No quote from the broker for conId {contract.conId}")
+
+    # The broker is not streaming it yet, we subscribe on our own connection. The pooled
+    # connection goes to other tasks, the subscription does not stay with it.
+    ticker = subscribe(ib, contract)
+    deadline = time.time() + timeout
+
+    try:
+        while time.time() < deadline:
+            if (
+                ticker.time
+                and time.time() - ticker.time.timestamp() < QUOTE_MAX_AGE
+                and any(_valid(getattr(ticker, f)) is not None for f in ["last", "bid", "ask"])
+            ):
+                publish_ticker(ticker)
+                return _snapshots[contract.conId]
+
+            ib.waitOnUpdate(timeout=max(deadline - time.time(), 0.01))
+
+        # Nothing arrived, we return the empty snapshot without publishing it
+        return snapshot_from_ticker(ticker)
+
+    finally:
+        unsubscribe(ib, contract.conId)
+
+
+def get_quotes(ib: IB, contracts: List[Contract], timeout: float = 11) -> pd.DataFrame:
+    """
+    Quote a whole set of contracts (an option ladder) with a single network wait.
+
+    Fresh snapshots are read from memory and Redis, all the others are requested together
+    as snapshot market data (reqTickers) and published for the other workers.
+
+    :param ib: The connection used for the snapshot requests.
+    :param contracts: Qualified contracts (with a conId).
+    :param timeout: Maximum time in seconds to wait for the snapshots, IB ends them after 11s.
+    :return: One row per contract, in the given order, with conId, last, bid, ask, volume
+        (NaN when unknown) and time.
+    """
+    snapshots = read_snapshots([contract.conId for contract in contracts])
+    missing = [contract for contract in contracts if contract.conId not in snapshots]
+
+    if missing:
+        try:
+            ib.run(asyncio.wait_for(ib.reqTickersAsync(*missing), timeout))
+        except asyncio.TimeoutError:
+            logger.warning(f"Snapshot quotes timed out for {len(missing)} contracts")
+
+        pipe = cache.r.pipeline()
+
+        for contract in missing:
+            ticker = ib.ticker(contract)
+
+            if ticker is None or not any(
+                _valid(getattr(ticker, f)) is not None for f in ["last", "bid", "ask"]
+            ):
+                continue
+
+            publish_ticker(ticker, pipe)
+            snapshots[contract.conId] = _snapshots[contract.conId]
+
+        pipe.execute()
+
+    return pd.DataFrame(
+        [
+            {"conId": contract.conId, **snapshots.get(contract.conId, {})}
+            for contract in contracts
+        ],
+        columns=["conId", *QUOTE_FIELDS, "time"],
+    ).astype({field: float for field in QUOTE_FIELDS})
@@ -0,0 +1,200 @@
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    start_http_server,
+    multiprocess,
+)
+from ib_insync import IB, Contract, util
+import functools
+import os
+import time
+from contextlib import contextmanager
+from typing import Optional
+from src.logging_config import logger
+
+# Celery prefork workers need PROMETHEUS_MULTIPROC_DIR so the parent can export
+# the metrics of all its children
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# A reqMktData without a tick after that many seconds counts as failed
+FIRST_TICK_TIMEOUT = 10
+
+IB_REQUEST_SECONDS = Histogram(
+    "ib_request_seconds",
+    "Latency of IB API calls",
+    ["call", "contract_type", "data_type", "bar_size"],
+    buckets=LATENCY_BUCKETS,
+)
+IB_REQUEST_FAILURES = Counter(
+    "ib_request_failures_total",
+    "IB API calls that raised or returned nothing",
+    ["call", "contract_type", "data_type", "bar_size"],
+)
+IB_ERRORS = Counter(
+    "ib_errors_total",
+    "Errors reported by IB on the errorEvent",
+    ["error_code"],
+)
+IB_PACING_WAIT_SECONDS = Histogram(
+    "ib_pacing_wait_seconds",
+    "Time spent waiting on the historical data pacing bucket",
+    ["priority"],
+    buckets=LATENCY_BUCKETS,
+)
+TASK_STAGE_SECONDS = Histogram(
+    "task_stage_seconds",
+    "Time spent by a task in each of its stages (ib, postgres, redis)",
+    ["task", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+
+    logger.info(f"Exporting metrics on port {port}")
+
+
+def mark_process_dead(pid: int):
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid)
+
+
+@contextmanager
+def stage(task: Optional[str], stage_name: str):
+    # Without a task nothing is timed, for the services called outside the timed tasks
+    if task is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TASK_STAGE_SECONDS.labels(task, stage_name).observe(time.perf_counter() - start)
+
+
+def _contract_type(contract) -> str:
+    return contract.secType if isinstance(contract, Contract) else ""
+
+
+def _observe(call: str, contract_type: str, data_type: str, bar_size: str, start: float, ok: bool):
+    labels = (call, contract_type, data_type, bar_size)
+    IB_REQUEST_SECONDS.labels(*labels).observe(time.perf_counter() - start)
+
+    if not ok:
+        IB_REQUEST_FAILURES.labels(*labels).inc()
+
+
+def instrument_ib(ib: IB) -> IB:
+    """
+    Wrap the calls of an IB connection so their latency and failures are recorded.
+
+    reqMktData is measured up to its first tick and placeOrder up to the order ack.
+    """
+    connect = ib.connect
+    qualify_contracts = ib.qualifyContracts
+    req_historical_data_async = ib.reqHistoricalDataAsync
+    req_mkt_data = ib.reqMktData
+    place_order = ib.placeOrder
+
+    @functools.wraps(connect)
+    def timed_connect(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = connect(*args, **kwargs)
+        except Exception:
+            _observe("connect", "", "", "", start, False)
+            raise
+
+        _observe("connect", "", "", "", start, True)
+        return result
+
+    @functools.wraps(qualify_contracts)
+    def timed_qualify_contracts(*contracts):
+        start = time.perf_counter()
+        contract_type = _contract_type(contracts[0]) if contracts else ""
+        try:
+            result = qualify_contracts(*contracts)
+        except Exception:
+            _observe("qualifyContracts", contract_type, "", "", start, False)
+            raise
+
+        _observe("qualifyContracts", contract_type, "", "", start, len(result) == len(contracts))
+        return result
+
+    @functools.wraps(req_historical_data_async)
+    async def timed_req_historical_data_async(contract, *args, **kwargs):
+        start = time.perf_counter()
+        labels = (
+            _contract_type(contract),
+            kwargs.get("whatToShow", ""),
+            kwargs.get("barSizeSetting", ""),
+        )
+        try:
+            result = await req_historical_data_async(contract, *args, **kwargs)
+        except Exception:
+            _observe("reqHistoricalData", *labels, start, False)
+            raise
+
+        _observe("reqHistoricalData", *labels, start, bool(result))
+        return result
+
+    @functools.wraps(req_mkt_data)
+    def timed_req_mkt_data(contract, *args, **kwargs):
+        start = time.perf_counter()
+        ticker = req_mkt_data(contract, *args, **kwargs)
+
+        if ticker.time is None:
+
+            def on_first_tick(ticker):
+                ticker.updateEvent -= on_first_tick
+                timeout.cancel()
+                _observe("reqMktData", _contract_type(contract), "", "", start, True)
+
+            def on_timeout():
+                # No tick came, the handler would stay on the ticker for good
+                if on_first_tick in ticker.updateEvent:
+                    ticker.updateEvent -= on_first_tick
+                    _observe("reqMktData", _contract_type(contract), "", "", start, False)
+
+            ticker.updateEvent += on_first_tick
+            timeout = util.getLoop().call_later(FIRST_TICK_TIMEOUT, on_timeout)
+
+        return ticker
+
+    @functools.wraps(place_order)
+    def timed_place_order(contract, order):
+        start = time.perf_counter()
+        trade = place_order(contract, order)
+
+        def on_status(trade):
+            if trade.orderStatus.status in ["PreSubmitted", "Submitted", "Filled"]:
+                trade.statusEvent -= on_status
+                _observe("placeOrder", _contract_type(contract), "", "", start, True)
+            elif trade.orderStatus.status in ["Cancelled", "ApiCancelled", "Inactive"]:
+                trade.statusEvent -= on_status
+                _observe("placeOrder", _contract_type(contract), "", "", start, False)
+
+        trade.statusEvent += on_status
+
+        return trade
+
+    def on_error(reqId, errorCode, errorString, contract):
+        IB_ERRORS.labels(str(errorCode)).inc()
+
+    ib.connect = timed_connect
+    ib.qualifyContracts = timed_qualify_contracts
+    ib.reqHistoricalDataAsync = timed_req_historical_data_async
+    ib.reqMktData = timed_req_mkt_data
+    ib.placeOrder = timed_place_order
+    ib.errorEvent += on_error
+
+    return ib
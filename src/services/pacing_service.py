@@ -0,0 +1,302 @@
+from ib_insync import IB, Contract, BarData, BarDataList, util
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import time
+from datetime import date, datetime
+from typing import Dict, Optional
+from src.logging_config import logger
+from src.services import cache, metrics_service
+
+# Priority classes, a lower value is served first
+PRIORITY_LIVE = 0  # Live strategy refreshes (stream_spx_trades, stream_strat_2)
+PRIORITY_ORDER = 1  # Data needed to place or manage an order
+PRIORITY_BACKFILL = 2  # Everything that can wait
+
+# IB allows 60 historical requests every 10 minutes, shared by all our workers
+BUCKET_KEY = "hist_pacing_bucket"
+BUCKET_CAPACITY = int(os.getenv("HIST_PACING_CAPACITY", 60))
+BUCKET_RATE = BUCKET_CAPACITY / 600  # Tokens per second
+
+# Tokens a priority class has to leave in the bucket, so a backfill can never
+# starve the live refreshes
+RESERVED_TOKENS = {
+    PRIORITY_LIVE: 0,
+    PRIORITY_ORDER: 10,
+    PRIORITY_BACKFILL: 25,
+}
+
+# Identical requests are coalesced while in flight and their response is shared
+# for 15 seconds, which is also IB's window for identical requests
+INFLIGHT_KEY = "hist_inflight"
+RESULT_KEY = "hist_result"
+INFLIGHT_TTL = 90
+RESULT_TTL = 15
+COALESCE_POLL = 0.1
+
+PACING_VIOLATION = "pacing violation"
+# Error 162 "HMDS query returned no data": IB answered, it has no bars for the range
+NO_DATA = "returned no data"
+
+_TAKE_TOKEN = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2)
+return tostring(wait)
+"""
+
+_take_token = cache.r.register_script(_TAKE_TOKEN)
+
+# Requests in flight in this process, keyed by request key
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def request_key(
+    contract: Contract,
+    whatToShow: str,
+    endDateTime: str,
+    durationStr: str,
+    barSizeSetting: str,
+    useRTH: bool,
+    formatDate: int,
+) -> str:
+    contract_key = contract.conId or util.dataclassNonDefaults(contract)
+    raw = json.dumps(
+        [
+            contract_key,
+            whatToShow,
+            str(endDateTime),
+            durationStr,
+            barSizeSetting,
+            useRTH,
+            formatDate,
+        ],
+        sort_keys=True,
+        default=str,
+    )
+
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+async def acquire_token(priority: int = PRIORITY_BACKFILL):
+    """
+    Wait until the shared bucket lets a request of this priority class through.
+    """
+    reserve = RESERVED_TOKENS[priority]
+    start = time.perf_counter()
+
+    while True:
+        wait = float(_take_token(keys=[BUCKET_KEY], args=[BUCKET_CAPACITY, BUCKET_RATE, reserve]))
+
+        if wait <= 0:
+            metrics_service.IB_PACING_WAIT_SECONDS.labels(str(priority)).observe(
+                time.perf_counter() - start
+            )
+            return
+
+        logger.info(f"Historical data pacing: priority {priority} waits {wait:.1f}s")
+        await asyncio.sleep(wait)
+
+
+def on_error(reqId: int, errorCode: int, errorString: str, contract: Contract):
+    # IB paced us anyway (another client on the account), we empty the bucket
+    if errorCode == 162 and PACING_VIOLATION in errorString.lower():
+        logger.warning(f"Historical data pacing violation: {errorString}")
+        cache.r.hset(BUCKET_KEY, "tokens", 0)
+
+
+def answered(bars: BarDataList) -> bool:
+    """
+    Whether IB answered a request: bars came back, or it has none for the range. A
+    pacing violation, a farm disconnect or a timeout also come back as an empty list.
+    """
+    return bool(bars) or any(
+        errorCode == 162 and NO_DATA in errorString.lower()
+        for errorCode, errorString in getattr(bars, "errors", [])
+    )
+
+
+async def _request(ib: IB, **kwargs) -> BarDataList:
+    # The errors of the request are kept on its bars, see answered
+    errors = []
+
+    def on_request_error(reqId: int, errorCode: int, errorString: str, contract: Contract):
+        errors.append((reqId, errorCode, errorString))
+
+    ib.errorEvent += on_request_error
+    try:
+        bars = await ib.reqHistoricalDataAsync(**kwargs)
+    finally:
+        ib.errorEvent -= on_request_error
+
+    bars.errors = [
+        (errorCode, errorString)
+        for reqId, errorCode, errorString in errors
+        if reqId == getattr(bars, "reqId", None)
+    ]
+
+    return bars
+
+
+def _dump_bars(bars: BarDataList) -> str:
+    return json.dumps(
+        [
+            {
+                **util.dataclassAsDict(bar),
+                "date": bar.date.isoformat(),
+                "is_datetime": isinstance(bar.date, datetime),
+            }
+            for bar in bars
+        ]
+    )
+
+
+def _load_bars(raw: bytes) -> BarDataList:
+    bars = BarDataList()
+
+    for bar in json.loads(raw):
+        is_datetime = bar.pop("is_datetime")
+        bar["date"] = (
+            datetime.fromisoformat(bar["date"])
+            if is_datetime
+            else date.fromisoformat(bar["date"])
+        )
+        bars.append(BarData(**bar))
+
+    return bars
+
+
+def _read_result(key: str) -> Optional[BarDataList]:
+    raw = cache.r.get(f"{RESULT_KEY}:{key}")
+
+    return _load_bars(raw) if raw else None
+
+
+async def _hold_lock(lock_key: str, owner: str):
+    # The lock is extended while its request waits for a token, a backfill can wait for
+    # longer than INFLIGHT_TTL and a peer would then make the same request
+    while True:
+        await asyncio.sleep(INFLIGHT_TTL / 3)
+
+        if cache.r.get(lock_key) != owner.encode("utf-8"):
+            return
+        cache.r.expire(lock_key, INFLIGHT_TTL)
+
+
+async def _fetch_shared(ib: IB, key: str, priority: int, **kwargs) -> BarDataList:
+    bars = _read_result(key)
+    if bars is not None:
+        return bars
+
+    lock_key = f"{INFLIGHT_KEY}:{key}"
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    # Another worker is making the same request, we wait for its response
+    while not cache.r.set(lock_key, owner, nx=True, ex=INFLIGHT_TTL):
+        await asyncio.sleep(COALESCE_POLL)
+
+        bars = _read_result(key)
+        if bars is not None:
+            return bars
+
+    holder = asyncio.ensure_future(_hold_lock(lock_key, owner))
+
+    try:
+        # The response may have landed between our last check and the lock
+        bars = _read_result(key)
+        if bars is not None:
+            return bars
+
+        await acquire_token(priority)
+        bars = await _request(ib, **kwargs)
+
+        # Errors come back as empty lists, they are not shared
+        if bars:
+            cache.r.set(f"{RESULT_KEY}:{key}", _dump_bars(bars), ex=RESULT_TTL)
+
+        return bars
+
+    finally:
+        holder.cancel()
+        if cache.r.get(lock_key) == owner.encode("utf-8"):
+            cache.r.delete(lock_key)
+
+
+async def request_historical_bars(
+    ib: IB,
+    contract: Contract,
+    whatToShow: str,
+    endDateTime: str = "",
+    durationStr: str = "1 D",
+    barSizeSetting: str = "1 min",
+    useRTH: bool = False,
+    formatDate: int = 1,
+    priority: int = PRIORITY_BACKFILL,
+) -> BarDataList:
+    """
+    Make a historical data request through the shared pacing bucket.
+
+    Identical requests in flight, in this process or in another worker, share one response.
+
+    :param priority: PRIORITY_LIVE, PRIORITY_ORDER or PRIORITY_BACKFILL.
+    :return: The bars returned by IB.
+    """
+    key = request_key(
+        contract, whatToShow, endDateTime, durationStr, barSizeSetting, useRTH, formatDate
+    )
+
+    if key in _inflight:
+        return await asyncio.shield(_inflight[key])
+
+    future = asyncio.get_event_loop().create_future()
+    _inflight[key] = future
+
+    try:
+        bars = await _fetch_shared(
+            ib,
+            key,
+            priority,
+            contract=contract,
+            endDateTime=endDateTime,
+            durationStr=durationStr,
+            barSizeSetting=barSizeSetting,
+            whatToShow=whatToShow,
+            useRTH=useRTH,
+            formatDate=formatDate,
+        )
+        future.set_result(bars)
+
+        return bars
+
+    except asyncio.CancelledError:
+        # The requests sharing it would otherwise await the future forever
+        future.cancel()
+        raise
+
+    except Exception as e:
+        future.set_exception(e)
+        # Retrieved here so nobody gets warned when no other request was waiting
+        future.exception()
+        raise
+
+    finally:
+        del _inflight[key]
@@ -0,0 +1,116 @@
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timezone
+from typing import Iterable, List, Set
+import os
+import re
+from src.logging_config import logger
+
+# price_bars is range partitioned by UTC month (see the 17a551cf5922 migration), one
+# partition per month named price_bars_yYYYYmMM
+PARTITION_NAME = re.compile(r"^price_bars_y(\d{4})m(\d{2})$")
+MONTHS_AHEAD = int(os.getenv("PRICE_BARS_MONTHS_AHEAD", 3))
+# Months of bars kept, 0 keeps everything
+RETENTION_MONTHS = int(os.getenv("PRICE_BARS_RETENTION_MONTHS", 0))
+
+# Months known to have a partition in this process, so the ingestion hot path
+# only goes to the db for a month it never wrote to
+_partitioned_months: Set[date] = set()
+
+
+# A partition created in a transaction only exists once it is committed
+@event.listens_for(Session, "after_commit")
+def _remember_partitions(session: Session):
+    _partitioned_months.update(session.info.pop("new_partitions", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_partitions(session: Session):
+    session.info.pop("new_partitions", None)
+
+
+def month_start(value: date) -> date:
+    # Partitions are UTC months, the last evening of a month in New York is in the next one
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def ensure_partitions(db: Session, dates: Iterable[date]):
+    """
+    Create the partitions of the months of these dates if they do not exist yet.
+
+    The caller commits.
+    """
+    new_partitions = db.info.setdefault("new_partitions", set())
+    months = {month_start(value) for value in dates} - _partitioned_months - new_partitions
+
+    for month in sorted(months):
+        db.execute(text("SELECT price_bars_ensure_partition(:month)"), {"month": month})
+        new_partitions.add(month)
+
+
+def create_future_partitions(db: Session, months_ahead: int = MONTHS_AHEAD):
+    this_month = month_start(datetime.utcnow().date())
+    ensure_partitions(db, [add_months(this_month, i) for i in range(months_ahead + 1)])
+    db.commit()
+
+
+def get_partitions(db: Session) -> List[tuple]:
+    """
+    :return: (partition name, month) of the partitions of price_bars, oldest first.
+    """
+    names = db.execute(
+        text(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'price_bars'
+            """
+        )
+    ).scalars()
+
+    partitions = []
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def drop_expired_partitions(db: Session, retention_months: int = RETENTION_MONTHS) -> List[str]:
+    """
+    Detach and drop the partitions entirely older than the retention.
+
+    :param retention_months: Number of months kept, the current one included. 0 keeps everything.
+    :return: The names of the dropped partitions.
+    """
+    if retention_months <= 0:
+        return []
+
+    cutoff = add_months(month_start(datetime.utcnow().date()), -(retention_months - 1))
+    dropped = []
+
+    for name, month in get_partitions(db):
+        if month >= cutoff:
+            break
+
+        # Detaching first only locks the parent briefly, the drop then only touches the partition
+        db.execute(text(f'ALTER TABLE price_bars DETACH PARTITION "{name}"'))
+        db.execute(text(f'DROP TABLE "{name}"'))
+        db.commit()
+
+        _partitioned_months.discard(month)
+        dropped.append(name)
+        logger.warning(f"Dropped expired price_bars partition {name}")
+
+    return dropped
@@ -1,51 +1,103 @@
+from sqlalchemy import Row, Select, func, literal_column, or_, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import Session
-from ib_insync import Contract, IB, BarDataList, BarData
+import asyncio
+import os
+from ib_insync import Contract, IB, BarDataList, BarData, Option
 import math
-from typing import List
+from typing import AsyncIterator, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+import polars as pl
+from src.models import models
 from src.models.models import PriceBar
 from datetime import date, datetime, timedelta
 from pytz import timezone
 from src.models import schemas
+from src.services import (
+    archive_service,
+    market_data_service,
+    metrics_service,
+    pacing_service,
+    partition_service,
+    shared_bars_service,
+)
 
 
 def get_latest_price(
     contract: Contract, ib: IB, data_type: str = "LAST", allow_hist: bool = True
 ):
-    market_data = ib.reqMktData(contract, "", False, False)
+    # The quote comes from the shared snapshot, a subscription is only made on a miss
+    quote = market_data_service.get_quote(ib, contract)
 
-    cur_iter = 0
+    price = quote[{"BID": "bid", "ASK": "ask"}.get(data_type, "last")]
 
-    while (market_data.last is None or math.isnan(market_data.last)) and cur_iter < 20:
-        ib.sleep(0.1)
-        cur_iter += 1
-
-    if cur_iter == 20:
+    if price is None:
         if allow_hist:
             # Request historical data as fallback
             data_req = "TRADES" if data_type == "LAST" else data_type
-            historical_data = ib.reqHistoricalData(
+            historical_data = get_historical_bars(
+                ib,
                 contract,
-                endDateTime="",
+                data_req,
                 durationStr="1 D",
                 barSizeSetting="15 mins",
-                whatToShow=data_req,
-                useRTH=False,
+                priority=pacing_service.PRIORITY_ORDER,
             )
             if historical_data:
                 return historical_data[-1].close  # Return last close price
 
         raise ValueError("Could not get latest price.")
 
-    if data_type == "BID":
-        return market_data.bid
+    return price
 
-    if data_type == "ASK":
-        return market_data.ask
 
-    return market_data.last
+def get_last_price(ib: IB, contract: models.Option, data_type: str = "LAST"):
+    ib_contract = Option(
+        symbol=contract.symbol,
+        lastTradeDateOrContractMonth=contract.lastTradeDateOrContractMonth.strftime(
+            "%Y%m%d"
+        ),
+        strike=contract.strike,
+        right=contract.right,
+        exchange=contract.exchange,
+        currency=contract.currency,
+    )
 
+    if contract.conId:
+        ib_contract.conId = contract.conId
+        ib_contract.tradingClass = contract.tradingClass or ""
+        ib_contract.multiplier = contract.multiplier or ""
 
-def get_historical_bars(
+    return get_latest_price(ib_contract, ib, data_type)
+
+
+def bar_size_setting(bar_size: int) -> str:
+    # IB only takes "1 min", "5 mins", "1 hour", "1 day"...
+    if bar_size % (24 * 60) == 0:
+        count, unit = bar_size // (24 * 60), "day"
+    elif bar_size % 60 == 0:
+        count, unit = bar_size // 60, "hour"
+    else:
+        count, unit = bar_size, "min"
+
+    return f"{count} {unit}{'s' if count > 1 else ''}"
+
+
+# Historical requests allowed in flight at once when fanning out
+MAX_CONCURRENT_HISTORICAL = int(os.getenv("MAX_CONCURRENT_HISTORICAL", 8))
+
+
+class HistoricalRequest(NamedTuple):
+    contract: Contract
+    whatToShow: str
+    durationStr: str = "1 D"
+    barSizeSetting: str = "1 min"
+    endDateTime: str = ""
+    useRTH: bool = False
+    priority: int = pacing_service.PRIORITY_BACKFILL
+
+
+async def get_historical_bars_async(
     ib: IB,
     contract: Contract,
     whatToShow: str,
@@ -54,8 +106,11 @@ def get_historical_bars(
     barSizeSetting: str = "1 min",
     useRTH: bool = False,
     formatDate: int = 1,
+    priority: int = pacing_service.PRIORITY_BACKFILL,
 ) -> BarDataList:
-    return ib.reqHistoricalData(
+    # Every request goes through the shared pacing bucket and is coalesced when identical
+    return await pacing_service.request_historical_bars(
+        ib,
         contract,
         endDateTime=endDateTime,
         durationStr=durationStr,  # Example: 1 day of data
@@ -63,51 +118,205 @@ def get_historical_bars(
         whatToShow=whatToShow,  # Request bid/ask data
         useRTH=useRTH,  # Whether to show regular trading hours data
         formatDate=formatDate,
+        priority=priority,
     )
 
 
-def check_bar_exists(
-    db: Session,
-    date: date,
-    contract_id: str,
-    contract_type: str,
-    data_type: str,
-    bar_size: int,
-) -> PriceBar:
-    return (
-        db.query(PriceBar)
-        .filter(
-            # (
-            #     PriceBar.stock_contract_id == contract_id
-            #     if contract_type == "Stock"
-            #     else None
-            # ),
-            # (
-            #     PriceBar.option_contract_id == contract_id
-            #     if contract_type == "Option"
-            #     else None
-            # ),
-            PriceBar.contract_id == contract_id,
-            # PriceBar.contract_type == contract_type,
-            PriceBar.date == date,
-            PriceBar.data_type == data_type,
-            PriceBar.bar_size == bar_size,
+def get_historical_bars(
+    ib: IB,
+    contract: Contract,
+    whatToShow: str,
+    endDateTime: str = "",
+    durationStr: str = "1 D",
+    barSizeSetting: str = "1 min",
+    useRTH: bool = False,
+    formatDate: int = 1,
+    priority: int = pacing_service.PRIORITY_BACKFILL,
+) -> BarDataList:
+    return ib.run(
+        get_historical_bars_async(
+            ib,
+            contract,
+            whatToShow,
+            endDateTime=endDateTime,
+            durationStr=durationStr,
+            barSizeSetting=barSizeSetting,
+            useRTH=useRTH,
+            formatDate=formatDate,
+            priority=priority,
         )
-        .first()
     )
 
 
-def get_add_price_bars(
+async def iter_historical_bars_async(
     ib: IB,
-    contract: Contract,
+    requests: List[HistoricalRequest],
+    max_concurrency: int = MAX_CONCURRENT_HISTORICAL,
+) -> AsyncIterator[Tuple[HistoricalRequest, BarDataList]]:
+    """
+    Fetch the historical bars of many requests concurrently.
+
+    :param ib: The IB connection.
+    :param requests: The requests to make, e.g. BID/ASK/TRADES for every strike of a ladder.
+    :param max_concurrency: Maximum number of requests in flight at once.
+    :return: (request, bars) pairs, yielded as the requests complete.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fetch(request: HistoricalRequest):
+        async with semaphore:
+            bars = await get_historical_bars_async(
+                ib,
+                request.contract,
+                request.whatToShow,
+                endDateTime=request.endDateTime,
+                durationStr=request.durationStr,
+                barSizeSetting=request.barSizeSetting,
+                useRTH=request.useRTH,
+                priority=request.priority,
+            )
+            return request, bars
+
+    for completed in asyncio.as_completed([fetch(request) for request in requests]):
+        yield await completed
+
+
+def get_many_historical_bars(
+    ib: IB,
+    requests: List[HistoricalRequest],
+    max_concurrency: int = MAX_CONCURRENT_HISTORICAL,
+) -> List[Tuple[HistoricalRequest, BarDataList]]:
+    async def collect():
+        return [
+            result
+            async for result in iter_historical_bars_async(ib, requests, max_concurrency)
+        ]
+
+    return ib.run(collect())
+
+
+# Bars written per INSERT statement, Postgres accepts at most 65535 parameters
+UPSERT_BATCH_SIZE = 5000
+
+PRICE_BAR_KEY = ["contract_id", "data_type", "bar_size", "date"]
+PRICE_BAR_VALUES = ["open", "high", "low", "close", "volume"]
+
+
+class UpsertResult(NamedTuple):
+    inserted: int = 0
+    updated: int = 0
+
+    def __add__(self, other: "UpsertResult") -> "UpsertResult":
+        return UpsertResult(self.inserted + other.inserted, self.updated + other.updated)
+
+
+def split_closed_bars(
+    bars: BarDataList, bar_size: int
+) -> Tuple[List[BarData], Optional[BarData]]:
+    """
+    Separate the closed bars from the bar still forming.
+
+    :return: The closed bars and the forming bar, if any.
+    """
+    now = datetime.now(timezone("America/New_York"))
+    closed_bars = []
+    open_bar = None
+
+    for bar in bars:
+        if bar.date + timedelta(minutes=bar_size) > now:
+            open_bar = bar
+        else:
+            closed_bars.append(bar)
+
+    return closed_bars, open_bar
+
+
+def upsert_price_bars(
+    db: Session,
+    bars: List[BarData],
     data_type: str,
+    contract_id: int,
+    bar_size: int,
+    update: bool = False,
+) -> UpsertResult:
+    """
+    Write bars with INSERT ... ON CONFLICT on (contract_id, data_type, bar_size, date).
+
+    The caller commits.
+
+    :param update: Overwrite the stored bars whose values changed, otherwise they are kept.
+    :return: The number of bars inserted and updated.
+    """
+    # IB can send the same bar twice in a response, a statement cannot touch a row twice
+    rows = {
+        bar.date: {
+            "contract_id": contract_id,
+            "data_type": data_type,
+            "bar_size": bar_size,
+            "date": bar.date,
+            "open": bar.open,
+            "high": bar.high,
+            "low": bar.low,
+            "close": bar.close,
+            "volume": bar.volume,
+        }
+        for bar in bars
+    }
+    rows = list(rows.values())
+    result = UpsertResult()
+    written_dates = set()
+
+    partition_service.ensure_partitions(db, [row["date"] for row in rows])
+
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        statement = insert(PriceBar).values(rows[start : start + UPSERT_BATCH_SIZE])
+
+        if update:
+            statement = statement.on_conflict_do_update(
+                index_elements=PRICE_BAR_KEY,
+                set_={
+                    **{column: statement.excluded[column] for column in PRICE_BAR_VALUES},
+                    "updated_at": func.now(),
+                },
+                # Identical bars are left alone and not counted
+                where=or_(
+                    *[
+                        getattr(PriceBar, column).is_distinct_from(statement.excluded[column])
+                        for column in PRICE_BAR_VALUES
+                    ]
+                ),
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=PRICE_BAR_KEY)
+
+        # xmax is 0 for a freshly inserted row
+        written = db.execute(
+            statement.returning(literal_column("xmax = 0"), PriceBar.date)
+        ).all()
+        inserted = sum(row[0] for row in written)
+
+        result += UpsertResult(inserted, len(written) - inserted)
+        written_dates.update(row[1] for row in written)
+
+    # Only the bars actually written are published to the workers' shared copy
+    shared_bars_service.stage(
+        db,
+        contract_id,
+        data_type,
+        bar_size,
+        [row for row in rows if row["date"] in written_dates],
+    )
+
+    return result
+
+
+def get_duration_str(
+    db: Session,
     contract_id: str,
     contract_type: str,
+    data_type: str,
     bar_size: int,
-    bars_to_create: List,
-    db: Session,
-    get_open_bar: bool = False,
-):
+) -> str:
     # First we check the last bar's date
     last_bar = db.query(PriceBar).filter(
         PriceBar.bar_size == bar_size,
@@ -124,54 +333,149 @@ def get_add_price_bars(
 
     if last_bar:
         difference = datetime.now(timezone("America/New_York")) - last_bar.date
-        difference_insec = (
+        durationStr = duration_str(
             difference.total_seconds() + timedelta(minutes=bar_size).total_seconds()
         )
 
-        if difference_insec < 3600:
-            durationStr = f"{math.ceil(difference_insec / 60)} S"
-        else:
-            durationStr = f"{math.ceil(difference_insec / 3600 / 6.5)} D"
+    return durationStr
 
-    open_bar = None
 
-    for bar in get_historical_bars(
-        ib,
-        contract,
-        data_type,
-        durationStr=durationStr,
-        barSizeSetting=f"{bar_size} mins",
-    ):
-        # We create the bars to add to the db
-        if bar.date + timedelta(minutes=bar_size) > datetime.now(
-            timezone("America/New_York")
-        ):
-            open_bar = bar
-            continue
-
-        if check_bar_exists(
-            db, bar.date, contract_id, contract_type, data_type, bar_size
-        ):
-            continue
-
-        bars_to_create.append(
-            PriceBar(
-                contract_id=contract_id,
-                date=bar.date,
-                open=bar.open,
-                high=bar.high,
-                low=bar.low,
-                close=bar.close,
-                volume=bar.volume,
-                bar_size=bar_size,
-                data_type=data_type,
-            )
+def duration_str(seconds: float) -> str:
+    # IB takes at most a day in seconds, longer durations are whole days
+    if seconds <= 24 * 3600:
+        return f"{math.ceil(seconds)} S"
+
+    return f"{math.ceil(seconds / (24 * 3600))} D"
+
+
+def get_add_price_bars(
+    ib: IB,
+    contract: Contract,
+    data_type: str,
+    contract_id: str,
+    contract_type: str,
+    bar_size: int,
+    db: Session,
+    get_open_bar: bool = False,
+    priority: int = pacing_service.PRIORITY_BACKFILL,
+    task: Optional[str] = None,
+):
+    """
+    Fetch the bars since the last stored one and write the closed ones.
+
+    :param task: Task whose "postgres" and "ib" stages the db work and the request are
+        timed under.
+    :return: The UpsertResult, and the forming bar when get_open_bar is set.
+    """
+    with metrics_service.stage(task, "postgres"):
+        durationStr = get_duration_str(db, contract_id, contract_type, data_type, bar_size)
+
+    with metrics_service.stage(task, "ib"):
+        bars = get_historical_bars(
+            ib,
+            contract,
+            data_type,
+            durationStr=durationStr,
+            barSizeSetting=bar_size_setting(bar_size),
+            priority=priority,
         )
 
+    closed_bars, open_bar = split_closed_bars(bars, bar_size)
+
+    with metrics_service.stage(task, "postgres"):
+        result = upsert_price_bars(db, closed_bars, data_type, contract_id, bar_size)
+
     if get_open_bar:
-        return [bars_to_create, open_bar]
+        return [result, open_bar]
+
+    return result
+
+
+def get_add_many_price_bars(
+    ib: IB,
+    series: List[Tuple[Contract, str, str, str, int]],
+    db: Session,
+    max_concurrency: int = MAX_CONCURRENT_HISTORICAL,
+    priority: int = pacing_service.PRIORITY_BACKFILL,
+) -> UpsertResult:
+    """
+    Same as get_add_price_bars for many series at once, the IB requests run concurrently.
+
+    :param series: (contract, data_type, contract_id, contract_type, bar_size) tuples.
+    :return: The total UpsertResult, the caller commits.
+    """
+    requests = {}
+
+    # The db is only used before and after the requests, never while they are in flight
+    for contract, data_type, contract_id, contract_type, bar_size in series:
+        request = HistoricalRequest(
+            contract,
+            data_type,
+            durationStr=get_duration_str(
+                db, contract_id, contract_type, data_type, bar_size
+            ),
+            barSizeSetting=bar_size_setting(bar_size),
+            priority=priority,
+        )
+        # Contracts are not hashable before qualification, we key by identity
+        requests[id(request)] = (request, data_type, contract_id, bar_size)
+
+    result = UpsertResult()
+
+    for request, bars in get_many_historical_bars(
+        ib, [request for request, *_ in requests.values()], max_concurrency
+    ):
+        _, data_type, contract_id, bar_size = requests[id(request)]
+        closed_bars, _ = split_closed_bars(bars, bar_size)
+        result += upsert_price_bars(db, closed_bars, data_type, contract_id, bar_size)
+
+    return result
+
+
+def price_bars_query(
+    contract_id: str,
+    data_type: str,
+    bar_size: int,
+    order: str,
+    limit: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+) -> Select:
+    """
+    Build the query of a page of bars, the limit and filters run in SQL on the series index.
+
+    :param start: Only the bars at or after this date.
+    :param end: Only the bars before this date.
+    :param after: Keyset cursor, the date of the last bar of the previous page. The
+        next page starts right after it in the requested order.
+    """
+    descending = order == "desc"
+
+    query = select(
+        PriceBar.id,
+        PriceBar.date,
+        PriceBar.open,
+        PriceBar.high,
+        PriceBar.low,
+        PriceBar.close,
+        PriceBar.volume,
+    ).where(
+        PriceBar.contract_id == contract_id,
+        PriceBar.data_type == data_type,
+        PriceBar.bar_size == bar_size,
+    )
+
+    if start is not None:
+        query = query.where(PriceBar.date >= start)
+    if end is not None:
+        query = query.where(PriceBar.date < end)
+    if after is not None:
+        query = query.where(PriceBar.date < after if descending else PriceBar.date > after)
+
+    query = query.order_by(PriceBar.date.desc() if descending else PriceBar.date.asc())
 
-    return bars_to_create
+    return query.limit(limit)
 
 
 def get_price_bars_from_db(
@@ -181,18 +485,133 @@ def get_price_bars_from_db(
     bar_size: int,
     order: str,
     limit: int,
-) -> List[PriceBar]:
-    query = (
-        db.query(PriceBar)
-        .filter(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+) -> List[Row]:
+    """
+    Read a page of bars, see price_bars_query.
+
+    :return: (id, date, open, high, low, close, volume) rows.
+    """
+    return db.execute(
+        price_bars_query(contract_id, data_type, bar_size, order, limit, start, end, after)
+    ).all()
+
+
+# Rows fetched at once from the server side cursor when streaming bars
+STREAM_BATCH_SIZE = 5000
+
+
+def iter_price_bars_from_db(
+    db: Session,
+    contract_id: str,
+    data_type: str,
+    bar_size: int,
+    order: str,
+    limit: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[datetime] = None,
+    batch_size: int = STREAM_BATCH_SIZE,
+) -> Iterator[List[Row]]:
+    """
+    Same as get_price_bars_from_db, the rows come in batches from a server side cursor
+    so only one batch is held in memory.
+    """
+    result = db.execute(
+        price_bars_query(
+            contract_id, data_type, bar_size, order, limit, start, end, after
+        ).execution_options(yield_per=batch_size)
+    )
+
+    yield from result.partitions()
+
+
+def get_bar_columns(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Read a long range of bars as columns, for research and backtests.
+
+    The archived days come from the memory-mapped archive files, only the days after
+    the archive watermark are read from the db.
+
+    :param limit: Only read the last `limit` bars of the range.
+    :return: date (datetime64[us], UTC), open, high, low, close and volume arrays.
+    """
+    watermark = archive_service.archived_until(contract_id, data_type, bar_size)
+    frames = []
+
+    db_start = start if watermark is None or (start is not None and start > watermark) else watermark
+    if end is None or db_start is None or db_start < end:
+        query = select(
+            PriceBar.date,
+            PriceBar.open,
+            PriceBar.high,
+            PriceBar.low,
+            PriceBar.close,
+            PriceBar.volume,
+        ).where(
+            PriceBar.contract_id == contract_id,
             PriceBar.data_type == data_type,
             PriceBar.bar_size == bar_size,
-            PriceBar.contract_id == contract_id,
         )
-        .order_by(PriceBar.date.desc() if order == "desc" else PriceBar.date.asc())
-    )
+        if db_start is not None:
+            query = query.where(PriceBar.date >= db_start)
+        if end is not None:
+            query = query.where(PriceBar.date < end)
 
-    return query.all()[:limit]
+        if limit is None:
+            rows = db.execute(query.order_by(PriceBar.date.asc())).all()
+        else:
+            # The last bars, read backwards along the index
+            rows = db.execute(query.order_by(PriceBar.date.desc()).limit(limit)).all()[::-1]
+
+        frames.append(
+            pl.DataFrame(
+                [tuple(row) for row in rows],
+                schema=archive_service.ARCHIVE_SCHEMA,
+                orient="row",
+            )
+        )
+
+    missing = None if limit is None else limit - sum(len(frame) for frame in frames)
+    if (
+        watermark is not None
+        and (start is None or start < watermark)
+        and (missing is None or missing > 0)
+    ):
+        archived = archive_service.read_archive(
+            contract_id,
+            data_type,
+            bar_size,
+            start,
+            watermark if end is None else min(end, watermark),
+        )
+        frames.insert(0, archived if missing is None else archived.tail(missing))
+
+    # A single archive file is returned as views on the mapped memory, several
+    # files or a db part are copied once into contiguous arrays
+    if not frames:
+        bars = pl.DataFrame(schema=archive_service.ARCHIVE_SCHEMA)
+    elif len(frames) == 1:
+        bars = frames[0]
+    else:
+        bars = pl.concat(frames, rechunk=True)
+
+    return {
+        column: bars[column].dt.replace_time_zone(None).to_numpy()
+        if column == "date"
+        else bars[column].to_numpy()
+        for column in bars.columns
+    }
 
 
 # Function to check if momentum is lost
@@ -0,0 +1,239 @@
+from sqlalchemy import delete, select, func
+from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
+from typing import NamedTuple, Optional, Tuple
+from pytz import timezone
+import os
+from src.logging_config import logger
+from src.models.models import BaseContract, PriceBar
+from src.services import (
+    aggregation_service,
+    archive_service,
+    backfill_service,
+    partition_service,
+    prices_service,
+    shared_bars_service,
+)
+
+# Days after which the fine bars are compacted
+COMPACT_AFTER_DAYS = int(os.getenv("PRICE_BARS_COMPACT_AFTER_DAYS", 90))
+# Days after their last trade date the bars of an option are purged
+EXPIRED_OPTION_DAYS = int(os.getenv("EXPIRED_OPTION_BARS_DAYS", 1))
+FINE_BAR_SIZES = (1, 2, 3, 5, 10, 15)
+
+NY_TZ = timezone("America/New_York")
+
+
+class RetentionPolicy(NamedTuple):
+    contract_types: Optional[Tuple[str, ...]]  # None matches every contract type
+    data_types: Optional[Tuple[str, ...]]  # None matches every data type
+    bar_sizes: Optional[Tuple[int, ...]]  # None matches every bar size
+    max_age_days: int  # Older bars are compacted, days after expiry for expired options
+    # Bar size the compacted bars are rolled up into before they are dropped, None only
+    # drops them. Rolled up bars follow the NYSE sessions.
+    roll_up_to: Optional[int] = None
+    # Only matches the options past their last trade date, all of their bars go
+    expired_options: bool = False
+
+
+# The first policy matching a series applies, the series matched by none are kept as is.
+# The bars dropped are always archived first and stay readable with get_bar_columns.
+POLICIES = (
+    # Nobody reads the bars of an expired option after its session
+    RetentionPolicy(("Option",), None, None, EXPIRED_OPTION_DAYS, expired_options=True),
+    # Old quotes are not read, the trades keep hourly bars
+    RetentionPolicy(None, ("BID", "ASK", "MIDPOINT"), FINE_BAR_SIZES, COMPACT_AFTER_DAYS),
+    RetentionPolicy(
+        ("Stock", "Index", "Option"),
+        ("TRADES",),
+        FINE_BAR_SIZES,
+        COMPACT_AFTER_DAYS,
+        roll_up_to=60,
+    ),
+)
+
+
+class CompactionResult(NamedTuple):
+    archived: int = 0
+    rolled_up: int = 0
+    deleted: int = 0
+
+    def __add__(self, other: "CompactionResult") -> "CompactionResult":
+        return CompactionResult(*(a + b for a, b in zip(self, other)))
+
+
+def find_policy(
+    contract_type: str,
+    data_type: str,
+    bar_size: int,
+    expired: bool,
+    policies: Tuple[RetentionPolicy, ...] = POLICIES,
+) -> Optional[RetentionPolicy]:
+    for policy in policies:
+        if (
+            (policy.contract_types is None or contract_type in policy.contract_types)
+            and (policy.data_types is None or data_type in policy.data_types)
+            and (policy.bar_sizes is None or bar_size in policy.bar_sizes)
+            and (expired or not policy.expired_options)
+        ):
+            return policy
+
+    return None
+
+
+def _cutoff_day(policy: RetentionPolicy, today: date, expiry: Optional[date]) -> Optional[date]:
+    # The bars before this New York day go, None when none is old enough yet
+    if policy.expired_options:
+        if expiry is None or expiry > today - timedelta(days=policy.max_age_days):
+            return None
+        return today
+
+    # The backfill would request the holes left in its window again
+    return today - timedelta(days=max(policy.max_age_days, backfill_service.BACKFILL_DAYS + 1))
+
+
+def compact_series(
+    db: Session,
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    until: date,
+    roll_up_to: Optional[int] = None,
+) -> CompactionResult:
+    """
+    Archive the bars of a series before the day `until`, roll them up into roll_up_to bars
+    and drop them from the db.
+
+    A month is done per transaction, oldest first, so an interrupted compaction resumes
+    with the bars left.
+    """
+    series = (
+        PriceBar.contract_id == contract_id,
+        PriceBar.data_type == data_type,
+        PriceBar.bar_size == bar_size,
+    )
+    cutoff = archive_service.day_bounds(until)[0]
+
+    first_date = db.execute(
+        select(func.min(PriceBar.date)).where(*series, PriceBar.date < cutoff)
+    ).scalar()
+    if first_date is None:
+        return CompactionResult()
+
+    archived = archive_service.archive_series(
+        db, contract_id, data_type, bar_size, until, first_date
+    )
+    rolled_up = deleted = 0
+
+    month = partition_service.month_start(first_date)
+    while archive_service.day_bounds(month)[0] < cutoff:
+        start = max(first_date, archive_service.day_bounds(month)[0])
+        end = min(
+            cutoff, archive_service.day_bounds(partition_service.add_months(month, 1))[0]
+        )
+
+        if roll_up_to is not None:
+            columns = prices_service.get_bar_columns(
+                db, contract_id, data_type, bar_size, start, end
+            )
+            bars = aggregation_service.resample(
+                columns, roll_up_to, aggregation_service.get_sessions(start, end)
+            )
+            # The coarse bars already stored, e.g. rolled up live, are kept
+            inserted = prices_service.upsert_price_bars(
+                db, aggregation_service.to_bars(bars), data_type, contract_id, roll_up_to
+            ).inserted
+
+            if inserted:
+                archive_service.rearchive_days(db, contract_id, data_type, roll_up_to, start, end)
+            rolled_up += inserted
+
+        deleted += db.execute(
+            delete(PriceBar).where(*series, PriceBar.date >= start, PriceBar.date < end)
+        ).rowcount
+        db.commit()
+
+        month = partition_service.add_months(month, 1)
+
+    return CompactionResult(archived, rolled_up, deleted)
+
+
+def compact_price_bars(
+    db: Session,
+    policies: Tuple[RetentionPolicy, ...] = POLICIES,
+    today: Optional[date] = None,
+) -> CompactionResult:
+    """
+    Apply the retention policies to every series holding old enough bars.
+
+    The caller runs it on the primary, the bars are rolled up and deleted in the same
+    transactions as they are read.
+    """
+    today = today or datetime.now(NY_TZ).date()
+    expiry = BaseContract.__table__.c.lastTradeDateOrContractMonth
+    columns = (
+        PriceBar.contract_id,
+        PriceBar.data_type,
+        PriceBar.bar_size,
+        BaseContract.contract_type,
+        expiry,
+    )
+
+    # Expired options go whatever the age of their bars, their series are found with the
+    # index instead of a scan of every partition
+    expired_ids = select(BaseContract.id).where(expiry < today)
+    series = set(
+        db.execute(
+            select(*columns)
+            .join(BaseContract, BaseContract.id == PriceBar.contract_id)
+            .where(PriceBar.contract_id.in_(expired_ids))
+            .distinct()
+        ).all()
+    )
+
+    # The other series only when they hold bars older than the latest cutoff, only the
+    # old partitions are read
+    latest_cutoff = max(
+        (
+            _cutoff_day(policy, today, None)
+            for policy in policies
+            if not policy.expired_options
+        ),
+        default=None,
+    )
+    if latest_cutoff is not None:
+        series.update(
+            db.execute(
+                select(*columns)
+                .join(BaseContract, BaseContract.id == PriceBar.contract_id)
+                .where(PriceBar.date < archive_service.day_bounds(latest_cutoff)[0])
+                .distinct()
+            ).all()
+        )
+
+    result = CompactionResult()
+
+    for contract_id, data_type, bar_size, contract_type, last_trade_date in sorted(series):
+        expired = last_trade_date is not None and last_trade_date < today
+        policy = find_policy(contract_type, data_type, bar_size, expired, policies)
+        if policy is None:
+            continue
+
+        until = _cutoff_day(policy, today, last_trade_date)
+        if until is None:
+            continue
+
+        compacted = compact_series(
+            db, contract_id, data_type, bar_size, until, policy.roll_up_to
+        )
+        if policy.expired_options:
+            # Nothing is left of the series, nor in the workers' shared memory
+            shared_bars_service.unlink(contract_id, data_type, bar_size)
+        if compacted.deleted:
+            logger.info(
+                f"Compacted {contract_id}:{data_type}:{bar_size} before {until}, "
+                f"{compacted.deleted} bars dropped and {compacted.rolled_up} built"
+            )
+        result += compacted
+
+    return result
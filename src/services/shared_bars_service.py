@@ -0,0 +1,365 @@
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from multiprocessing import resource_tracker, shared_memory
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+import fcntl
+import os
+import tempfile
+import time
+import numpy as np
+import pytz
+from src.logging_config import logger
+from src.models.models import PriceBar
+
+# The last bars of every series live in a shared memory ring buffer on the node, so the
+# workers read them without a db query. A series' segment is found by its name, the name
+# is the index.
+CAPACITY = int(os.getenv("SHARED_BARS_CAPACITY", 2048))
+SEGMENT_PREFIX = "htb_bars"
+READ_RETRIES = 100
+# A buffer is only trusted while bars keep being appended to it, a series idle for that
+# many bars is read from the db again
+LIVE_BARS = 2
+# Segments without new bars for that long are unlinked by the nightly sweep
+IDLE_SECONDS = int(os.getenv("SHARED_BARS_IDLE_HOURS", 24)) * 60 * 60
+SHM_DIR = "/dev/shm"
+
+BAR_DTYPE = np.dtype(
+    [
+        ("date", "M8[us]"),  # naive UTC, as prices_service.get_bar_columns
+        ("open", "f8"),
+        ("high", "f8"),
+        ("low", "f8"),
+        ("close", "f8"),
+        ("volume", "i8"),
+    ]
+)
+
+# Header of a segment, int64 values followed by the ring of bars. LIVE_AT is the time the
+# last bars were seeded or appended, the watermark of the buffer. A SIZE of 0 marks a
+# segment being created or unlinked.
+SEQ, HEAD, COUNT, SEEDED, SIZE, LIVE_AT = range(6)
+HEADER_BYTES = 64
+
+# Segments attached by this process
+_segments: Dict[str, Tuple[shared_memory.SharedMemory, np.ndarray, np.ndarray]] = {}
+
+
+# Bars written in a transaction are only published once it is committed
+@event.listens_for(Session, "after_commit")
+def _publish_staged(session: Session):
+    for (contract_id, data_type, bar_size), rows in session.info.pop("shared_bars", {}).items():
+        try:
+            write_bars(contract_id, data_type, bar_size, rows)
+        except Exception as e:
+            logger.error(f"Could not publish bars to shared memory: {str(e)}")
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_staged(session: Session):
+    session.info.pop("shared_bars", None)
+
+
+def segment_name(contract_id: int, data_type: str, bar_size: int) -> str:
+    return f"{SEGMENT_PREFIX}_{contract_id}_{data_type}_{bar_size}"
+
+
+def _untrack(segment: shared_memory.SharedMemory):
+    # The tracker would unlink the segment when the process that opened it exits,
+    # the segments outlive the workers
+    resource_tracker.unregister(segment._name, "shared_memory")
+
+
+def _detach(name: str):
+    if name not in _segments:
+        return
+
+    segment, header, ring = _segments.pop(name)
+    del header, ring
+
+    try:
+        segment.close()
+    except BufferError:
+        # A view of the buffer is still referenced, the mapping goes with it
+        pass
+
+
+def _attach(name: str, create: bool = False):
+    if name in _segments:
+        if _segments[name][1][SIZE]:
+            return _segments[name]
+
+        # Unlinked by another process, a new segment may hold the series now
+        _detach(name)
+
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        if not create:
+            return None
+
+        segment = shared_memory.SharedMemory(
+            name=name, create=True, size=HEADER_BYTES + CAPACITY * BAR_DTYPE.itemsize
+        )
+        # A new segment is zeroed, the size is set last
+        np.ndarray((HEADER_BYTES // 8,), np.int64, segment.buf)[SIZE] = CAPACITY
+
+    _untrack(segment)
+
+    header = np.ndarray((HEADER_BYTES // 8,), np.int64, segment.buf)
+    if not header[SIZE]:
+        # Caught between the creation and the initialisation by a writer
+        segment.close()
+        return None
+
+    ring = np.ndarray((header[SIZE],), BAR_DTYPE, segment.buf, offset=HEADER_BYTES)
+    _segments[name] = (segment, header, ring)
+
+    return _segments[name]
+
+
+@contextmanager
+def _write_lock(name: str):
+    # One writer at a time per series, across the processes of the node
+    with open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _to_records(rows: List[dict]) -> np.ndarray:
+    records = np.empty(len(rows), BAR_DTYPE)
+
+    for i, row in enumerate(rows):
+        date = row["date"]
+        if date.tzinfo is not None:
+            date = date.astimezone(pytz.utc).replace(tzinfo=None)
+
+        records[i] = (date, row["open"], row["high"], row["low"], row["close"], row["volume"])
+
+    return records
+
+
+def _ordered(header: np.ndarray, ring: np.ndarray, n: int) -> np.ndarray:
+    # The last n bars, oldest first. Fancy indexing copies them out of the segment.
+    n = min(n, header[COUNT])
+    return ring[(header[HEAD] - n + np.arange(n)) % len(ring)]
+
+
+def stage(db: Session, contract_id: int, data_type: str, bar_size: int, rows: List[dict]):
+    """
+    Publish bars written in the transaction of db once it is committed.
+    """
+    db.info.setdefault("shared_bars", {}).setdefault(
+        (contract_id, data_type, bar_size), []
+    ).extend(rows)
+
+
+def write_bars(
+    contract_id: int, data_type: str, bar_size: int, rows: List[dict], seeded: bool = False
+):
+    """
+    Write bars to the ring buffer of their series, a bar of a date already held replaces it.
+
+    :param rows: Bars as dicts with date, open, high, low, close and volume.
+    :param seeded: The rows are the last bars of the series in the db, the buffer then
+        holds every bar of the series up to its capacity.
+    """
+    if not rows and not seeded:
+        return
+
+    name = segment_name(contract_id, data_type, bar_size)
+    records = np.sort(_to_records(rows), order="date")
+
+    with _write_lock(name):
+        _, header, ring = _attach(name, create=True)
+
+        if header[SEQ] % 2:
+            # A writer died halfway, the content cannot be trusted
+            header[COUNT] = header[HEAD] = header[SEEDED] = header[LIVE_AT] = 0
+            header[SEQ] += 1
+
+        header[SEQ] += 1
+        try:
+            current = _ordered(header, ring, len(ring))
+
+            if seeded:
+                # Bars published since the db was read are newer than the seed
+                records = records[~np.isin(records["date"], current["date"])]
+
+            if len(records) and (
+                not len(current) or records[0]["date"] > current[-1]["date"]
+            ):
+                # New bars, the usual case, are appended after the head
+                records = records[-len(ring) :]
+                ring[(header[HEAD] + np.arange(len(records))) % len(ring)] = records
+                header[HEAD] = (header[HEAD] + len(records)) % len(ring)
+                header[COUNT] = min(header[COUNT] + len(records), len(ring))
+                header[LIVE_AT] = time.time()
+            elif len(records):
+                # Updated or older bars, the ring is rebuilt in date order
+                kept = current[~np.isin(current["date"], records["date"])]
+                merged = np.sort(np.concatenate((kept, records)), order="date")[-len(ring) :]
+                ring[: len(merged)] = merged
+                header[HEAD] = len(merged) % len(ring)
+                header[COUNT] = len(merged)
+
+            if seeded:
+                header[SEEDED] = 1
+                header[LIVE_AT] = time.time()
+        finally:
+            header[SEQ] += 1
+
+
+def invalidate(contract_id: int, data_type: str, bar_size: int):
+    """
+    Empty the buffer of a series written without upsert_price_bars, it is seeded again
+    from the db on the next read.
+    """
+    name = segment_name(contract_id, data_type, bar_size)
+
+    with _write_lock(name):
+        segment = _attach(name)
+        if segment is None:
+            return
+
+        _, header, _ = segment
+        if not header[SEQ] % 2:
+            header[SEQ] += 1
+        header[COUNT] = header[HEAD] = header[SEEDED] = header[LIVE_AT] = 0
+        header[SEQ] += 1
+
+
+def _unlink(name: str):
+    # Under the write lock. The processes still attached see the mark and let the mapping go.
+    _segments[name][1][SIZE] = 0
+
+    segment = _segments[name][0]
+    # unlink() unregisters the segment from the tracker again
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+    del segment
+
+    _detach(name)
+
+
+def unlink(contract_id: int, data_type: str, bar_size: int):
+    """
+    Remove the segment of a series from the node, e.g. once its bars are purged.
+    """
+    name = segment_name(contract_id, data_type, bar_size)
+
+    with _write_lock(name):
+        if _attach(name) is not None:
+            _unlink(name)
+
+
+def sweep(idle_seconds: int = IDLE_SECONDS) -> int:
+    """
+    Unlink the segments of the node no bar was appended to for idle_seconds, e.g. the
+    expired options'. They are seeded from the db again if the series is read.
+
+    :return: The number of segments unlinked.
+    """
+    if not os.path.isdir(SHM_DIR):
+        return 0
+
+    unlinked = 0
+
+    for name in os.listdir(SHM_DIR):
+        if not name.startswith(f"{SEGMENT_PREFIX}_"):
+            continue
+
+        attached = name in _segments
+
+        with _write_lock(name):
+            if _attach(name) is None:
+                continue
+
+            if time.time() - _segments[name][1][LIVE_AT] >= idle_seconds:
+                _unlink(name)
+                unlinked += 1
+            elif not attached:
+                _detach(name)
+
+    return unlinked
+
+
+def read_bars(contract_id: int, data_type: str, bar_size: int, n: int) -> Optional[np.ndarray]:
+    """
+    Read the last n bars of a series from its ring buffer.
+
+    The buffer only serves them once seeded from the db, and while the series is live:
+    a buffer written by a backfill only, or no longer appended to, is not the latest bars.
+
+    :return: The bars, None when the buffer cannot serve them and the db has to.
+    """
+    segment = _attach(segment_name(contract_id, data_type, bar_size))
+    if segment is None:
+        return None
+
+    _, header, ring = segment
+    live_seconds = LIVE_BARS * bar_size * 60
+
+    for _ in range(READ_RETRIES):
+        # Seqlock: the copy is only valid if no write started or ended meanwhile
+        seq = header[SEQ]
+        if seq % 2:
+            continue
+
+        if not header[SEEDED] or time.time() - header[LIVE_AT] > live_seconds:
+            return None
+
+        bars = _ordered(header, ring, n)
+
+        if header[SEQ] == seq:
+            return bars
+
+    return None
+
+
+def _load_bars(db: Session, contract_id: int, data_type: str, bar_size: int, n: int) -> List[dict]:
+    rows = db.execute(
+        select(
+            PriceBar.date,
+            PriceBar.open,
+            PriceBar.high,
+            PriceBar.low,
+            PriceBar.close,
+            PriceBar.volume,
+        )
+        .where(
+            PriceBar.contract_id == contract_id,
+            PriceBar.data_type == data_type,
+            PriceBar.bar_size == bar_size,
+        )
+        .order_by(PriceBar.date.desc())
+        .limit(n)
+    ).all()
+
+    return [row._asdict() for row in reversed(rows)]
+
+
+def get_recent_bars(
+    db: Session, contract_id: int, data_type: str, bar_size: int, n: int = CAPACITY
+) -> Dict[str, np.ndarray]:
+    """
+    Get the last n bars of a series, from shared memory when the buffer holds them.
+
+    The buffer is seeded from the db the first time a series is read, and again when no
+    bar was appended to it for LIVE_BARS bars.
+
+    :return: date (naive UTC datetime64[us]), open, high, low, close and volume arrays.
+    """
+    bars = read_bars(contract_id, data_type, bar_size, n) if n <= CAPACITY else None
+
+    if bars is None:
+        rows = _load_bars(db, contract_id, data_type, bar_size, max(n, CAPACITY))
+        if n <= CAPACITY:
+            write_bars(contract_id, data_type, bar_size, rows, seeded=True)
+        bars = _to_records(rows[-n:])
+
+    return {column: bars[column] for column in BAR_DTYPE.names}
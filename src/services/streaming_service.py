@@ -0,0 +1,345 @@
+from ib_insync import IB, Contract, BarDataList, util
+from datetime import datetime
+import json
+import time
+import numpy as np
+import pytz
+from typing import Dict, Optional
+from src.logging_config import logger
+from src.models.database import get_celery_db
+from src.models import schemas
+from src.services import (
+    aggregation_service,
+    cache,
+    metrics_service,
+    pacing_service,
+    prices_service,
+)
+
+# Bar streams held by the broker process, keyed by "conId:data_type:bar_size"
+STREAMS_KEY = "bar_streams"
+# Set by the updates of a live stream, the polling fallback in check_streams is skipped
+# then. A stream without update for STREAM_LIVE_BARS bars during a session is restarted.
+STREAM_ALIVE_KEY = "bar_stream_up"
+STREAM_LIVE_BARS = 2
+# Window requested when a stream starts, the closed bars missing from the db are stored
+STREAM_DURATION = "1 D"
+STREAM_RETRY_SECONDS = 60
+BAR_CACHE_TTL = 60 * 20
+
+# Process local state: the live bar lists and the last forming bar dispatched per stream
+_streams: Dict[str, BarDataList] = {}
+_dispatched: Dict[str, tuple] = {}
+# Forming bars of the rolled up bar sizes, built from the closed 1 min bars
+_rolled_up: Dict[str, Dict[int, object]] = {}
+_updated_at: Dict[str, float] = {}
+_failed_at: Dict[str, float] = {}
+_stream_ib: Optional[IB] = None
+
+
+def stream_key(conId: int, data_type: str, bar_size: int) -> str:
+    return f"{conId}:{data_type}:{bar_size}"
+
+
+def request_stream(
+    contract: Contract,
+    contract_id: int,
+    contract_type: str,
+    data_type: str,
+    bar_size: int,
+    cache_key: str,
+    on_update: str = None,
+    roll_up: Dict[int, str] = None,
+):
+    """
+    Ask the broker process to stream the bars of a contract.
+
+    Closed bars are written to price_bars and cached under {cache_key}C, the forming bar
+    under {cache_key}O.
+
+    :param contract: A qualified contract (with a conId).
+    :param on_update: Name of a celery task sent (contract_id, has_new_bar) when a bar
+        closes or the forming bar makes a new high or low.
+    :param roll_up: For a 1 min stream, the bar sizes built from its bars with their
+        cache keys, e.g. {5: "SPX_TRADE_5"}. The first one then drives on_update.
+    """
+    cache.r.hset(
+        STREAMS_KEY,
+        stream_key(contract.conId, data_type, bar_size),
+        json.dumps(
+            {
+                "contract": util.dataclassNonDefaults(contract),
+                "contract_id": contract_id,
+                "contract_type": contract_type,
+                "data_type": data_type,
+                "bar_size": bar_size,
+                "cache_key": cache_key,
+                "on_update": on_update,
+                "roll_up": roll_up,
+            }
+        ),
+    )
+
+
+def cancel_stream(conId: int, data_type: str, bar_size: int):
+    cache.r.hdel(STREAMS_KEY, stream_key(conId, data_type, bar_size))
+
+
+def is_streaming(cache_key: str) -> bool:
+    return bool(cache.r.exists(f"{STREAM_ALIVE_KEY}:{cache_key}"))
+
+
+def _alive_seconds(request: dict) -> int:
+    return STREAM_LIVE_BARS * request["bar_size"] * 60
+
+
+def _mark_alive(key: str, request: dict):
+    # Only an update from IB proves the stream alive, a stream IB ended silently expires
+    _updated_at[key] = time.time()
+
+    for cache_key in [request["cache_key"], *_roll_up_keys(request).values()]:
+        cache.set(f"{STREAM_ALIVE_KEY}:{cache_key}", 1, _alive_seconds(request))
+
+
+def _in_session(now: datetime) -> bool:
+    # Outside the sessions a stream can go quiet without being dead
+    opens, closes = aggregation_service.get_sessions(now, now)
+    moment = np.datetime64(now.astimezone(pytz.utc).replace(tzinfo=None), "us")
+
+    return bool(((opens <= moment) & (moment < closes)).any())
+
+
+def _cache_bar(key: str, bar):
+    cache.set(
+        key,
+        schemas.PriceBar(
+            id=0,
+            date=bar.date,
+            open=bar.open,
+            high=bar.high,
+            low=bar.low,
+            close=bar.close,
+            volume=bar.volume,
+        ).model_dump_json(),
+        BAR_CACHE_TTL,
+    )
+
+
+def _roll_up_keys(request: dict) -> Dict[int, str]:
+    # The bar sizes are strings once stored as json
+    return {int(bar_size): key for bar_size, key in (request.get("roll_up") or {}).items()}
+
+
+def _store_closed_bars(key: str, request: dict, closed_bars):
+    if not closed_bars:
+        return
+
+    roll_up_keys = _roll_up_keys(request)
+
+    with metrics_service.stage("stream_bars", "postgres"):
+        with get_celery_db() as db:
+            # The streamed values are final, they replace a bar stored by an earlier poll
+            prices_service.upsert_price_bars(
+                db,
+                closed_bars,
+                request["data_type"],
+                request["contract_id"],
+                request["bar_size"],
+                update=True,
+            )
+
+            last_closed = {}
+            if roll_up_keys and key not in _rolled_up:
+                # The forming bars of the session so far are read once, when the stream starts
+                rolled_up = aggregation_service.roll_up(
+                    db,
+                    request["contract_id"],
+                    request["data_type"],
+                    closed_bars[0].date,
+                    list(roll_up_keys),
+                )
+                _rolled_up[key] = {
+                    bar_size: forming for bar_size, (_, forming) in rolled_up.items()
+                }
+                last_closed = {
+                    bar_size: closed for bar_size, (closed, _) in rolled_up.items()
+                }
+
+            elif roll_up_keys:
+                # Then each closed 1 min bar is folded into them
+                for bar in closed_bars:
+                    closed, _rolled_up[key] = aggregation_service.fold(_rolled_up[key], bar)
+
+                    for bar_size, bars in closed.items():
+                        if not bars:
+                            continue
+                        prices_service.upsert_price_bars(
+                            db,
+                            bars,
+                            request["data_type"],
+                            request["contract_id"],
+                            bar_size,
+                            update=True,
+                        )
+                        last_closed[bar_size] = bars[-1]
+
+            db.commit()
+
+    with metrics_service.stage("stream_bars", "redis"):
+        _cache_bar(f"{request['cache_key']}C", closed_bars[-1])
+
+        for bar_size, cache_key in roll_up_keys.items():
+            if last_closed.get(bar_size) is not None:
+                _cache_bar(f"{cache_key}C", last_closed[bar_size])
+
+
+def _forming_bar(key: str, request: dict, bar):
+    """
+    Cache the forming bars and return the one driving on_update.
+    """
+    roll_up_keys = _roll_up_keys(request)
+
+    with metrics_service.stage("stream_bars", "redis"):
+        _cache_bar(f"{request['cache_key']}O", bar)
+
+        if not roll_up_keys:
+            return bar
+
+        # The forming 1 min bar is added to the bars rolled up from the closed ones
+        rolled_up = _rolled_up.get(key, {})
+        forming_bars = {
+            bar_size: aggregation_service.merge_forming(rolled_up.get(bar_size), bar, bar_size)
+            for bar_size in roll_up_keys
+        }
+
+        for bar_size, cache_key in roll_up_keys.items():
+            if forming_bars[bar_size] is not None:
+                _cache_bar(f"{cache_key}O", forming_bars[bar_size])
+
+    return forming_bars[next(iter(roll_up_keys))]
+
+
+def _dispatch(key: str, request: dict, forming_bar):
+    if forming_bar is None:
+        return
+
+    # Only a new bar or a new high/low of the forming bar can change a signal
+    extremes = (forming_bar.date, forming_bar.high, forming_bar.low)
+    dispatched = _dispatched.get(key)
+    if dispatched == extremes:
+        return
+    _dispatched[key] = extremes
+
+    if not request["on_update"]:
+        return
+
+    from src.celery_app import celery_app
+
+    has_new_bar = dispatched is None or dispatched[0] != forming_bar.date
+    celery_app.send_task(request["on_update"], args=[request["contract_id"], has_new_bar])
+
+
+def _on_bar_update(key: str, request: dict):
+    def on_bar_update(bars: BarDataList, hasNewBar: bool):
+        if not bars:
+            return
+
+        try:
+            _mark_alive(key, request)
+
+            if hasNewBar:
+                # The bar before the forming one just closed
+                _store_closed_bars(key, request, bars[-2:-1])
+
+            _dispatch(key, request, _forming_bar(key, request, bars[-1]))
+
+        except Exception as e:
+            logger.error(f"Error handling bar update for {key}: {str(e)}")
+
+    return on_bar_update
+
+
+def start_stream(ib: IB, key: str, request: dict) -> BarDataList:
+    contract = Contract.create(**request["contract"])
+
+    ib.run(pacing_service.acquire_token(pacing_service.PRIORITY_LIVE))
+    bars = ib.reqHistoricalData(
+        contract,
+        endDateTime="",
+        durationStr=STREAM_DURATION,
+        barSizeSetting=prices_service.bar_size_setting(request["bar_size"]),
+        whatToShow=request["data_type"],
+        useRTH=False,
+        formatDate=1,
+        keepUpToDate=True,
+    )
+    logger.info(f"Streaming {request['bar_size']} min {request['data_type']} bars of conId {contract.conId}")
+    _mark_alive(key, request)
+
+    # The last bar is still forming, the others fill the gap since the last stored bar
+    if bars:
+        _store_closed_bars(key, request, bars[:-1])
+        _dispatch(key, request, _forming_bar(key, request, bars[-1]))
+
+    bars.updateEvent += _on_bar_update(key, request)
+
+    return bars
+
+
+def stop_stream(ib: IB, key: str):
+    bars = _streams.pop(key, None)
+    _dispatched.pop(key, None)
+    _rolled_up.pop(key, None)
+    _updated_at.pop(key, None)
+
+    if bars is not None and ib.isConnected():
+        ib.cancelHistoricalData(bars)
+
+
+def sync_streams(ib: IB):
+    """
+    Run by the broker process: start the requested streams and drop the removed ones.
+    """
+    global _stream_ib
+
+    if ib is not _stream_ib:
+        # New connection, the subscriptions of the previous one are gone
+        _streams.clear()
+        _dispatched.clear()
+        _rolled_up.clear()
+        _updated_at.clear()
+        _failed_at.clear()
+        _stream_ib = ib
+
+    requests = {
+        key.decode("utf-8"): json.loads(raw)
+        for key, raw in cache.r.hgetall(STREAMS_KEY).items()
+    }
+
+    now = time.time()
+    in_session = _in_session(datetime.now(pytz.utc))
+
+    for key in list(_streams):
+        if not in_session:
+            # Quiet until the open, the window starts then
+            _updated_at[key] = now
+        elif key in requests and now - _updated_at[key] > _alive_seconds(requests[key]):
+            # IB ended it without a word (error 162/1100, farm reset), it is started again
+            logger.warning(f"No update of bar stream {key}, restarting it")
+            stop_stream(ib, key)
+
+    for key, request in requests.items():
+        if key not in _streams:
+            if time.time() - _failed_at.get(key, 0) < STREAM_RETRY_SECONDS:
+                continue
+
+            try:
+                _streams[key] = start_stream(ib, key, request)
+            except Exception as e:
+                logger.error(f"Could not start bar stream {key}: {str(e)}")
+                _failed_at[key] = time.time()
+
+    for key in list(_streams):
+        if key not in requests:
+            logger.info(f"Cancelling bar stream {key}")
+            stop_stream(ib, key)
@@ -16,6 +16,29 @@ CELERY_BEAT_SCHEDULE = {
         "task": "src.tasks.market_reader_tasks.check_streams",
         "schedule": timedelta(seconds=30),  # Run every minute for testing purposes
     },
+    # Before the partitions are maintained, so a month is archived before it expires
+    "archive_closed_days": {
+        "task": "src.tasks.maintenance_tasks.archive_closed_days",
+        "schedule": crontab(hour=1, minute=0),
+    },
+    # Once the closed days are archived, the dropped bars stay readable from the archive
+    "compact_price_bars": {
+        "task": "src.tasks.maintenance_tasks.compact_price_bars",
+        "schedule": crontab(hour=1, minute=30),
+    },
+    "sweep_shared_bars": {
+        "task": "src.tasks.maintenance_tasks.sweep_shared_bars",
+        "schedule": crontab(hour=1, minute=45),
+    },
+    "maintain_price_bar_partitions": {
+        "task": "src.tasks.maintenance_tasks.maintain_price_bar_partitions",
+        "schedule": crontab(hour=2, minute=0),
+    },
+    # Holes left by outages are fetched overnight, once the partitions exist
+    "backfill_recent_series": {
+        "task": "src.tasks.maintenance_tasks.backfill_recent_series",
+        "schedule": crontab(hour=3, minute=0),
+    },
     # "cleanup_streams": {
     #     "task": "src.tasks.broadcasting_tasks.cleanup_streams",
     #     "schedule": timedelta(minutes=1),
@@ -36,6 +59,7 @@ CELERY_TASK_ROUTES = {
     "src.tasks.economic_data_tasks.*": {"queue": "default"},
     "src.tasks.trend_tasks.*": {"queue": "default"},
     "src.tasks.order_tasks.*": {"queue": "default"},
+    "src.tasks.maintenance_tasks.*": {"queue": "default"},
 }
 
 CELERY_LOG_LEVEL = logging.INFO
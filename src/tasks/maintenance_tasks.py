@@ -0,0 +1,139 @@
+from src.celery_app import celery_app
+from src.logging_config import logger
+from src.models import models
+from src.models.database import get_celery_db, get_read_celery_db
+from src.services import (
+    aggregation_service,
+    archive_service,
+    backfill_service,
+    contracts_service,
+    ibapi_service,
+    indicator_service,
+    partition_service,
+    retention_service,
+    shared_bars_service,
+)
+from sqlalchemy import select
+from datetime import datetime, timedelta
+from typing import List
+import pytz
+
+
+@celery_app.task
+def maintain_price_bar_partitions():
+    # The partitions of the next months exist before the first bar of the month arrives,
+    # and the expired months are dropped as a whole instead of deleting their rows
+    with get_celery_db() as db:
+        partition_service.create_future_partitions(db)
+        dropped = partition_service.drop_expired_partitions(db)
+
+    logger.info(f"price_bars partitions maintained, {len(dropped)} dropped")
+
+
+@celery_app.task
+def archive_closed_days():
+    # Long range reads go to the archive files, the db keeps serving the recent bars.
+    # Closed days only, a replica's lag does not matter.
+    with get_read_celery_db() as db:
+        archive_service.archive_closed_days(db)
+
+
+@celery_app.task
+def compact_price_bars():
+    # Old fine bars are archived and rolled up, expired options' bars are purged, so
+    # price_bars only holds what the hot queries read
+    with get_celery_db() as db:
+        result = retention_service.compact_price_bars(db)
+
+    logger.info(
+        f"price_bars compacted, {result.deleted} bars dropped, {result.rolled_up} rolled up"
+    )
+
+
+@celery_app.task
+def sweep_shared_bars():
+    # The series no bar was appended to lately, e.g. the expired options', leave /dev/shm
+    unlinked = shared_bars_service.sweep()
+
+    logger.info(f"Shared bars swept, {unlinked} idle segments unlinked")
+
+
+@celery_app.task
+def backfill_price_bars(
+    contract_id: int,
+    data_type: str,
+    bar_size: int,
+    days: int = backfill_service.BACKFILL_DAYS,
+    roll_up: List[int] = None,
+):
+    """
+    Fetch the holes of a series, then rebuild the bar sizes rolled up from it.
+    """
+    with get_celery_db() as db:
+        db_contract = (
+            db.query(models.BaseContract)
+            .filter(models.BaseContract.id == contract_id)
+            .first()
+        )
+
+        with ibapi_service.connect_to_ib() as ib:
+            contract = contracts_service.get_qualified_contract(db, ib, db_contract)
+            result = backfill_service.backfill(
+                db, ib, contract, contract_id, data_type, bar_size, days
+            )
+
+        if result.inserted and roll_up:
+            aggregation_service.roll_up(
+                db,
+                contract_id,
+                data_type,
+                datetime.now(pytz.utc) - timedelta(days=days),
+                roll_up,
+            )
+            db.commit()
+
+    # The holes filled are in the past of the indicators, they start over
+    if result.inserted:
+        for size in [bar_size, *(roll_up or [])]:
+            indicator_service.reset_state(contract_id, data_type, size)
+
+    logger.info(
+        f"Backfilled {contract_id}:{data_type}:{bar_size}, {result.inserted} bars inserted"
+    )
+
+
+@celery_app.task
+def backfill_recent_series(days: int = backfill_service.BACKFILL_DAYS):
+    # Every intraday series written to lately. The bar sizes built from 1 min bars are
+    # rebuilt from them instead of being requested.
+    since = datetime.now(pytz.utc) - timedelta(days=days)
+
+    with get_celery_db() as db:
+        series = {
+            tuple(row)
+            for row in db.execute(
+                select(
+                    models.PriceBar.contract_id,
+                    models.PriceBar.data_type,
+                    models.PriceBar.bar_size,
+                )
+                .where(models.PriceBar.date >= since)
+                .distinct()
+            )
+        }
+
+    rolled_up = {}
+    for contract_id, data_type, bar_size in series:
+        if bar_size in aggregation_service.ROLLUP_BAR_SIZES:
+            rolled_up.setdefault((contract_id, data_type), []).append(bar_size)
+
+    for contract_id, data_type, bar_size in series:
+        if bar_size == aggregation_service.SOURCE_BAR_SIZE:
+            backfill_price_bars.delay(
+                contract_id, data_type, bar_size, days, rolled_up.get((contract_id, data_type))
+            )
+        elif bar_size < aggregation_service.DAILY and not (
+            bar_size in aggregation_service.ROLLUP_BAR_SIZES
+            and (contract_id, data_type, aggregation_service.SOURCE_BAR_SIZE) in series
+        ):
+            backfill_price_bars.delay(contract_id, data_type, bar_size, days)
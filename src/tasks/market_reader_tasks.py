@@ -11,8 +11,11 @@ from src.services import (
     calendar_service,
     cache,
     notification_service,
+    pacing_service,
+    metrics_service,
+    shared_bars_service,
+    streaming_service,
 )
-from src.services.ibapi_service import ib_index
 import asyncio
 import json
 from src.models.models import Stock, PriceBar, Future, Option, Forex, Index
@@ -29,18 +32,22 @@ from ib_insync import (
     BarData,
 )
 from pytz import timezone
+import pytz
 from src.tasks import trend_tasks, order_tasks, stocks_tasks
 
 
 entry_time = datetime.strptime("10:00:00", "%H:%M:%S").time()
 out_time = datetime.strptime("15:00:00", "%H:%M:%S").time()
 momentum_threshold = 3
+SPX_STREAM_KEY = "SPX_TRADE_5"
 
 
 @celery_app.task
 def check_streams():
-    # To check entries
-    stream_spx_trades.delay()
+    # To check entries, the broker streams the SPX bars and sends on_spx_bar itself.
+    # We only poll while that stream is down.
+    if not streaming_service.is_streaming(SPX_STREAM_KEY):
+        stream_spx_trades.delay()
 
     # To check strat 1
     stream_strat_1_pnl.delay()
@@ -56,35 +63,37 @@ def stream_spx_trades():
         index = contracts_service.get_contract_by_symbol(db, "SPX", "Index")
 
         with ibapi_service.connect_to_ib() as ib:
-            bars, open_bar = prices_service.get_add_price_bars(
+            # The request and the db work are timed as separate stages
+            result, open_bar = prices_service.get_add_price_bars(
                 ib,
                 ib_index("SPX", "SMART"),
                 "TRADES",
                 index.id,
                 "Index",
                 5,
-                [],
                 db,
                 True,
+                priority=pacing_service.PRIORITY_LIVE,
+                task="stream_spx_trades",
             )
 
-        if bars:
-            db.add_all(bars)
-            db.commit()
+        if result.inserted:
+            with metrics_service.stage("stream_spx_trades", "postgres"):
+                db.commit()
 
-            last_bar = (
-                db.query(PriceBar)
-                .filter(
-                    PriceBar.contract_id == index.id,
-                    PriceBar.bar_size == 5,
-                    PriceBar.data_type == "TRADES",
+                last_bar = (
+                    db.query(PriceBar)
+                    .filter(
+                        PriceBar.contract_id == index.id,
+                        PriceBar.bar_size == 5,
+                        PriceBar.data_type == "TRADES",
+                    )
+                    .order_by(PriceBar.date.desc())
+                    .first()
                 )
-                .order_by(PriceBar.timestamp.desc())
-                .first()
-            )
 
             cache.set(
-                f"SPX_TRADE_5C",
+                f"{SPX_STREAM_KEY}C",
                 schemas.PriceBar(
                     id=last_bar.id,
                     date=last_bar.date,
@@ -101,22 +110,10 @@ def stream_spx_trades():
             )
             trend_tasks.get_trend.delay(index.id, "TRADES", 5)
 
-        else:
-            last_bar = (
-                db.query(PriceBar)
-                .filter(
-                    PriceBar.contract_id == index.id,
-                    PriceBar.bar_size == 5,
-                    PriceBar.data_type == "TRADES",
-                )
-                .order_by(PriceBar.timestamp.desc())
-                .first()
-            )
-
     open_bar: BarData = open_bar
 
     cache.set(
-        f"SPX_TRADE_5O",
+        f"{SPX_STREAM_KEY}O",
         schemas.PriceBar(
             id=0,
             date=open_bar.date,
@@ -129,19 +126,40 @@ def stream_spx_trades():
         60 * 20,
     )
 
+    check_spx_entry(index.id, open_bar)
+
+
+@celery_app.task
+def on_spx_bar(contract_id: int, has_new_bar: bool):
+    # Sent by the broker's bar stream, the bars are already stored and cached
+    if has_new_bar:
+        trend_tasks.find_high_low_day.delay(
+            contract_id, 5, "TRADES", datetime.now().strftime("%Y%m%d")
+        )
+        trend_tasks.get_trend.delay(contract_id, "TRADES", 5)
+
+    open_bar = cache.get(f"{SPX_STREAM_KEY}O")
+    if not open_bar:
+        return
+
+    check_spx_entry(contract_id, schemas.PriceBar(**open_bar))
+
+
+def check_spx_entry(index_id: int, open_bar):
     logger.warning(f"SPX last price: {open_bar.close}")
     now = datetime.now(timezone("America/New_York")).time()
 
     # Now we check to enter:
-    trend = cache.get("SPX_TRADES_trend")
-    high = cache.get("SPX_TRADES_high")
-    low = cache.get("SPX_TRADES_low")
+    with metrics_service.stage("stream_spx_trades", "redis"):
+        trend = cache.get("SPX_TRADES_trend")
+        high = cache.get("SPX_TRADES_high")
+        low = cache.get("SPX_TRADES_low")
 
     if not trend or not high or not low:
         trend_tasks.find_high_low_day(
-            index.id, 5, "TRADES", datetime.now().strftime("%Y%m%d")
+            index_id, 5, "TRADES", datetime.now().strftime("%Y%m%d")
         )
-        trend_tasks.get_trend(index.id, "TRADES", 5)
+        trend_tasks.get_trend(index_id, "TRADES", 5)
 
         trend = cache.get("SPX_TRADES_trend")
         high = cache.get("SPX_TRADES_high")
@@ -268,40 +286,34 @@ def stream_strat_2():
 
         with get_celery_db() as db:
             option = db.query(Option).filter(Option.id == int(option_id)).first()
-            contract = contracts_service.db_to_ib_option_contracts([option])[0].option
 
             with ibapi_service.connect_to_ib() as ib:
-                ib_contract = ib.qualifyContracts(contract)[0]
-                bars, open_bar = prices_service.get_add_price_bars(
-                    ib, ib_contract, "BID", option.id, "Option", 15, [], db, True
+                ib_contract = contracts_service.get_qualified_contract(db, ib, option)
+                result, open_bar = prices_service.get_add_price_bars(
+                    ib,
+                    ib_contract,
+                    "BID",
+                    option.id,
+                    "Option",
+                    15,
+                    db,
+                    True,
+                    priority=pacing_service.PRIORITY_LIVE,
                 )
 
-            if bars:
-                db.add_all(bars)
+            if result.inserted:
                 db.commit()
-                last_closed_bar = bars[-1]
 
-            else:
-                last_closed_bar = (
-                    db.query(PriceBar)
-                    .filter(
-                        PriceBar.contract_id == option_id,
-                        PriceBar.bar_size == 15,
-                        PriceBar.data_type == "BID",
-                    )
-                    .order_by(PriceBar.date.desc())
-                    .first()
-                )
+            # From the workers' shared copy, the bars just written are already in it
+            bars = shared_bars_service.get_recent_bars(db, option.id, "BID", 15, 1)
+            last_closed_bar = None
 
-            last_closed_bar = schemas.PriceBar(
-                id=last_closed_bar.id,
-                date=last_closed_bar.date,
-                open=last_closed_bar.open,
-                high=last_closed_bar.high,
-                low=last_closed_bar.low,
-                close=last_closed_bar.close,
-                volume=last_closed_bar.volume,
-            )
+            if len(bars["date"]):
+                last_closed_bar = {column: values[-1].item() for column, values in bars.items()}
+                last_closed_bar["date"] = last_closed_bar["date"].replace(tzinfo=pytz.utc)
+                last_closed_bar = schemas.PriceBar(**last_closed_bar)
+            else:
+                logger.warning(f"No closed {trade_type.upper()} BID bar yet")
 
         if open_bar:
             cache.set(
@@ -318,7 +330,8 @@ def stream_strat_2():
             cache.set(f"s2_{trade_type}", 0, 1)
 
         if (
-            last_closed_bar.high > price * momentum_threshold
+            last_closed_bar is not None
+            and last_closed_bar.high > price * momentum_threshold
             and prices_service.momentum_is_lost(last_closed_bar, 1)
         ):
             logger.warning(f"SELLING {trade_type.upper()} with profit STRAT 2")
@@ -11,6 +11,11 @@ from services import (
 )
 
 from ib_insync import LimitOrder
+import math
+
+# Ladder positions of the legs, strikes ordered away from the money
+MONEY_LEG = 1
+SAVER_LEG = 9
 
 
 @celery_app.task
@@ -29,13 +34,12 @@ def enter_trade(trend: int):
                 db, ib, spx_contract.id, expiration_date, trend
             )
 
-            money_contract = contracts[1]
+            money_contract = contracts[MONEY_LEG]
             place_order.delay(
                 money_contract.id, None, "SELL", 1, trend=trend, cache_key="sell_trade"
             )
-            entry_prices[money_contract.id] = prices_service.get_last_price(ib, money_contract)
 
-            saver_contract = contracts[9]
+            saver_contract = contracts[SAVER_LEG]
             place_order.delay(
                 saver_contract.id,
                 None,
@@ -44,7 +48,21 @@ def enter_trade(trend: int):
                 trend=trend,
                 cache_key="buy_trade",
             )
-            entry_prices[saver_contract.id] = prices_service.get_last_price(ib, saver_contract)
+
+            # The whole ladder up to the saver leg is quoted with one network wait
+            quotes = contracts_service.get_ladder_quotes(db, ib, contracts[: SAVER_LEG + 1])
+            # Mid price when the contract did not trade yet
+            quotes["price"] = quotes["last"].fillna((quotes["bid"] + quotes["ask"]) / 2)
+
+            for leg in [MONEY_LEG, SAVER_LEG]:
+                contract = contracts[leg]
+                price = quotes["price"].iloc[leg]
+
+                entry_prices[contract.id] = (
+                    float(price)
+                    if not math.isnan(price)
+                    else prices_service.get_last_price(ib, contract)
+                )
 
             cache.set(f"trade", f"{trend}:0")
             
@@ -96,11 +114,9 @@ def place_order(
     with get_celery_db() as db:
         with ibapi_service.connect_to_ib() as ib:
             contract = db.query(models.Option).get(option_id)
-            ib_contract = contracts_service.db_to_ib_option_contracts([contract])[
-                0
-            ].option
 
-            ib_contract = ib.qualifyContracts(ib_contract)[0]
+            # Built from the stored conId, IB is only asked on the first order of a contract
+            ib_contract = contracts_service.get_qualified_contract(db, ib, contract)
 
             bid_ask = "ASK" if order_type == "BUY" else "BID"
 
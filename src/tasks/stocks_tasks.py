@@ -17,7 +17,6 @@ def fetch_stock(symbol: str, exchange: str, currency: str, to_trade: bool):
         stock = ib_stock(symbol, exchange, currency)
 
         contract_details = contracts_service.get_contract_details(ib, stock)
-        conId = contract_details[0].contract.conId
 
         with get_celery_db() as db:
             db_stock = Stock(
@@ -25,9 +24,11 @@ def fetch_stock(symbol: str, exchange: str, currency: str, to_trade: bool):
                 contract_type="Stock",
                 exchange=exchange,
                 currency=currency,
-                conId=conId,
                 to_trade=to_trade,
             )
+            contracts_service.apply_contract_details(
+                db_stock, contract_details[0].contract
+            )
             db.add(db_stock)
             db.commit()
             db.refresh(db_stock)
@@ -48,6 +49,9 @@ def fetch_index(symbol: str, exchange: str, currency: str, to_trade: bool):
                 currency=currency,
                 to_trade=to_trade,
             )
+            contracts_service.apply_contract_details(
+                db_index, contract_details[0].contract
+            )
             db.add(db_index)
             db.commit()
             db.refresh(db_index)
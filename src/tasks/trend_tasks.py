@@ -1,10 +1,9 @@
 from src.celery_app import celery_app
-from src.services import cache
+from src.services import cache, indicator_service, shared_bars_service
 from src.models import models
 from src.models.database import get_celery_db
-from sqlalchemy import func
-from datetime import datetime, timedelta
-import pandas as pd
+from datetime import datetime
+import numpy as np
 
 
 @celery_app.task
@@ -12,37 +11,21 @@ def find_high_low_day(contract_id: int, bar_size: int, bar_type: str, date_str:
     date_obj = datetime.strptime(date_str, "%Y%m%d")
 
     # Assuming 'date' is the day you want to filter on
-    start_of_day = datetime.combine(date_obj, datetime.min.time())  # Start of the day
-    end_of_day = start_of_day + timedelta(days=1)  # End of the day (exclusive)
+    start_of_day = np.datetime64(date_obj, "us")  # Start of the day, bar dates are naive UTC
+    end_of_day = start_of_day + np.timedelta64(1, "D")  # End of the day (exclusive)
 
     with get_celery_db() as db:
-        high = (
-            db.query(
-                func.max(models.PriceBar.high),
-            )
-            .filter(
-                models.PriceBar.contract_id == contract_id,
-                models.PriceBar.bar_size == bar_size,
-                models.PriceBar.data_type == bar_type,
-                models.PriceBar.date >= start_of_day,
-                models.PriceBar.date < end_of_day,  # Exclusive end of the day
-            )
-            .first()
-        )
-
-        low = (
-            db.query(
-                func.min(models.PriceBar.low),
-            )
-            .filter(
-                models.PriceBar.contract_id == contract_id,
-                models.PriceBar.bar_size == bar_size,
-                models.PriceBar.data_type == bar_type,
-                models.PriceBar.date >= start_of_day,
-                models.PriceBar.date < end_of_day,  # Exclusive end of the day
-            )
-            .first()
+        # A day of bars at most, read from the workers' shared copy
+        bars = shared_bars_service.get_recent_bars(
+            db,
+            contract_id,
+            bar_type,
+            bar_size,
+            min(24 * 60 // bar_size + 1, shared_bars_service.CAPACITY),
         )
+        in_day = (bars["date"] >= start_of_day) & (bars["date"] < end_of_day)
+        high = float(bars["high"][in_day].max()) if in_day.any() else None
+        low = float(bars["low"][in_day].min()) if in_day.any() else None
 
         contract = (
             db.query(models.BaseContract)
@@ -53,78 +36,24 @@ def find_high_low_day(contract_id: int, bar_size: int, bar_type: str, date_str:
     cached_high = cache.get(f"{contract.symbol}_{bar_type}_high")
     cached_low = cache.get(f"{contract.symbol}_{bar_type}_low")
 
-    if not cached_high or high[0] > cached_high:
-        cache.set(f"{contract.symbol}_{bar_type}_high", high[0], 60 * 20)
+    if not cached_high or high > cached_high:
+        cache.set(f"{contract.symbol}_{bar_type}_high", high, 60 * 20)
 
-    if not cached_low or low[0] < cached_low:
-        cache.set(f"{contract.symbol}_{bar_type}_low", low[0], 60 * 20)
+    if not cached_low or low < cached_low:
+        cache.set(f"{contract.symbol}_{bar_type}_low", low, 60 * 20)
 
 
 @celery_app.task
 def get_trend(contract_id: str, data_type: str, bar_size: int):
-    # TODO: Only calculate from the necessary number of bars
-
-    with get_celery_db() as db:
-        bars = (
-            db.query(models.PriceBar)
-            .filter(
-                models.PriceBar.contract_id == contract_id,
-                models.PriceBar.data_type == data_type,
-                models.PriceBar.bar_size == bar_size,
-            )
-            .order_by(models.PriceBar.date.asc())
-            .all()
-        )
-        price_bars = pd.DataFrame([bar.__dict__ for bar in bars])
-
-    # Convert the data into a Pandas DataFrame
-    data = pd.DataFrame(
-        {
-            "Date": price_bars["date"],
-            "Open": price_bars["open"],
-            "High": price_bars["high"],
-            "Low": price_bars["low"],
-            "Close": price_bars["close"],
-            "Volume": price_bars["volume"],
-        }
-    )
-
-    # Set the 'Date' column as the index
-    data.set_index("Date", inplace=True)
-
-    # Calculate RSI with adjusted period for 5-min bars using closing prices
-    window_length = 12 * 5
-    delta = data["Close"].diff(1)
-    gain = (delta.where(delta > 0, 0)).rolling(window=window_length).mean()
-    loss = (-delta.where(delta < 0, 0)).rolling(window=window_length).mean()
-    rs = gain / loss
-    data["RSI"] = 100 - (100 / (1 + rs))
-
-    # Calculate 144 EMA of RSI
-    data["RSI_EMA_144"] = data["RSI"].ewm(span=144, adjust=False).mean()
-
-    # Define threshold for RSI EMA
-    rsi_ema_threshold = 45
-
-    # Initialize trend column
-    data["Trend"] = 0
-
-    # Generate bullish signal when RSI's 144 EMA is above 45
-    data.loc[data["RSI_EMA_144"] > rsi_ema_threshold, "Trend"] = 1
-
+    # The RSI and its EMA are advanced over the bars closed since the last run only,
+    # their state is kept between the runs
     with get_celery_db() as db:
-        for index, row in data.iterrows():
-            db.query(models.PriceBar).filter(
-                models.PriceBar.contract_id == contract_id,
-                models.PriceBar.data_type == data_type,
-                models.PriceBar.bar_size == bar_size,
-                models.PriceBar.date == index,
-            ).update({
-                "trend": float(row["Trend"]),
-                "rsi_ema": float(row["RSI_EMA_144"])
-            })
+        values, state = indicator_service.update_trend(db, contract_id, data_type, bar_size)
 
+        # One statement per batch, the bars already holding these values are not touched
+        indicator_service.write_trend(db, contract_id, data_type, bar_size, values)
         db.commit()
+        indicator_service.save_state(contract_id, data_type, bar_size, state)
 
         contract = (
             db.query(models.BaseContract)
@@ -133,9 +62,10 @@ def get_trend(contract_id: str, data_type: str, bar_size: int):
         )
 
     # Cache the latest values
+    rsi_ema, trend = indicator_service.latest_trend(state)
     latest_values = {
-        "rsi_ema": float(data["RSI_EMA_144"].iloc[-1]),
-        "trend": int(data["Trend"].iloc[-1])
+        "rsi_ema": rsi_ema,
+        "trend": trend
     }
 
     # Store all values in cache